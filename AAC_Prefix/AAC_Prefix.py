@@ -3,17 +3,25 @@ from torch import nn, Tensor
 import torch.nn as nn
 from torch.nn import functional as nnf
 from transformers import GPT2Model, GPT2Tokenizer
+from transformers.pytorch_utils import Conv1D
 import numpy as np
 import math
 import copy
 
 from torch.nn import functional as nnf
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.ao.quantization import quantize_dynamic
 
 from util import *
 from AAC_Prefix.PANNs.CNN14 import Cnn14 # audio encoder : PANNs
+from AAC_Prefix.PANNs.CNN14 import get_student_encoder # distilled slim Cnn14
 from .Transformer import * # transformer
+from .GPT2_KVCache import SharedPrefixKVCache # key/value cache for beam search
+from .StaticDecodeStep import StaticDecoder # fixed-shape decoding step for graph compilation
+from .DraftDecoder import generate_speculative # speculative decoding with a small draft decoder
 
 num_head = 8
+num_temporal_tokens = 15 # temporal length of Cnn14's feature for a 10s clip, variable-length clips are pooled to it
 
 # PE from PyTorch(link : ) 
 class PositionalEncoding(nn.Module):
@@ -37,8 +45,31 @@ class PositionalEncoding(nn.Module):
         x = x + self.pe[:x.size(0)]
         return self.dropout(x)
 
+def masked_adaptive_avg_pool(x, mask, output_size) :
+    # adaptive_avg_pool1d over dim 2 of x [batch_size, channel, time_steps, freq], using only the valid frames of each clip.
+    # mask : [batch_size, time_steps], True on the valid frames (a prefix of the time axis, see Cnn14.forward)
+    # Bin i of a clip with L valid frames averages frames [floor(i*L/S), ceil((i+1)*L/S)), as adaptive_avg_pool1d does.
+    time_steps = x.size()[2]
+    
+    valid_length = mask.sum(dim=1, keepdim=True) # [batch_size, 1]
+    bin_idx = torch.arange(output_size, device=x.device).unsqueeze(0)
+    start = torch.div(bin_idx * valid_length, output_size, rounding_mode='floor') # [batch_size, output_size]
+    end = torch.div((bin_idx + 1) * valid_length + output_size - 1, output_size, rounding_mode='floor')
+    
+    frame_idx = torch.arange(time_steps, device=x.device).view(1, 1, -1)
+    weight = (frame_idx >= start.unsqueeze(2)) & (frame_idx < end.unsqueeze(2)) # [batch_size, output_size, time_steps]
+    weight = weight.to(x.dtype) / (end - start).unsqueeze(2).to(x.dtype)
+    
+    return torch.einsum('bctf,bst->bcsf', x, weight)
+
+
 class MappingNetwork_forTemporalFeature(nn.Module):
-    def forward(self, x):
+    def forward(self, x, mask = None):
+        # mask : [batch_size, time_steps] frame mask of a variable-length batch (see Cnn14.forward), 
+        #        then the valid frames of every clip are pooled to num_temporal_tokens tokens
+        
+        if mask is not None :
+            x = masked_adaptive_avg_pool(x, mask, num_temporal_tokens) # [batch_size, 2048, T, 2] -> [batch_size, 2048, 15, 2]
         
         x = self.conv(x) # [batch_size, 2048, 15, 2] -> [batch_size, 768, 15, 1]
         x = self.bn_conv(x) 
@@ -58,6 +89,12 @@ class MappingNetwork_forTemporalFeature(nn.Module):
         out = self.transformer(prefix)[:, -self.prefix_length:]
         return out
 
+    def fuse_conv_bn(self):
+        # inference only : fold bn_conv (eval statistics) into conv
+        self.conv = fuse_conv_bn_eval(self.conv, self.bn_conv)
+        self.bn_conv = nn.Identity()
+        self.relu_conv.inplace = True
+
     def __init__(self, dim_embedding: int, prefix_length: int, clip_length: int, num_layers: int = 8, device = 'cuda:1', Dataset = 'AudioCaps'):
         super(MappingNetwork_forTemporalFeature, self).__init__()
         
@@ -104,6 +141,12 @@ class MappingNetwork_forGlobalFeature(nn.Module):
         out = self.transformer(prefix)[:, -self.prefix_length:]
         return out
 
+    def fuse_conv_bn(self):
+        # inference only : fold bn_conv (eval statistics) into conv
+        self.conv = fuse_conv_bn_eval(self.conv, self.bn_conv)
+        self.bn_conv = nn.Identity()
+        self.relu_conv.inplace = True
+
     def __init__(self, dim_embedding: int, prefix_length: int, clip_length: int, num_layers : int = 8, device = 'cuda:1', Dataset = 'AudioCaps'):
         super(MappingNetwork_forGlobalFeature, self).__init__()
 
@@ -125,15 +168,60 @@ class MappingNetwork_forGlobalFeature(nn.Module):
         print("global feature ver's mapping network : num_head =", num_head, "num_layers =", num_layers, "prefix_vector_length =", prefix_length)
 
 
+def nucleus_filtering_full_sort(logits, top_p, filter_value = -float("Inf")) :
+    # Top-p filtering with a sort of the whole vocabulary (each row : the best tokens until 'top_p' is exceeded)
+    sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+    cumulative_probs = torch.cumsum(nnf.softmax(sorted_logits, dim=-1), dim=-1)
+    
+    sorted_indices_to_remove = cumulative_probs > top_p
+    sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
+    sorted_indices_to_remove[..., 0] = False
+    
+    indices_to_remove = sorted_indices_to_remove.scatter(-1, sorted_indices, sorted_indices_to_remove)
+    
+    return logits.masked_fill(indices_to_remove, filter_value)
+
+
+def nucleus_filtering(logits, top_p, top_k = 64, filter_value = -float("Inf")) :
+    # Top-p filtering without sorting the whole vocabulary : 
+    # the candidates are the 'top_k' best tokens (partial top-k), their probabilities are still normalized 
+    # over the whole vocabulary, and the candidates after the cumulative cutoff 'top_p' are removed. 
+    # The best token is always kept. The result is the same as nucleus_filtering_full_sort : 
+    # rows whose 'top_k' best tokens do not exceed 'top_p' (flat distributions) are filtered with the full sort.
+    top_k = min(top_k, logits.size()[-1])
+    topk_logits, topk_indices = logits.topk(top_k, dim=-1) # sorted in descending order
+    
+    topk_probs = (topk_logits - torch.logsumexp(logits, dim=-1, keepdim=True)).exp()
+    cumulative_probs = torch.cumsum(topk_probs, dim=-1)
+    
+    # shift to the right so that the first token above the threshold is also kept
+    indices_to_remove = cumulative_probs > top_p
+    indices_to_remove[..., 1:] = indices_to_remove[..., :-1].clone()
+    indices_to_remove[..., 0] = False
+    
+    filtered_logits = torch.full_like(logits, filter_value)
+    filtered_logits.scatter_(-1, topk_indices, topk_logits.masked_fill(indices_to_remove, filter_value))
+    
+    # the nucleus goes beyond the 'top_k' best tokens
+    is_beyond_top_k = cumulative_probs[..., -1] <= top_p
+    if is_beyond_top_k.any() :
+        filtered_logits[is_beyond_top_k] = nucleus_filtering_full_sort(logits[is_beyond_top_k], top_p, filter_value)
+    
+    return filtered_logits
+
+
 class AAC_Prefix(nn.Module):
 
     def get_dummy_token(self, batch_size: int, device: torch.device) -> torch.Tensor:
         return torch.zeros(batch_size, (self.temporal_prefix_length + self.global_prefix_length), dtype=torch.int64, device=device)
     
-    def get_logits_for_inference(self, generated) :
+    def get_logits_from_hidden_states(self, out_hidden_states, last_position_only = False) :
+        
+        # Decoding only consumes the logits of the last position. 
+        # Projecting only that position avoids running every hidden state through the (768 x vocab) header.
+        if last_position_only == True :
+            out_hidden_states = out_hidden_states[:, -1:, :] # [batch_size, seq_len, 768] -> [batch_size, 1, 768]
         
-        out = self.gpt(inputs_embeds=generated)
-        out_hidden_states = out[0]
         logits = self.language_header(out_hidden_states)
 
         # The first word in own vocabulary is '!'. It is not used for creating sentence, just for padding.
@@ -147,8 +235,28 @@ class AAC_Prefix(nn.Module):
         
         return logits
     
-    def generate_beam(self, prefix_projections, beam_size = 5) :
+    def get_logits_for_inference(self, generated, last_position_only = True) :
+        
+        out = self.gpt(inputs_embeds=generated)
+        out_hidden_states = out[0]
         
+        return self.get_logits_from_hidden_states(out_hidden_states, last_position_only)
+    
+    def generate_beam_steps(self, prefix_projections, beam_size = 5, track_stable_tokens = False) :
+        
+        # All clips are decoded together as [num_active_clips, beam_size] beams. 
+        # GPT2's key/value states of the prefix are computed once per clip and shared by all its beams.
+        # A beam that produced the stop token joins the clip's pool of finished hypotheses : it keeps its place 
+        # and its score, and competes with the running beams of its clip at every step (the same search as 
+        # decoding each clip alone), but it is not decoded anymore : GPT2 and the language header only run 
+        # the running beams, so each clip has its own number of active beams. A clip is removed from the batch 
+        # (and from the key/value cache) as soon as all its beams have stopped.
+        #
+        # Generator : after every step, yields (stable_tokens_list, output_tokens_list) for all clips.
+        # output_tokens_list[clip] : the 'beam_size' best token lists of a finished clip (None while it is decoding)
+        # stable_tokens_list[clip] : tokens shared by every beam of the clip (running or stopped), 
+        #                            so they are the beginning of its best caption whatever the next steps are 
+        #                            (only computed with track_stable_tokens = True, the whole best caption once finished)
         entry_count = prefix_projections.size()[0]
         entry_length = 67
         temperature=1.0
@@ -158,134 +266,328 @@ class AAC_Prefix(nn.Module):
         else :
             stop_token_index = 13
         
-        output_texts_list = []
+        device = prefix_projections.device
+        
+        kv_cache = SharedPrefixKVCache(self.gpt, beam_size, entry_length)
+        out_hidden_states = kv_cache.encode_prefix(prefix_projections) # [entry_count, prefix_len, 768]
+        
+        scores = None
+        tokens = torch.zeros(entry_count, beam_size, entry_length, dtype=torch.int64, device=device) # written in place
+        seq_lengths = torch.ones(entry_count, beam_size, device=device)
+        is_stopped = torch.zeros(entry_count, beam_size, device=device, dtype=torch.bool)
         
-        for entry_idx in range(entry_count):
+        entry_idx_list = list(range(entry_count)) # clip index of each active row
+        output_tokens_list = [None] * entry_count
+        stable_tokens_list = [[] for _ in range(entry_count)]
+        
+        for i in range(entry_length):
+            
+            if i > 0 :
+                is_running = ~is_stopped
+                out_hidden_states = kv_cache.step(self.gpt.wte(tokens[:, :, i - 1][is_running]), is_running) # [num_running, 768]
+                out_hidden_states = out_hidden_states.unsqueeze(1)
+            logits = self.get_logits_from_hidden_states(out_hidden_states, last_position_only = True)
             
-            generated = prefix_projections[entry_idx,:,:].unsqueeze(0)
-            scores = None
-            tokens = None
-            seq_lengths = torch.ones(beam_size, device=self.device)
-            is_stopped = torch.zeros(beam_size, device=self.device, dtype=torch.bool)
+            active_count = is_stopped.size()[0]
+            active_idx = torch.arange(active_count, device=device).unsqueeze(1)
             
-            for i in range(entry_length):
+            logits = logits[:, -1, :] / (temperature)
+            logits = logits.softmax(-1).log()
+            if scores is None:
+                # all beams of a clip start from the same prefix, so only its 'beam_size' best first tokens are kept
+                scores, next_tokens = logits.topk(beam_size, -1) # [entry_count, beam_size]
+                tokens[:, :, 0] = next_tokens
+            else:
+                # a finished hypothesis has a single candidate : itself (padded with 0, same score and length)
+                scores_sum = torch.full((active_count, beam_size, logits.size()[-1]), -float(np.inf), device=device)
+                scores_sum[is_running] = scores[is_running][:, None] + logits
+                scores_sum[:, :, 0][is_stopped] = scores[is_stopped]
+                seq_lengths[~is_stopped] += 1
+                scores_sum_average = scores_sum / seq_lengths[:, :, None]
+                scores_sum_average, next_tokens = scores_sum_average.view(active_count, -1).topk(
+                    beam_size, -1
+                )
+                next_tokens_source = torch.div(next_tokens, scores_sum.shape[2], rounding_mode='floor')
+                seq_lengths = seq_lengths.gather(1, next_tokens_source)
+                next_tokens = next_tokens % scores_sum.shape[2]
                 
-                logits = self.get_logits_for_inference(generated)
+                tokens[:, :, :i] = tokens[active_idx, next_tokens_source, :i]
+                tokens[:, :, i] = next_tokens
+                kv_cache.reorder(next_tokens_source)
+                scores = scores_sum_average * seq_lengths
+                is_stopped = is_stopped.gather(1, next_tokens_source)
+            is_stopped = is_stopped + next_tokens.eq(stop_token_index)
+            del logits
+            
+            if track_stable_tokens == True :
+                # common prefix of the beams, a stopped beam only counts up to its length
+                position = torch.arange(i + 1, device=device)
+                is_common = tokens[:, :, :i + 1].eq(tokens[:, :1, :i + 1]) & (position < seq_lengths[:, :, None])
+                common_length_list = is_common.all(1).long().cumprod(1).sum(1).tolist()
+                for row, (best_tokens, common_length) in enumerate(zip(tokens[:, 0, :i + 1].tolist(), common_length_list)) :
+                    stable_tokens_list[entry_idx_list[row]] = best_tokens[:common_length]
+            
+            is_done = is_stopped.all(1)
+            if i == entry_length - 1 :
+                is_done[:] = True
+            
+            if is_done.any() :
+                order_list = (scores / seq_lengths).argsort(dim=1, descending=True)
+                for row in is_done.nonzero().squeeze(1).tolist() :
+                    output_tokens_list[entry_idx_list[row]] = [tokens[row, beam, :int(seq_lengths[row, beam])].tolist() 
+                                                               for beam in order_list[row].tolist()]
+                    stable_tokens_list[entry_idx_list[row]] = output_tokens_list[entry_idx_list[row]][0]
                 
-                logits = logits[:, -1, :] / (temperature)
-                logits = logits.softmax(-1).log()
-                if scores is None:
-                    scores, next_tokens = logits.topk(beam_size, -1)
-                    generated = generated.expand(beam_size, *generated.shape[1:])
-                    next_tokens, scores = next_tokens.permute(1, 0), scores.squeeze(0)
-                    if tokens is None:
-                        tokens = next_tokens
-                    else:
-                        tokens = tokens.expand(beam_size, *tokens.shape[1:])
-                        tokens = torch.cat((tokens, next_tokens), dim=1)
-                else:
-                    logits[is_stopped] = -float(np.inf)
-                    logits[is_stopped, 0] = 0
-                    scores_sum = scores[:, None] + logits
-                    seq_lengths[~is_stopped] += 1
-                    scores_sum_average = scores_sum / seq_lengths[:, None]
-                    scores_sum_average, next_tokens = scores_sum_average.view(-1).topk(
-                        beam_size, -1
-                    )
-                    next_tokens_source = torch.div(next_tokens, scores_sum.shape[1], rounding_mode='floor')
-#                     next_tokens_source = next_tokens // scores_sum.shape[1]
-                    seq_lengths = seq_lengths[next_tokens_source]
-                    next_tokens = next_tokens % scores_sum.shape[1]
-                    next_tokens = next_tokens.unsqueeze(1)
-                    tokens = tokens[next_tokens_source]
-                    tokens = torch.cat((tokens, next_tokens), dim=1)
-                    generated = generated[next_tokens_source]
-                    scores = scores_sum_average * seq_lengths
-                    is_stopped = is_stopped[next_tokens_source]
-                next_token_embed = self.gpt.wte(next_tokens.squeeze()).view(
-                    generated.shape[0], 1, -1
-                )
-                generated = torch.cat((generated, next_token_embed), dim=1)
-                is_stopped = is_stopped + next_tokens.eq(stop_token_index).squeeze()
-                del logits 
-                if is_stopped.all():
-                    del generated
+                keep_idx = (~is_done).nonzero().squeeze(1)
+                if keep_idx.numel() == 0 :
+                    del kv_cache
+                    yield stable_tokens_list, output_tokens_list
                     break
-            scores = scores / seq_lengths
-            output_list = tokens.cpu().numpy()
-            output_texts = [
-                self.tokenizer.decode(output[: int(length)])
-                for output, length in zip(output_list, seq_lengths)
-            ]
-            order = scores.argsort(descending=True)
-            output_texts = [output_texts[i] for i in order]
-
-            output_texts_list.append(output_texts)
+                
+                scores, tokens = scores[keep_idx], tokens[keep_idx]
+                seq_lengths, is_stopped = seq_lengths[keep_idx], is_stopped[keep_idx]
+                entry_idx_list = [entry_idx_list[row] for row in keep_idx.tolist()]
+                kv_cache.select_clips(keep_idx)
+            
+            yield stable_tokens_list, output_tokens_list
+    
+    def generate_beam(self, prefix_projections, beam_size = 5) :
+        
+        for _, output_tokens_list in self.generate_beam_steps(prefix_projections, beam_size) :
+            pass
+        
+        output_texts_list = [[self.tokenizer.decode(output) for output in outputs] for outputs in output_tokens_list]
         
         return output_texts_list
 
-    def generate(self, prefix_projections) :
+    def generate_steps(self, prefix_projections, do_sample = False) :
+        
+        # All clips are decoded together. Finished rows keep running (their tokens are dropped when decoding)
+        # so the loop never needs to read a token back to the host.
+        #
+        # Generator : after every step i, yields (i, tokens) where tokens[:, i] holds the new token of each clip
+        # (tokens is [entry_count, entry_length], written in place, rows that already stopped repeat the stop token)
         temperature = 1.0
         entry_length = 67
         top_p = 0.8
+        stop_check_interval = 4 # steps between checks whether every row has finished
         
         if self.vocab_size == None :
             stop_token_index = self.tokenizer.encode(".")[0]
         else :
             stop_token_index = 13
-            
-        filter_value = -float("Inf")
-        generated_list = []
         
         entry_count = prefix_projections.size()[0]
+        device = prefix_projections.device
+        
+        # the compiled fixed-shape step (see compile_decode_step) is used when it was built for this batch
+        use_static_decoder = self.static_decoder != None and self.static_decoder.is_compatible(prefix_projections)
+        
+        if use_static_decoder == True :
+            logits = self.static_decoder.prefill(prefix_projections) # [entry_count, vocab_size]
+        else :
+            kv_cache = SharedPrefixKVCache(self.gpt, 1, entry_length) # greedy decoding : one beam per clip
+            out_hidden_states = kv_cache.encode_prefix(prefix_projections) # [entry_count, prefix_len, 768]
         
+        tokens = torch.zeros(entry_count, entry_length, dtype=torch.int64, device=device) # written in place
+        is_stopped = torch.zeros(entry_count, device=device, dtype=torch.bool)
         
-        for entry_idx in range(entry_count):
+        for i in range(entry_length):
+            
+            if use_static_decoder == True :
+                if i > 0 :
+                    logits = self.static_decoder.step(tokens[:, i - 1], i - 1)
+            else :
+                if i > 0 :
+                    out_hidden_states = kv_cache.step(self.gpt.wte(tokens[:, i - 1 : i])) # [entry_count, 1, 768]
+                logits = self.get_logits_from_hidden_states(out_hidden_states, last_position_only = True)[:, -1, :]
 
-            generated = prefix_projections[entry_idx]
+            logits = logits / (temperature)
+            logits = nucleus_filtering(logits, top_p)
             
-            tokens = None 
+            if do_sample == True :
+                next_token = torch.multinomial(logits.softmax(-1), num_samples=1)
+            else :
+                next_token = torch.argmax(logits, -1).unsqueeze(1)
             
-            for i in range(entry_length):
-                
-                logits = self.get_logits_for_inference(generated)
-
-                logits = logits[:, -1, :] / (temperature)
-                sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-                cumulative_probs = torch.cumsum(
-                            nnf.softmax(sorted_logits, dim=-1), dim=-1
-                        )
-                sorted_indices_to_remove = cumulative_probs > top_p
-                sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[
-                            ..., :-1
-                        ].clone()
-                sorted_indices_to_remove[..., 0] = 0
-
-                indices_to_remove = sorted_indices[sorted_indices_to_remove]
-                logits[:, indices_to_remove] = filter_value
-                next_token = torch.argmax(logits, -1).unsqueeze(0)
-                next_token_embed = self.gpt.wte(next_token)
-                
-                if tokens is None:
-                    tokens = next_token
-                else:
-                    tokens = torch.cat((tokens, next_token), dim=1)
-                generated = torch.cat((generated, next_token_embed), dim=1)
-                if stop_token_index == next_token.item():
-                    break
-
-            output_list = list(tokens.squeeze().cpu().numpy())
+            # rows that already produced the stop token just repeat it
+            next_token = next_token.masked_fill(is_stopped.unsqueeze(1), stop_token_index)
+            
+            tokens[:, i] = next_token.squeeze(1)
+            is_stopped = is_stopped + next_token.squeeze(1).eq(stop_token_index)
+            
+            yield i, tokens
+            
+            if (i + 1) % stop_check_interval == 0 and is_stopped.all() :
+                break
+    
+    def generate(self, prefix_projections, do_sample = False) :
+        
+        if self.vocab_size == None :
+            stop_token_index = self.tokenizer.encode(".")[0]
+        else :
+            stop_token_index = 13
+        
+        for i, tokens in self.generate_steps(prefix_projections, do_sample) :
+            pass
+        
+        generated_list = []
+        
+        for output in tokens[:, :i + 1].cpu().numpy() :
+            output_list = list(output)
+            if stop_token_index in output_list :
+                output_list = output_list[:output_list.index(stop_token_index) + 1]
             output_text = self.tokenizer.decode(output_list)
             generated_list.append(output_text)
         return generated_list 
 
-    def forward(self, audio, tokens = None, mask = None, labels = None, beam_search = False):
+    @torch.no_grad()
+    def generate_stream(self, audio, beam_search = False, beam_size = 5, do_sample = False, audio_lengths = None) :
+        # Streaming version of forward() in eval mode : after every decoding step, yields a list (one per clip) of 
+        # the token ids decided at this step (empty if none), so a caption can be shown while it is generated.
+        # greedy / sampling : the new token of every clip that has not stopped yet (the stop token is the last one)
+        # beam search       : the new tokens of the stable prefix (shared by every running and stopped beam), 
+        #                     then the rest of the best caption when the clip finishes
+        # The concatenated ids of a clip are the caption of forward(), model.tokenizer.decode() gives its text.
+        
+        prefix_vectors = self.get_prefix_vectors(audio, audio_lengths)
+        entry_count = prefix_vectors.size()[0]
+        
+        if beam_search == True :
+            emitted_length_list = [0] * entry_count
+            
+            for stable_tokens_list, _ in self.generate_beam_steps(prefix_vectors, beam_size, track_stable_tokens = True) :
+                new_tokens_list = [stable_tokens[emitted_length:] 
+                                   for stable_tokens, emitted_length in zip(stable_tokens_list, emitted_length_list)]
+                emitted_length_list = [len(stable_tokens) for stable_tokens in stable_tokens_list]
+                yield new_tokens_list
+        else :
+            if self.vocab_size == None :
+                stop_token_index = self.tokenizer.encode(".")[0]
+            else :
+                stop_token_index = 13
+            
+            is_stopped_list = [False] * entry_count
+            
+            for i, tokens in self.generate_steps(prefix_vectors, do_sample) :
+                next_token_list = tokens[:, i].tolist()
+                new_tokens_list = [[] if is_stopped else [next_token] 
+                                   for next_token, is_stopped in zip(next_token_list, is_stopped_list)]
+                is_stopped_list = [is_stopped or next_token == stop_token_index 
+                                   for next_token, is_stopped in zip(next_token_list, is_stopped_list)]
+                yield new_tokens_list
+                
+                if all(is_stopped_list) :
+                    break
+
+    def compile_decode_step(self, batch_size = 1, backend = 'torchscript', 
+                            cache_dir = './AAC_Prefix/compiled_decode_step', warmup_steps = 3) :
+        # Build (or load from 'cache_dir') a compiled fixed-shape decoding step that generate() uses 
+        # for batches of 'batch_size' clips. backend = 'torchscript', 'inductor' or None (eager).
+        entry_length = 67
+        
+        prefix_length = self.temporal_prefix_length + self.global_prefix_length
+        if prefix_length == 0 :
+            prefix_length = 26
+        
+        self.eval()
+        self.static_decoder = StaticDecoder(self.gpt, self.language_header, self.vocab_size != None, 
+                                            batch_size, prefix_length, entry_length, self.device)
+        self.static_decoder.compile(backend, cache_dir, warmup_steps)
+        
+        return self.static_decoder
+
+    def set_checkpointing_policy(self, policy) :
+        # Activation checkpointing for training : the activations of the selected parts are recomputed in backward 
+        # instead of stored, which trades compute for memory (see report_checkpointing_memory in Train.py).
+        # policy : list of 'encoder' (ConvBlocks of Cnn14), 'mapping' (TransformerLayers of the mapping networks), 
+        #          'gpt2' (GPT2 blocks), or 'all', or None / [] (no checkpointing)
+        if policy == None :
+            policy = []
+        elif policy == 'all' :
+            policy = ['encoder', 'mapping', 'gpt2']
+        
+        for part in policy :
+            if part not in ['encoder', 'mapping', 'gpt2'] :
+                raise Exception('Incorrect argument!')
+        
+        if isinstance(self.audio_encoder, Cnn14) :
+            self.audio_encoder.set_checkpointing('encoder' in policy)
+        
+        for mappingnetwork in [self.temporal_mappingnetwork, self.global_mappingnetwork] :
+            if isinstance(mappingnetwork, (MappingNetwork_forTemporalFeature, MappingNetwork_forGlobalFeature)) :
+                mappingnetwork.transformer.use_checkpoint = 'mapping' in policy
+        
+        if 'gpt2' in policy :
+            self.gpt.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant" : False})
+        else :
+            self.gpt.gradient_checkpointing_disable()
+        
+        print("checkpointing policy :", policy)
+
+    def optimize_for_inference(self, channels_last = True) :
+        # Folds the BatchNorms of the audio encoder (Cnn14) and of the mapping networks into their convs 
+        # and runs Cnn14's conv stack in channels-last (see Cnn14.optimize_for_inference).
+        # Inference only : the model must not be trained or saved as a training checkpoint afterwards.
+        self.eval()
         
-        temporal_feature, global_feature = self.audio_encoder(audio)
+        if isinstance(self.audio_encoder, Cnn14) :
+            self.audio_encoder.optimize_for_inference(channels_last)
+        
+        for mappingnetwork in [self.temporal_mappingnetwork, self.global_mappingnetwork] :
+            if isinstance(mappingnetwork, (MappingNetwork_forTemporalFeature, MappingNetwork_forGlobalFeature)) :
+                mappingnetwork.fuse_conv_bn()
+        
+        return self
+
+    def quantize_decoder(self) :
+        # Int8 dynamic quantization of GPT2 and the language header for CPU inference : int8 weights, 
+        # activations quantized at run time. GPT2's Conv1D layers become nn.Linear first (quantize_dynamic only 
+        # handles nn.Linear), the embeddings and layer norms stay in float32.
+        # Inference only : trained parameters must be loaded before (see get_AAC_Prefix's params_path).
+        if torch.device(self.device).type != 'cpu' :
+            raise Exception('int8 dynamic quantization runs on CPU only!')
+        
+        self.eval()
+        
+        for module in list(self.gpt.modules()) :
+            for name, child in list(module.named_children()) :
+                if isinstance(child, Conv1D) : # y = x @ weight + bias, weight : [in_features, out_features]
+                    linear = nn.Linear(child.weight.size()[0], child.nf)
+                    linear.weight.data = child.weight.data.t().contiguous()
+                    linear.bias.data = child.bias.data
+                    setattr(module, name, linear)
+        
+        quantize_dynamic(self.gpt, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        
+        header_container = nn.ModuleDict({'language_header' : self.language_header}) # quantize_dynamic swaps children
+        quantize_dynamic(header_container, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        self.language_header = header_container['language_header']
+        
+        self.static_decoder = None # compiled for the float32 decoder
+        self.is_decoder_quantized = True
+        
+        print("int8 dynamic quantization : GPT2, language header")
+        
+        return self
+
+    def get_prefix_vectors(self, audio, audio_lengths = None) :
+        # audio_lengths : [batch_size] number of samples of each clip if 'audio' is a zero-padded variable-length batch
+        
+        frame_mask = None
+        
+        if isinstance(audio, (list, tuple)) : # (temporal_feature, global_feature) from the feature cache (FeatureCache.py)
+            temporal_feature, global_feature = audio
+        elif audio_lengths is not None :
+            temporal_feature, global_feature, frame_mask = self.audio_encoder(audio, lengths = audio_lengths)
+        else :
+            temporal_feature, global_feature = self.audio_encoder(audio)
         
         if self.temporal_prefix_length > 0 :
-            temporal_prefix_vector = self.temporal_mappingnetwork(temporal_feature).view(-1, self.temporal_prefix_length, self.gpt_embedding_size)
+            temporal_prefix_vector = self.temporal_mappingnetwork(temporal_feature, frame_mask).view(-1, self.temporal_prefix_length, self.gpt_embedding_size)
         elif self.global_prefix_length + self.temporal_prefix_length == 0  :
+            if frame_mask is not None :
+                temporal_feature = masked_adaptive_avg_pool(temporal_feature, frame_mask, num_temporal_tokens)
             temporal_feature = temporal_feature.permute(0,2,1,3).contiguous()
             temporal_feature = torch.reshape(temporal_feature, (temporal_feature.size()[0], temporal_feature.size()[1], -1))  
             temporal_prefix_vector = self.temporal_mappingnetwork(temporal_feature)
@@ -301,8 +603,13 @@ class AAC_Prefix(nn.Module):
         elif self.temporal_prefix_length == 0 and self.global_prefix_length > 0 :
             prefix_vectors = global_prefix_vector
         else :
-            prefix_vectors = torch.cat((temporal_prefix_vector, global_prefix_vector), dim=1) 
-            
+            prefix_vectors = torch.cat((temporal_prefix_vector, global_prefix_vector), dim=1)
+        
+        return prefix_vectors
+
+    def forward(self, audio, tokens = None, mask = None, labels = None, beam_search = False, draft_decoder = None, audio_lengths = None):
+        
+        prefix_vectors = self.get_prefix_vectors(audio, audio_lengths)
            
         if self.training :
             embedding_text = self.gpt.wte(tokens.to(self.device))
@@ -324,6 +631,8 @@ class AAC_Prefix(nn.Module):
         else :
             if beam_search == True :
                 return self.generate_beam(prefix_vectors)
+            elif draft_decoder != None :
+                return generate_speculative(self, draft_decoder, prefix_vectors)
             else :   
                 return self.generate(prefix_vectors)
             
@@ -375,6 +684,8 @@ class AAC_Prefix(nn.Module):
             nn.init.kaiming_uniform_(self.global_mappingnetwork.weight)  
         
         self.language_header = None
+        self.static_decoder = None # built by compile_decode_step()
+        self.is_decoder_quantized = False # set by quantize_decoder()
         
         if vocab_size == None : # If we do not use own vocaburaly
             self.language_header = nn.Linear(768, 50257, bias=False) # 50257 : original vocabulary size of GPT2
@@ -448,12 +759,19 @@ def get_AAC_Prefix(tokenizer,
                     vocab_size = None, Dataset = 'AudioCaps',
                     prefix_size_dict = {"temporal_prefix_size" : 10, "global_prefix_size" : 10}, 
                     transformer_num_layers = None, encoder_freeze = True, decoder_freeze = True, 
-                    pretrain_fromAudioCaps = False, device = 'cuda:1') :
+                    pretrain_fromAudioCaps = False, device = 'cuda:1', 
+                    params_path = None, quantize_decoder = False, student_encoder_params_path = None, 
+                    frontend = 'torchlibrosa') :
+    # params_path      : trained parameters of the whole model, loaded before the quantization
+    # quantize_decoder : int8 dynamic quantization of GPT2 and the language header (CPU inference only)
+    # student_encoder_params_path : distilled slim Cnn14 (Train_StudentEncoder in Train.py) as the audio encoder
+    # frontend         : spectrogram of the audio encoder, 'torchlibrosa' (conv1d STFT) or 'fft' (torch.stft, faster), 
+    #                    the weights are the same
     
     # PANNS
     audio_encoder = Cnn14(sample_rate=16000, window_size=512, 
                 hop_size=320, mel_bins=64, fmin=50, fmax=14000, 
-                classes_num=527)
+                classes_num=527, frontend=frontend)
     
     folder_name = None
 
@@ -469,7 +787,9 @@ def get_AAC_Prefix(tokenizer,
     if vocab_size != None and folder_name != None :
         vocab_size_only_clotho = vocab_size - 7911
     
-    if pretrain_fromAudioCaps == False :
+    if student_encoder_params_path != None :
+        audio_encoder = get_student_encoder(student_encoder_params_path, frontend=frontend)
+    elif pretrain_fromAudioCaps == False :
         checkpoint_path = "./AAC_Prefix/PANNs/Cnn14_16k_mAP=0.438.pth"
         checkpoint = torch.load(checkpoint_path, map_location=device)
         audio_encoder.load_state_dict(checkpoint['model'])
@@ -492,10 +812,23 @@ def get_AAC_Prefix(tokenizer,
                         temporal_num_layers = temporal_num_layers, global_num_layers = global_num_layers, 
                         pretrain_fromAudioCaps = pretrain_fromAudioCaps, device = device)
     
+    if params_path != None :
+        state_dict = torch.load(params_path, map_location = device)
+        if student_encoder_params_path != None : # the student replaces the trained model's encoder
+            state_dict = {key : value for key, value in state_dict.items() if not key.startswith('audio_encoder.')}
+            state_dict.update({'audio_encoder.' + key : value for key, value in audio_encoder.state_dict().items()})
+        model.load_state_dict(state_dict)
+    
+    if quantize_decoder == True :
+        model.quantize_decoder()
+    
     return model.to(device)
 
 
-def get_model_in_table(table_num, setting_num, device) :
+def get_model_in_table(table_num, setting_num, device, quantize_decoder = False, student_encoder_params_path = None, frontend = 'torchlibrosa') :
+    # quantize_decoder : int8 dynamic quantization of GPT2 and the language header (device must be the CPU)
+    # student_encoder_params_path : distilled encoder of the model (Distill_Encoder.py) instead of its Cnn14
+    # frontend : see get_AAC_Prefix
     transformer_num_layers = {"temporal_num_layers" : 4, "global_num_layers" : 4}
     prefix_size_dict = {"temporal_prefix_size" : 15, "global_prefix_size" : 11}
     
@@ -513,19 +846,17 @@ def get_model_in_table(table_num, setting_num, device) :
         tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
         vocab_size = None
     
-    model = get_AAC_Prefix(tokenizer, 
-                        vocab_size = vocab_size, Dataset = Dataset,
-                        prefix_size_dict = prefix_size_dict, transformer_num_layers = transformer_num_layers, 
-                        encoder_freeze = True, decoder_freeze = True,
-                        pretrain_fromAudioCaps = False, device = device)
-    
     if setting_num != 3 :
         model_path = 'Params_in_Table/Table' + str(table_num) + '_' + str(setting_num) + '_params.pt'
     else :
         model_path = 'Params_in_Table/Params_Overall_Dataset.pt'
     
-    params = torch.load(model_path, map_location = device)
-    
-    model.load_state_dict(params) 
+    model = get_AAC_Prefix(tokenizer, 
+                        vocab_size = vocab_size, Dataset = Dataset,
+                        prefix_size_dict = prefix_size_dict, transformer_num_layers = transformer_num_layers, 
+                        encoder_freeze = True, decoder_freeze = True,
+                        pretrain_fromAudioCaps = False, device = device, 
+                        params_path = model_path, quantize_decoder = quantize_decoder, 
+                        student_encoder_params_path = student_encoder_params_path, frontend = frontend)
     
     return model
\ No newline at end of file
@@ -0,0 +1,136 @@
+import copy
+
+import torch
+import torch.nn as nn
+from torch.nn import functional as nnf
+from transformers import GPT2Config, GPT2Model
+
+# Speculative decoding for AAC_Prefix.
+#
+# A small draft decoder (a few GPT2 blocks) proposes several tokens cheaply, and the frozen GPT2 + language header
+# of AAC_Prefix verifies all of them in one forward pass. With greedy decoding, a proposal is accepted only if it is
+# the token GPT2 itself would choose, so the caption is the same as AAC_Prefix.generate.
+
+class DraftDecoder(nn.Module):
+
+    def get_logits(self, model, hidden_states) :
+        # the draft shares the language header of 'model' (not trained by the distillation)
+        header = model.language_header
+        if model.is_decoder_quantized == True : # int8 header (inference only)
+            logits = header(hidden_states)
+        else :
+            logits = nnf.linear(hidden_states, header.weight.detach(),
+                                header.bias.detach() if header.bias is not None else None)
+
+        if model.vocab_size != None :
+            logits[:,:,0] = 0.0 # '!' is not used
+
+        return logits
+
+    def forward(self, inputs_embeds, past_key_values = None, attention_mask = None, use_cache = False) :
+        # inputs_embeds : [batch_size, seq_len, 768], prefix vectors and/or token embeddings of GPT2's wte
+        return self.gpt(inputs_embeds=inputs_embeds, past_key_values=past_key_values,
+                        attention_mask=attention_mask, use_cache=use_cache)
+
+    def __init__(self, gpt, num_layers = 2) :
+        super(DraftDecoder, self).__init__()
+
+        # token embeddings come from the main GPT2 (shared wte), so the draft's own table is a dummy of size 1
+        config = copy.deepcopy(gpt.config)
+        config.n_layer = num_layers
+        config.vocab_size = 1
+
+        self.gpt = GPT2Model(config)
+
+        # initialize from the first 'num_layers' blocks of the main GPT2
+        self.gpt.wpe.load_state_dict(gpt.wpe.state_dict())
+        for layer_idx in range(num_layers) :
+            self.gpt.h[layer_idx].load_state_dict(gpt.h[layer_idx].state_dict())
+        self.gpt.ln_f.load_state_dict(gpt.ln_f.state_dict())
+
+        print("draft decoder : num_layers =", num_layers)
+
+
+def get_draft_decoder(model, num_layers = 2, params_path = None) :
+
+    draft_decoder = DraftDecoder(model.gpt, num_layers)
+
+    if params_path != None :
+        draft_decoder.load_state_dict(torch.load(params_path, map_location = model.device))
+
+    return draft_decoder.to(model.device)
+
+
+def crop_past_key_values(past_key_values, length) :
+    # keep the first 'length' positions of GPT2's key/value cache
+    return tuple(
+        tuple(past_state[:, :, :length] for past_state in layer_past)
+        for layer_past in past_key_values
+    )
+
+
+def generate_speculative(model, draft_decoder, prefix_projections, num_draft_tokens = 4) :
+    # Greedy decoding of AAC_Prefix (same captions as AAC_Prefix.generate), one clip at a time.
+    entry_length = 67
+
+    if model.vocab_size == None :
+        stop_token_index = model.tokenizer.encode(".")[0]
+    else :
+        stop_token_index = 13
+
+    device = prefix_projections.device
+    prefix_len = prefix_projections.size()[1]
+
+    generated_list = []
+
+    for entry_idx in range(prefix_projections.size()[0]) :
+
+        prefix = prefix_projections[entry_idx].unsqueeze(0)
+
+        out = model.gpt(inputs_embeds=prefix, use_cache=True)
+        target_past_key_values = out.past_key_values
+        tokens = [model.get_logits_from_hidden_states(out[0], last_position_only = True)[0, -1].argmax().item()]
+
+        draft_past_key_values = draft_decoder(prefix, use_cache=True).past_key_values
+
+        # GPT2 has seen every token except the last one. The draft may lag further behind after a rejection.
+        while tokens[-1] != stop_token_index and len(tokens) < entry_length :
+
+            # draft : catch up on the tokens it has not seen, then propose greedily
+            draft_seen = draft_past_key_values[0][0].size()[2] - prefix_len
+            draft_input = model.gpt.wte(torch.tensor(tokens[draft_seen:], device=device)).unsqueeze(0)
+
+            proposals = []
+            for _ in range(min(num_draft_tokens, entry_length - len(tokens))) :
+                out = draft_decoder(draft_input, draft_past_key_values, use_cache=True)
+                draft_past_key_values = out.past_key_values
+                proposal = draft_decoder.get_logits(model, out[0][:, -1:])[0, -1].argmax()
+
+                proposals.append(proposal)
+                if proposal.item() == stop_token_index :
+                    break
+                draft_input = model.gpt.wte(proposal).view(1, 1, -1)
+            proposals = torch.stack(proposals)
+
+            # GPT2 : the last token and all proposals in one pass
+            target_input = torch.cat((torch.tensor(tokens[-1:], device=device), proposals))
+            out = model.gpt(inputs_embeds=model.gpt.wte(target_input).unsqueeze(0),
+                            past_key_values=target_past_key_values, use_cache=True)
+            target_tokens = model.get_logits_from_hidden_states(out[0])[0].argmax(-1) # [num_proposals + 1]
+
+            # accept the proposals up to the first disagreement, then take GPT2's own token at that position
+            num_accepted = int(target_tokens[:-1].eq(proposals).long().cumprod(0).sum().item())
+            new_tokens = target_tokens[:num_accepted + 1].tolist()
+
+            if stop_token_index in new_tokens :
+                new_tokens = new_tokens[:new_tokens.index(stop_token_index) + 1]
+            tokens = (tokens + new_tokens)[:entry_length]
+
+            seen = prefix_len + len(tokens) - 1
+            target_past_key_values = crop_past_key_values(out.past_key_values, seen)
+            draft_past_key_values = crop_past_key_values(draft_past_key_values,
+                                                         min(seen, draft_past_key_values[0][0].size()[2]))
+
+        generated_list.append(model.tokenizer.decode(tokens))
+
+    return generated_list
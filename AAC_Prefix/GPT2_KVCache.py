@@ -0,0 +1,165 @@
+import torch
+from torch.nn import functional as nnf
+
+# Key/value cache of GPT2 for decoding (beam search, or greedy with beam_size = 1), 
+# where the audio prefix is stored once per clip.
+#
+# The prefix is the same for every beam of a clip, so its key/value states are computed once and
+# every beam attends to them by broadcasting. Only the key/value states of the generated tokens (suffix)
+# are kept per beam, and only these are gathered when the beams are reordered.
+# The suffix is stored in buffers allocated once for 'max_length' tokens and written in place, 
+# so a decoding step does not reallocate and copy the whole cache.
+# A step can decode only some of the beams (e.g. beam search skips the finished ones) : the linear layers run 
+# on these beams only, and the other beams keep their slot (and stale key/value states) in the buffers.
+#
+# prefix_keys[layer], prefix_values[layer] : [num_clips, num_head, prefix_len, head_dim]
+# suffix_keys[layer], suffix_values[layer] : [num_clips, beam_size, num_head, max_length, head_dim] 
+#                                            (only the first 'suffix_len' positions are filled)
+
+def check_gpt2_attention(gpt) :
+    # The decoding steps (SharedPrefixKVCache, StaticDecodeStep.DecodeStep) run GPT2's attention from the modules and
+    # flags of GPT2Attention in transformers 4.38 (requirements.txt) instead of through past_key_values.
+    # Fail here instead of decoding silently wrong captions with a GPT2 they do not support.
+    attn = gpt.h[0].attn
+
+    for name in ['c_attn', 'c_proj', 'split_size', 'num_heads', 'head_dim', 'attn_dropout', 'resid_dropout', 
+                 'scale_attn_weights', 'scale_attn_by_inverse_layer_idx'] :
+        if hasattr(attn, name) == False :
+            raise Exception('GPT2Attention has no ' + name + ' : unsupported transformers version (see requirements.txt)')
+
+    # upcast / reordered attention, cross-attention and pruned heads are not implemented (head_mask is never passed)
+    if gpt.config.reorder_and_upcast_attn == True or gpt.config.add_cross_attention == True :
+        raise Exception('Unsupported GPT2 config : reorder_and_upcast_attn / add_cross_attention')
+    if any(len(block.attn.pruned_heads) > 0 for block in gpt.h) :
+        raise Exception('Unsupported GPT2 : pruned attention heads')
+
+
+class SharedPrefixKVCache() :
+
+    def encode_prefix(self, prefix_embeds) :
+        # prefix_embeds : [num_clips, prefix_len, 768]
+        # return : last hidden states of the prefix, [num_clips, prefix_len, 768]
+
+        out = self.gpt(inputs_embeds=prefix_embeds, use_cache=True)
+
+        self.num_clips, self.prefix_len = prefix_embeds.size()[0], prefix_embeds.size()[1]
+        self.prefix_keys = [layer_past[0] for layer_past in out.past_key_values]
+        self.prefix_values = [layer_past[1] for layer_past in out.past_key_values]
+
+        suffix_size = (self.num_clips, self.beam_size, self.num_head, self.max_length, self.head_dim)
+        self.suffix_keys = [prefix_embeds.new_zeros(suffix_size) for _ in range(self.num_layers)]
+        self.suffix_values = [prefix_embeds.new_zeros(suffix_size) for _ in range(self.num_layers)]
+        self.suffix_len = 0
+
+        return out[0]
+
+    def attention(self, layer_idx, attn, query, key, value, is_active) :
+        # query, key, value : [num_active, num_head, head_dim] of the new token of the active beams
+        # is_active : [num_clips, beam_size], True on the active beams
+
+        self.suffix_keys[layer_idx][:, :, :, self.suffix_len][is_active] = key
+        self.suffix_values[layer_idx][:, :, :, self.suffix_len][is_active] = value
+        suffix_keys = self.suffix_keys[layer_idx][:, :, :, :self.suffix_len + 1]
+        suffix_values = self.suffix_values[layer_idx][:, :, :, :self.suffix_len + 1]
+
+        prefix_keys, prefix_values = self.prefix_keys[layer_idx], self.prefix_values[layer_idx]
+
+        # the attention runs on the [num_clips, beam_size] layout (inactive beams : zero query, output dropped),
+        # it is small next to the linear layers, which only run the active beams
+        query = query.new_zeros(*is_active.size(), *query.size()[1:]).index_put_((is_active,), query)
+
+        # scores against the shared prefix : the prefix of clip 'b' is broadcast over its beams 'k'
+        prefix_scores = torch.einsum('bkhd,bhpd->bkhp', query, prefix_keys)
+        suffix_scores = torch.einsum('bkhd,bkhtd->bkht', query, suffix_keys)
+        attn_weights = torch.cat((prefix_scores, suffix_scores), dim=3)
+
+        if attn.scale_attn_weights :
+            attn_weights = attn_weights / (value.size()[-1] ** 0.5)
+        if attn.scale_attn_by_inverse_layer_idx :
+            attn_weights = attn_weights / float(layer_idx + 1)
+
+        # the new token attends to every previous position, so no causal mask is needed
+        attn_weights = nnf.softmax(attn_weights, dim=-1).type(value.dtype)
+        attn_weights = attn.attn_dropout(attn_weights)
+
+        attn_output = torch.einsum('bkhp,bhpd->bkhd', attn_weights[..., :self.prefix_len], prefix_values) + \
+                      torch.einsum('bkht,bkhtd->bkhd', attn_weights[..., self.prefix_len:], suffix_values)
+
+        return attn_output[is_active]
+
+    def step(self, token_embeds, is_active = None) :
+        # token_embeds : [num_clips, beam_size, 768], embedding of the last generated token of each beam, 
+        #                or [num_active, 768] with is_active ([num_clips, beam_size] bool) : only the beams where 
+        #                is_active is True are decoded (e.g. not the finished ones), each clip has its own number of them.
+        #                Their key/value states are written, those of the other beams are left as they are.
+        # return : last hidden state of each beam, [num_clips, beam_size, 768] (with is_active : [num_active, 768])
+        output_size = None
+        if is_active is None :
+            output_size = token_embeds.size()
+            is_active = torch.ones(output_size[:2], dtype=torch.bool, device=token_embeds.device)
+            token_embeds = token_embeds.reshape(-1, output_size[-1])
+
+        position = self.prefix_len + self.suffix_len
+        position_ids = torch.full((1,), position, dtype=torch.int64, device=token_embeds.device)
+        hidden_states = self.gpt.drop(token_embeds + self.gpt.wpe(position_ids)) # [num_active, 768]
+
+        for layer_idx, block in enumerate(self.gpt.h) :
+            attn = block.attn
+
+            residual = hidden_states
+            hidden_states = block.ln_1(hidden_states)
+
+            query, key, value = attn.c_attn(hidden_states).split(attn.split_size, dim=1)
+            query, key, value = [x.view(-1, self.num_head, self.head_dim) for x in (query, key, value)]
+
+            attn_output = self.attention(layer_idx, attn, query, key, value, is_active)
+            attn_output = attn_output.reshape(attn_output.size()[0], -1)
+            attn_output = attn.resid_dropout(attn.c_proj(attn_output))
+            hidden_states = residual + attn_output
+
+            residual = hidden_states
+            hidden_states = block.ln_2(hidden_states)
+            hidden_states = residual + block.mlp(hidden_states)
+
+        self.suffix_len += 1
+
+        hidden_states = self.gpt.ln_f(hidden_states)
+
+        if output_size is not None :
+            return hidden_states.view(output_size)
+        return hidden_states
+
+    def reorder(self, beam_source) :
+        # beam_source : [num_clips, beam_size], index (inside its clip) of the beam each new beam comes from
+        # only the filled part of the per-beam suffix is gathered, the shared prefix is untouched
+        clip_idx = torch.arange(self.num_clips, device=beam_source.device).unsqueeze(1)
+
+        for suffix in self.suffix_keys + self.suffix_values :
+            suffix[:, :, :, :self.suffix_len] = suffix[clip_idx, beam_source, :, :self.suffix_len]
+
+    def select_clips(self, clip_idx) :
+        # keep only the clips in 'clip_idx' (e.g. drop the clips whose decoding is finished)
+        self.num_clips = clip_idx.size()[0]
+
+        self.prefix_keys = [prefix[clip_idx] for prefix in self.prefix_keys]
+        self.prefix_values = [prefix[clip_idx] for prefix in self.prefix_values]
+        self.suffix_keys = [suffix[clip_idx] for suffix in self.suffix_keys]
+        self.suffix_values = [suffix[clip_idx] for suffix in self.suffix_values]
+
+    def __init__(self, gpt, beam_size, max_length) :
+
+        check_gpt2_attention(gpt)
+
+        self.gpt = gpt
+        self.beam_size = beam_size
+        self.max_length = max_length # maximum number of generated tokens
+
+        self.num_layers = len(gpt.h)
+        self.num_head = gpt.h[0].attn.num_heads
+        self.head_dim = gpt.h[0].attn.head_dim
+
+        self.num_clips = 0
+        self.prefix_len = 0
+        self.suffix_len = 0
+        self.prefix_keys, self.prefix_values = [], []
+        self.suffix_keys, self.suffix_values = [], []
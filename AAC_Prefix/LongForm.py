@@ -0,0 +1,183 @@
+import torch
+import torchaudio
+
+# Long-form captioning : captions a recording of any length window by window, with timestamps.
+#
+# The recording is read in chunks and every part of it goes through Cnn14 once :
+#   - each log-mel frame is computed once, from the samples of a chunk plus the context its STFT window needs,
+#   - the conv blocks run on segments of log-mel frames with a halo of 'halo_columns' on each side, so the temporal
+#     feature columns of a segment are the ones Cnn14 gives on the whole recording.
+# A column of the temporal feature covers 32 log-mel frames (5 poolings of 2) = 0.64s. A 10s window is 15 columns
+# (30s : 46 columns, as for a clip of the datasets). Windows start every 'hop' columns and reuse the columns of
+# the overlap instead of re-encoding it, then the mapping networks and GPT2 caption a batch of windows at a time.
+# Memory is bounded by a chunk, a segment and a batch of windows, and the time is linear in the recording's length.
+# Unlike a clip encoded alone, the columns at the edges of a window see the neighbouring audio instead of zero padding.
+
+frames_per_column = 32 # temporal stride of Cnn14's conv blocks
+
+
+def iterate_audio_chunks(audio_file_path, chunk_sec = 60, sample_rate = 16000) :
+    # first channel of the file, 'chunk_sec' seconds at a time (the whole file is never loaded)
+    num_samples = torchaudio.info(audio_file_path).num_frames
+    chunk_len = int(chunk_sec * sample_rate)
+
+    for frame_offset in range(0, num_samples, chunk_len) :
+        audio, _ = torchaudio.load(audio_file_path, frame_offset = frame_offset, num_frames = chunk_len)
+        yield audio[0]
+
+
+def iterate_logmel(audio_encoder, chunk_iterator, device) :
+    # log-mel of the whole recording, [1, 1, frames, mel_bins] at a time : the frames of audio_encoder.get_logmel
+    # on the whole recording (STFT with center=True, frame k is centered on sample k * hop_size)
+    hop_size = audio_encoder.hop_size
+    margin = hop_size * ((audio_encoder.window_size // 2 + hop_size - 1) // hop_size) # context of a frame, in whole hops
+
+    def get_frames(samples, samples_start, first_frame, last_frame) :
+        # frames [first_frame, last_frame) from samples[samples_start:], the first ones are only the context
+        logmel = audio_encoder.get_logmel(samples.unsqueeze(0).to(device))
+        offset = (first_frame * hop_size - samples_start) // hop_size
+        return logmel[:, :, offset : offset + last_frame - first_frame]
+
+    buffer = torch.zeros(0)
+    buffer_start = 0 # index of buffer[0] in the recording
+    next_frame = 0
+
+    for chunk in chunk_iterator :
+        buffer = torch.cat((buffer, chunk))
+
+        # frames whose window and context lie inside the buffer
+        end_frame = (buffer_start + buffer.size()[0] - margin) // hop_size + 1
+        if end_frame > next_frame :
+            samples_start = max(0, next_frame * hop_size - margin)
+            samples_end = (end_frame - 1) * hop_size + margin
+            yield get_frames(buffer[samples_start - buffer_start : samples_end - buffer_start], samples_start, next_frame, end_frame)
+
+            next_frame = end_frame
+            keep_start = max(0, next_frame * hop_size - margin)
+            buffer = buffer[keep_start - buffer_start:]
+            buffer_start = keep_start
+
+    # last frames : reflect padding at the end of the recording, as on the whole recording
+    total_frames = (buffer_start + buffer.size()[0]) // hop_size + 1
+    if buffer.size()[0] > 0 and total_frames > next_frame :
+        yield get_frames(buffer, buffer_start, next_frame, total_frames)
+
+
+def iterate_temporal_feature(audio_encoder, logmel_iterator, segment_columns = 32, halo_columns = 5) :
+    # Cnn14's temporal feature (audio_feature) of the whole recording, [1, 2048, columns, 2] at a time.
+    # halo_columns : context of a segment on each side, it covers the receptive field of the conv blocks
+    #                (2 convs 3x3 per block at strides 1 to 32 frames : ~160 frames)
+
+    def get_columns(logmel, logmel_start, first_column, last_column) :
+        # columns [first_column, last_column) from logmel, which starts at frame 'logmel_start' (a multiple of 32)
+        audio_feature, _ = audio_encoder.forward_conv_blocks(logmel)
+        offset = first_column - logmel_start // frames_per_column
+        return audio_feature[:, :, offset : offset + last_column - first_column]
+
+    buffer = None
+    buffer_start = 0 # frame index of buffer[:, :, 0]
+    next_column = 0
+
+    for logmel in logmel_iterator :
+        buffer = logmel if buffer is None else torch.cat((buffer, logmel), dim=2)
+
+        while buffer_start + buffer.size()[2] >= (next_column + segment_columns + halo_columns) * frames_per_column :
+            logmel_start = max(0, (next_column - halo_columns) * frames_per_column)
+            logmel_end = (next_column + segment_columns + halo_columns) * frames_per_column
+            yield get_columns(buffer[:, :, logmel_start - buffer_start : logmel_end - buffer_start],
+                              logmel_start, next_column, next_column + segment_columns)
+
+            next_column += segment_columns
+            keep_start = max(0, (next_column - halo_columns) * frames_per_column)
+            buffer = buffer[:, :, keep_start - buffer_start:]
+            buffer_start = keep_start
+
+    if buffer is None :
+        return
+
+    # last columns : Cnn14 keeps floor(frames / 32) columns
+    total_columns = (buffer_start + buffer.size()[2]) // frames_per_column
+    if total_columns > next_column :
+        logmel_start = max(0, (next_column - halo_columns) * frames_per_column)
+        yield get_columns(buffer[:, :, logmel_start - buffer_start:], logmel_start, next_column, total_columns)
+
+
+def caption_windows(model, temporal_feature, beam_search = True) :
+    # temporal_feature : [num_windows, 2048, window_columns, 2], the same decoding as model.forward
+    global_feature = model.audio_encoder.forward_global(temporal_feature)
+    prefix_vectors = model.get_prefix_vectors([temporal_feature, global_feature])
+
+    if beam_search == True :
+        return [outputs[0] for outputs in model.generate_beam(prefix_vectors)]
+    else :
+        return model.generate(prefix_vectors)
+
+
+@torch.no_grad()
+def caption_long_audio(model, audio_file_path, window_sec = 10, hop_sec = 5, batch_size = 8, beam_search = True,
+                       chunk_sec = 60, segment_columns = 32, halo_columns = 5) :
+    # Captions of the windows of a recording : [(start_sec, end_sec, caption), ...]
+    # window_sec : length of the clips the model was trained on (10 : AudioCaps, 30 : Clotho)
+    # hop_sec    : time between the starts of two windows (rounded to a column, 0.64s)
+    model.eval()
+    audio_encoder = model.audio_encoder
+    device = next(model.parameters()).device
+
+    sample_rate = model.SAMPLE_RATE
+    sec_per_column = frames_per_column * audio_encoder.hop_size / sample_rate
+    window_columns = (int(window_sec * sample_rate) // audio_encoder.hop_size + 1) // frames_per_column # 10s : 15
+    hop_columns = max(1, int(round(hop_sec / sec_per_column)))
+
+    num_samples = torchaudio.info(audio_file_path).num_frames
+
+    if num_samples < window_sec * sample_rate :
+        # shorter than a window : zero padded to the window, as a clip of the datasets
+        audio, _ = torchaudio.load(audio_file_path)
+        audio = torch.cat((audio[0], torch.zeros(int(window_sec * sample_rate) - num_samples))).unsqueeze(0)
+
+        if beam_search == True :
+            caption = model(audio.to(device), None, beam_search = True)[0][0]
+        else :
+            caption = model(audio.to(device), None, beam_search = False)[0]
+
+        return [(0.0, num_samples / sample_rate, caption)]
+
+    result_list = []
+
+    def caption_batch(window_start_list) :
+        temporal_feature = torch.cat([column_buffer[:, :, start - buffer_start : start - buffer_start + window_columns]
+                                      for start in window_start_list])
+        for start, caption in zip(window_start_list, caption_windows(model, temporal_feature, beam_search)) :
+            result_list.append((round(start * sec_per_column, 2), round((start + window_columns) * sec_per_column, 2), caption))
+
+    chunk_iterator = iterate_audio_chunks(audio_file_path, chunk_sec, sample_rate)
+    logmel_iterator = iterate_logmel(audio_encoder, chunk_iterator, device)
+
+    column_buffer = None
+    buffer_start = 0 # column index of column_buffer[:, :, 0]
+    next_window = 0 # first column of the next window
+
+    for columns in iterate_temporal_feature(audio_encoder, logmel_iterator, segment_columns, halo_columns) :
+        column_buffer = columns if column_buffer is None else torch.cat((column_buffer, columns), dim=2)
+        buffer_end = buffer_start + column_buffer.size()[2]
+
+        while next_window + (batch_size - 1) * hop_columns + window_columns <= buffer_end :
+            caption_batch([next_window + i * hop_columns for i in range(batch_size)])
+
+            # the columns of the last 'hop' are kept for a last window that ends with the recording
+            next_window += batch_size * hop_columns
+            keep_start = max(buffer_start, min(next_window - hop_columns, buffer_end))
+            column_buffer = column_buffer[:, :, keep_start - buffer_start:]
+            buffer_start = keep_start
+
+    # remaining windows, and a last window that ends with the recording
+    total_columns = buffer_start + column_buffer.size()[2]
+    window_start_list = list(range(next_window, total_columns - window_columns + 1, hop_columns))
+    last_window_end = window_start_list[-1] + window_columns if len(window_start_list) > 0 else next_window - hop_columns + window_columns
+    if last_window_end < total_columns :
+        window_start_list.append(total_columns - window_columns)
+
+    for i in range(0, len(window_start_list), batch_size) :
+        caption_batch(window_start_list[i : i + batch_size])
+
+    return result_list
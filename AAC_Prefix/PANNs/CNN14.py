@@ -11,6 +11,9 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.utils.checkpoint as cp
 from torch.nn.parameter import Parameter
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+import torch.ao.nn.intrinsic as nni
+from torch.ao.quantization import QuantStub, DeQuantStub, get_default_qconfig, prepare, convert
 
 from torchlibrosa.stft import Spectrogram, LogmelFilterBank
 from torchlibrosa.augmentation import SpecAugmentation
@@ -32,6 +35,42 @@ def init_bn(bn):
     bn.weight.data.fill_(1.)
 
 
+def get_frame_mask(frame_num, time_steps):
+    """Mask of the valid frames of a variable-length batch.
+    Input: frame_num (batch_size,), number of valid frames of each clip
+    Output: (batch_size, 1, time_steps, 1), 1.0 on valid frames and 0.0 on padding"""
+    
+    mask = torch.arange(time_steps, device=frame_num.device)[None, :] < frame_num[:, None]
+    return mask.float()[:, None, :, None]
+
+
+def checkpoint_without_bn_update(function, module, *args):
+    """Activation checkpointing of 'function' (torch.utils.checkpoint) : its activations are recomputed 
+    in backward instead of stored. The recomputation uses the batch statistics again but does not update 
+    the running statistics of the BatchNorm layers of 'module' a second time."""
+    
+    bn_list = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    is_recomputation = [False]
+    
+    def run(*args):
+        if is_recomputation[0] == False:
+            is_recomputation[0] = True
+            return function(*args)
+        
+        # momentum 0 : the running statistics are kept as they are (the same tensors are saved for backward)
+        momentum_list = [bn.momentum for bn in bn_list]
+        for bn in bn_list:
+            bn.momentum = 0.0
+        try:
+            return function(*args)
+        finally:
+            for bn, momentum in zip(bn_list, momentum_list):
+                bn.momentum = momentum
+                bn.num_batches_tracked.sub_(1)
+    
+    return cp.checkpoint(run, *args, use_reentrant=False)
+
+
 class ConvBlock(nn.Module):
     def __init__(self, in_channels, out_channels):
         
@@ -52,18 +91,42 @@ class ConvBlock(nn.Module):
 
         self.init_weight()
         
+        self.use_checkpoint = False
+        
     def init_weight(self):
         init_layer(self.conv1)
         init_layer(self.conv2)
         init_bn(self.bn1)
         init_bn(self.bn2)
 
+    def fuse_bn(self):
+        """Fold bn1 / bn2 (eval statistics) into conv1 / conv2 : each conv gets a bias 
+        and the BatchNorm becomes an identity, so ReLU runs in place on the conv output."""
+        
+        self.conv1 = fuse_conv_bn_eval(self.conv1, self.bn1)
+        self.conv2 = fuse_conv_bn_eval(self.conv2, self.bn2)
+        self.bn1 = nn.Identity()
+        self.bn2 = nn.Identity()
+
+        
+    def forward(self, input, pool_size=(2, 2), pool_type='avg', mask=None):
+        """mask: (batch_size, 1, time_steps, 1) frame mask of a variable-length batch (see get_frame_mask), 
+        padded frames are set to 0 after each conv so that the next conv sees zero padding as at the clip's end"""
+        
+        if self.use_checkpoint and self.training and torch.is_grad_enabled():
+            return checkpoint_without_bn_update(self.forward_block, self, input, pool_size, pool_type, mask)
+        
+        return self.forward_block(input, pool_size, pool_type, mask)
         
-    def forward(self, input, pool_size=(2, 2), pool_type='avg'):
+    def forward_block(self, input, pool_size=(2, 2), pool_type='avg', mask=None):
         
         x = input
         x = F.relu_(self.bn1(self.conv1(x)))
+        if mask is not None:
+            x = x * mask
         x = F.relu_(self.bn2(self.conv2(x)))
+        if mask is not None:
+            x = x * mask
         if pool_type == 'max':
             x = F.max_pool2d(x, kernel_size=pool_size)
         elif pool_type == 'avg':
@@ -78,9 +141,69 @@ class ConvBlock(nn.Module):
         return x
 
 
+class FFTSpectrogram(nn.Module):
+    def __init__(self, n_fft, hop_length, win_length, center=True, pad_mode='reflect'):
+        """Power spectrogram with torch.stft (FFT), the same as torchlibrosa's Spectrogram 
+        (hann window, reflect padding, power = 2) that computes the STFT as conv1d with DFT kernels. 
+        It has no parameters, so Cnn14's state_dict does not change."""
+        
+        super(FFTSpectrogram, self).__init__()
+        
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.win_length = win_length
+        self.center = center
+        self.pad_mode = pad_mode
+        
+        # periodic hann window, as librosa.filters.get_window(..., fftbins=True) in torchlibrosa
+        self.register_buffer('window', torch.hann_window(win_length, periodic=True), persistent=False)
+        
+    def forward(self, input):
+        """
+        Input: (batch_size, data_length)
+        Output: (batch_size, 1, time_steps, n_fft // 2 + 1)"""
+        
+        x = torch.stft(input, n_fft=self.n_fft, hop_length=self.hop_length, win_length=self.win_length, 
+                       window=self.window, center=self.center, pad_mode=self.pad_mode, return_complex=True)
+        # (batch_size, n_fft // 2 + 1, time_steps)
+        
+        x = x.real ** 2 + x.imag ** 2
+        
+        return x.transpose(1, 2)[:, None, :, :]
+
+
+class QuantizableConvBlock(nn.Module):
+    """ConvBlock for eager-mode static quantization : BatchNorms folded into the convs (eval statistics), 
+    conv + ReLU as one fused module, average pooling"""
+    
+    def __init__(self, conv_block, pool_size):
+        
+        super(QuantizableConvBlock, self).__init__()
+        
+        conv_bn_list = [(conv_block.conv1, conv_block.bn1), (conv_block.conv2, conv_block.bn2)]
+        conv1, conv2 = [fuse_conv_bn_eval(conv, bn) if isinstance(bn, nn.BatchNorm2d) else copy.deepcopy(conv) 
+                        for conv, bn in conv_bn_list]   # the BatchNorm may already be folded (optimize_for_inference)
+        
+        self.conv1 = nni.ConvReLU2d(conv1, nn.ReLU())
+        self.conv2 = nni.ConvReLU2d(conv2, nn.ReLU())
+        self.pool_size = pool_size
+        
+    def forward(self, x):
+        
+        x = self.conv2(self.conv1(x))
+        if self.pool_size != (1, 1):
+            x = F.avg_pool2d(x, kernel_size=self.pool_size)
+        
+        return x
+
+
 class Cnn14(nn.Module):
     def __init__(self, sample_rate, window_size, hop_size, mel_bins, fmin, 
-        fmax, classes_num):
+        fmax, classes_num, frontend='torchlibrosa', channels=(64, 128, 256, 512, 1024, 2048)):
+        """frontend = 'torchlibrosa' : STFT as conv1d with DFT kernels
+        frontend = 'fft'          : STFT with torch.stft (faster, on CPU in particular)
+        Both use the same mel filter bank and load the same weights (can be changed later with self.frontend)
+        channels : output channels of the six ConvBlocks (Cnn14_Student uses fewer)"""
         
         super(Cnn14, self).__init__()
 
@@ -95,6 +218,13 @@ class Cnn14(nn.Module):
         self.spectrogram_extractor = Spectrogram(n_fft=window_size, hop_length=hop_size, 
             win_length=window_size, window=window, center=center, pad_mode=pad_mode, 
             freeze_parameters=True)
+        
+        self.fft_spectrogram_extractor = FFTSpectrogram(n_fft=window_size, hop_length=hop_size, 
+            win_length=window_size, center=center, pad_mode=pad_mode)
+        
+        if frontend != 'torchlibrosa' and frontend != 'fft':
+            raise Exception('Incorrect argument!')
+        self.frontend = frontend
 
         # Logmel feature extractor
         self.logmel_extractor = LogmelFilterBank(sr=sample_rate, n_fft=window_size, 
@@ -107,12 +237,12 @@ class Cnn14(nn.Module):
 
         self.bn0 = nn.BatchNorm2d(64)
 
-        self.conv_block1 = ConvBlock(in_channels=1, out_channels=64)
-        self.conv_block2 = ConvBlock(in_channels=64, out_channels=128)
-        self.conv_block3 = ConvBlock(in_channels=128, out_channels=256)
-        self.conv_block4 = ConvBlock(in_channels=256, out_channels=512)
-        self.conv_block5 = ConvBlock(in_channels=512, out_channels=1024)
-        self.conv_block6 = ConvBlock(in_channels=1024, out_channels=2048)
+        self.conv_block1 = ConvBlock(in_channels=1, out_channels=channels[0])
+        self.conv_block2 = ConvBlock(in_channels=channels[0], out_channels=channels[1])
+        self.conv_block3 = ConvBlock(in_channels=channels[1], out_channels=channels[2])
+        self.conv_block4 = ConvBlock(in_channels=channels[2], out_channels=channels[3])
+        self.conv_block5 = ConvBlock(in_channels=channels[3], out_channels=channels[4])
+        self.conv_block6 = ConvBlock(in_channels=channels[4], out_channels=channels[5])
 
         self.fc1 = nn.Linear(2048, 2048, bias=True)
         self.fc_audioset = nn.Linear(2048, classes_num, bias=True)
@@ -120,22 +250,160 @@ class Cnn14(nn.Module):
         self.init_weight()
         
         self.maxpool_forclothoaudio = nn.MaxPool2d((3, 1), stride=(3, 1))
+        
+        self.window_size = window_size
+        self.hop_size = hop_size
+        
+        # set by optimize_for_inference()
+        self.is_optimized_for_inference = False
+        self.is_channels_last = False
+        
+        # set by prepare_static_quantization() / convert_static_quantization() : None, 'calibrating' or 'quantized'
+        self.quantization_state = None
 
     def init_weight(self):
         init_bn(self.bn0)
         init_layer(self.fc1)
         init_layer(self.fc_audioset)
  
-    def forward(self, input, mixup_lambda=None):
+    def set_checkpointing(self, use_checkpoint):
+        """Recompute the activations of the ConvBlocks in backward instead of storing them (training only)"""
+        
+        for conv_block in [self.conv_block1, self.conv_block2, self.conv_block3, 
+                           self.conv_block4, self.conv_block5, self.conv_block6]:
+            conv_block.use_checkpoint = use_checkpoint
+ 
+    def optimize_for_inference(self, channels_last=True):
+        """Inference-only transformation (the model must not be trained afterwards) :
+        - BatchNorm of every ConvBlock is folded into its convs (conv + bias -> in-place ReLU)
+        - bn0 (normalization over mel bins) becomes one multiply-add on the log-mel, without the transposes
+        - the conv stack runs in channels-last memory format (if channels_last)"""
+        
+        self.eval()
+        
+        for conv_block in [self.conv_block1, self.conv_block2, self.conv_block3, 
+                           self.conv_block4, self.conv_block5, self.conv_block6]:
+            conv_block.fuse_bn()
+        
+        with torch.no_grad():
+            bn0_scale = self.bn0.weight / torch.sqrt(self.bn0.running_var + self.bn0.eps)
+            bn0_shift = self.bn0.bias - self.bn0.running_mean * bn0_scale
+        self.register_buffer('bn0_scale', bn0_scale)
+        self.register_buffer('bn0_shift', bn0_shift)
+        
+        self.is_channels_last = channels_last
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+        self.is_optimized_for_inference = True
+        
+        return self
+ 
+    def prepare_static_quantization(self, backend='x86'):
+        """Post-training static int8 quantization of the conv blocks, step 1 (inference only) : 
+        the ConvBlocks are folded into QuantizableConvBlocks between a QuantStub and a DeQuantStub, with observers.
+        Calibrate by running clips through forward() in eval mode, then call convert_static_quantization().
+        The log-mel frontend, bn0 and the global head (fc1, fc_audioset) stay in float32."""
+        
+        self.eval()
+        torch.backends.quantized.engine = backend
+        
+        self.quantized_conv_blocks = nn.Sequential(QuantStub(), 
+            QuantizableConvBlock(self.conv_block1, (2, 2)), QuantizableConvBlock(self.conv_block2, (2, 2)), 
+            QuantizableConvBlock(self.conv_block3, (2, 2)), QuantizableConvBlock(self.conv_block4, (2, 2)), 
+            QuantizableConvBlock(self.conv_block5, (2, 2)), QuantizableConvBlock(self.conv_block6, (1, 1)), 
+            DeQuantStub())
+        self.quantized_conv_blocks.qconfig = get_default_qconfig(backend)
+        prepare(self.quantized_conv_blocks, inplace=True)
+        
+        self.quantization_state = 'calibrating'
+        
+        return self
+ 
+    def convert_static_quantization(self):
+        """Step 2 : int8 weights and activations from the calibrated observers. 
+        The float32 ConvBlocks are removed, so the model can not be trained afterwards."""
+        
+        convert(self.quantized_conv_blocks, inplace=True)
+        
+        for name in ['conv_block1', 'conv_block2', 'conv_block3', 'conv_block4', 'conv_block5', 'conv_block6']:
+            delattr(self, name)
+        
+        self.quantization_state = 'quantized'
+        
+        return self
+ 
+    def get_logmel(self, input):
         """
-        Input: (batch_size, data_length)"""
-
-        x = self.spectrogram_extractor(input)   # (batch_size, 1, time_steps, freq_bins)
+        Input: (batch_size, data_length)
+        Output: (batch_size, 1, time_steps, mel_bins)"""
+        
+        if self.frontend == 'fft':
+            x = self.fft_spectrogram_extractor(input)   # (batch_size, 1, time_steps, freq_bins)
+        else:
+            x = self.spectrogram_extractor(input)   # (batch_size, 1, time_steps, freq_bins)
         x = self.logmel_extractor(x)    # (batch_size, 1, time_steps, mel_bins)
         
-        x = x.transpose(1, 3)
-        x = self.bn0(x)
-        x = x.transpose(1, 3)
+        return x
+ 
+    def forward(self, input, mixup_lambda=None, lengths=None):
+        """
+        Input: (batch_size, data_length), or log-mel (batch_size, 1, time_steps, mel_bins) 
+        computed by get_logmel (e.g. from the log-mel store, see FeatureCache.py)
+        lengths: (batch_size,) number of samples of each clip in a zero-padded variable-length batch. 
+        Padded frames are masked, and the frame mask of audio_feature is returned as a third output."""
+        
+        if input.dim() == 4 :
+            x = input
+        else:
+            x = self.get_logmel(input)
+        
+        if lengths is None:
+            return self.forward_from_logmel(x, mixup_lambda)
+        
+        frame_num = torch.div(lengths, self.hop_size, rounding_mode='floor') + 1   # STFT frames with center=True
+        return self.forward_from_logmel(x, mixup_lambda, frame_num.to(x.device))
+ 
+    def conv_block_with_mask(self, conv_block, x, pool_size, frame_num):
+        """conv_block, and the number of valid frames of each clip after its pooling (None : no mask)"""
+        
+        if frame_num is None:
+            return conv_block(x, pool_size=pool_size, pool_type='avg'), None
+        
+        x = conv_block(x, pool_size=pool_size, pool_type='avg', mask=get_frame_mask(frame_num, x.size()[2]))
+        frame_num = torch.div(frame_num, pool_size[0], rounding_mode='floor').clamp(min=1)
+        
+        return x * get_frame_mask(frame_num, x.size()[2]), frame_num
+ 
+    def forward_from_logmel(self, x, mixup_lambda=None, frame_num=None):
+        """
+        Input: (batch_size, 1, time_steps, mel_bins)
+        frame_num: (batch_size,) number of valid frames of each clip (variable-length batch) or None"""
+        
+        audio_feature, frame_num = self.forward_conv_blocks(x, mixup_lambda, frame_num)
+        semantic_feature = self.forward_global(audio_feature, frame_num)
+        
+        if frame_num is not None:
+            return audio_feature, semantic_feature, get_frame_mask(frame_num, audio_feature.size()[2])[:, 0, :, 0].bool()
+        
+        return audio_feature, semantic_feature
+ 
+    def forward_conv_blocks(self, x, mixup_lambda=None, frame_num=None):
+        """
+        Input: (batch_size, 1, time_steps, mel_bins)
+        Output: audio_feature (batch_size, 2048, time_steps / 32, mel_bins / 32), 
+        and the number of valid frames of audio_feature (None if frame_num is None)"""
+        
+        if self.is_optimized_for_inference:
+            x = torch.addcmul(self.bn0_shift, x, self.bn0_scale)   # bn0 over the last (mel) axis
+            if self.is_channels_last:
+                x = x.contiguous(memory_format=torch.channels_last)
+        else:
+            x = x.transpose(1, 3)
+            x = self.bn0(x)
+            x = x.transpose(1, 3)
+        
+        if frame_num is not None:
+            x = x * get_frame_mask(frame_num, x.size()[2])
         
         if self.training:
             x = self.spec_augmenter(x)
@@ -144,35 +412,116 @@ class Cnn14(nn.Module):
         if self.training and mixup_lambda is not None:
             x = do_mixup(x, mixup_lambda)
         
-        x = self.conv_block1(x, pool_size=(2, 2), pool_type='avg')
+        if self.quantization_state != None:
+            # int8 conv blocks (prepare_static_quantization), without frame masks
+            if frame_num is not None:
+                raise Exception('Variable-length batches are not supported by the quantized Cnn14!')
+            
+            return self.quantized_conv_blocks(x.contiguous()), None
+        
+        x, frame_num = self.conv_block_with_mask(self.conv_block1, x, (2, 2), frame_num)
         x = F.dropout(x, p=0.2, training=self.training) 
-        x = self.conv_block2(x, pool_size=(2, 2), pool_type='avg')
+        x, frame_num = self.conv_block_with_mask(self.conv_block2, x, (2, 2), frame_num)
         x = F.dropout(x, p=0.2, training=self.training)
-        x = self.conv_block3(x, pool_size=(2, 2), pool_type='avg')
+        x, frame_num = self.conv_block_with_mask(self.conv_block3, x, (2, 2), frame_num)
         x = F.dropout(x, p=0.2, training=self.training)
-        x = self.conv_block4(x, pool_size=(2, 2), pool_type='avg')
+        x, frame_num = self.conv_block_with_mask(self.conv_block4, x, (2, 2), frame_num)
         x = F.dropout(x, p=0.2, training=self.training)
-        x = self.conv_block5(x, pool_size=(2, 2), pool_type='avg')
+        x, frame_num = self.conv_block_with_mask(self.conv_block5, x, (2, 2), frame_num)
         x = F.dropout(x, p=0.2, training=self.training)
-        x = self.conv_block6(x, pool_size=(1, 1), pool_type='avg')
+        x, frame_num = self.conv_block_with_mask(self.conv_block6, x, (1, 1), frame_num)
         x = F.dropout(x, p=0.2, training=self.training)
         
-        audio_feature = x
-        
-        # if audio's length is 30s
-        if audio_feature.size()[2] == 46 :
-            x = self.maxpool_forclothoaudio(x)
-            
+        return x, frame_num
+ 
+    def forward_global(self, audio_feature, frame_num=None):
+        """
+        Input: audio_feature (batch_size, 2048, time_steps, 2) of forward_conv_blocks
+        Output: semantic_feature (batch_size, classes_num)"""
         
-        x = torch.mean(x, dim=3)
+        x = audio_feature
         
-        (x1, _) = torch.max(x, dim=2)
-        x2 = torch.mean(x, dim=2)
-        x = x1 + x2
+        if frame_num is not None:
+            # variable-length batch : max and mean over the valid frames of each clip
+            x = torch.mean(x, dim=3)
+            frame_mask = get_frame_mask(frame_num, x.size()[2])[:, :, :, 0]   # (batch_size, 1, time_steps)
+            
+            (x1, _) = torch.max(x.masked_fill(frame_mask == 0, -float('inf')), dim=2)
+            x2 = torch.sum(x * frame_mask, dim=2) / frame_num[:, None]
+            x = x1 + x2
+        else:
+            # if audio's length is 30s
+            if audio_feature.size()[2] == 46 :
+                x = self.maxpool_forclothoaudio(x)
+                
+            
+            x = torch.mean(x, dim=3)
+            
+            (x1, _) = torch.max(x, dim=2)
+            x2 = torch.mean(x, dim=2)
+            x = x1 + x2
         x = F.dropout(x, p=0.5, training=self.training)
        
         x = F.relu_(self.fc1(x))
         embedding = F.dropout(x, p=0.5, training=self.training)
         semantic_feature = torch.sigmoid(self.fc_audioset(x))
         
-        return audio_feature, semantic_feature
\ No newline at end of file
+        return semantic_feature
+
+class Cnn14_Student(Cnn14):
+    def __init__(self, sample_rate, window_size, hop_size, mel_bins, fmin, 
+        fmax, classes_num, channels=(32, 64, 128, 256, 512, 512), frontend='torchlibrosa'):
+        """Slim Cnn14 distilled from Cnn14 (Train_StudentEncoder in Train.py), a drop-in audio_encoder of AAC_Prefix : 
+        same frontend, poolings and outputs (temporal_feature (batch_size, 2048, time_steps, 2), global_feature), 
+        with 'channels' in the six ConvBlocks and a 1x1 conv (+ ReLU) projecting the last block to 2048 channels"""
+        
+        super(Cnn14_Student, self).__init__(sample_rate, window_size, hop_size, mel_bins, fmin, 
+            fmax, classes_num, frontend=frontend, channels=channels)
+        
+        self.projection = nn.Conv2d(in_channels=channels[5], out_channels=2048, 
+                                    kernel_size=(1, 1), stride=(1, 1), bias=True)
+        init_layer(self.projection)
+        
+        self.channels = channels
+        
+    def init_from_teacher(self, teacher):
+        """bn0 and the global head (fc1, fc_audioset) start from the teacher's : once the temporal feature matches, 
+        the global feature does too"""
+        
+        self.bn0.load_state_dict(teacher.bn0.state_dict())
+        self.fc1.load_state_dict(teacher.fc1.state_dict())
+        self.fc_audioset.load_state_dict(teacher.fc_audioset.state_dict())
+        
+        return self
+ 
+    def forward_conv_blocks(self, x, mixup_lambda=None, frame_num=None):
+        
+        x, frame_num = super(Cnn14_Student, self).forward_conv_blocks(x, mixup_lambda, frame_num)
+        
+        x = F.relu_(self.projection(x))
+        if frame_num is not None:
+            x = x * get_frame_mask(frame_num, x.size()[2])
+        
+        return x, frame_num
+
+
+def get_student_encoder(params_path=None, teacher=None, channels=(32, 64, 128, 256, 512, 512), frontend='torchlibrosa'):
+    """Cnn14_Student with the parameters of 'params_path' (its channels are read from them), 
+    or a new one initialized from 'teacher' for distillation"""
+    
+    if params_path is not None:
+        state_dict = torch.load(params_path, map_location='cpu')
+        channels = tuple(state_dict['conv_block' + str(i) + '.conv1.weight'].size()[0] for i in range(1, 7))
+    
+    student = Cnn14_Student(sample_rate=16000, window_size=512, 
+        hop_size=320, mel_bins=64, fmin=50, fmax=14000, 
+        classes_num=527, channels=channels, frontend=frontend)
+    
+    if params_path is not None:
+        student.load_state_dict(state_dict)
+    elif teacher is not None:
+        student.init_from_teacher(teacher)
+    
+    print("student encoder : channels =", channels)
+    
+    return student
@@ -0,0 +1,179 @@
+import os
+import hashlib
+
+import torch
+import torch.nn as nn
+from torch.nn import functional as nnf
+
+from .GPT2_KVCache import check_gpt2_attention
+
+# Decoding step of GPT2 + language header with fixed shapes, for graph compilation (TorchScript or torch.compile).
+#
+# Every step takes the current token, its position and a key/value cache of fixed size
+# [num_layers, batch_size, num_head, max_length, head_dim], writes the key/value of the token at 'position'
+# and attends to the whole cache with a mask on the positions that are not written yet.
+# The shapes never change between steps, so the step is compiled once and reused for every token.
+
+class DecodeStep(nn.Module):
+
+    def forward(self, token, position, keys, values) :
+        # token : [batch_size], position : [1] (int64 tensor, so that it is not baked into the compiled graph)
+        # keys, values : [num_layers, batch_size, num_head, max_length, head_dim], updated in place
+        # return : logits of the next token, [batch_size, vocab_size]
+
+        batch_size = token.size()[0]
+
+        hidden_states = self.gpt.wte(token).unsqueeze(1) + self.gpt.wpe(position).unsqueeze(0) # [batch_size, 1, 768]
+
+        # positions after 'position' are not generated yet
+        is_empty = torch.arange(keys.size()[3], device=token.device).gt(position)
+
+        for layer_idx, block in enumerate(self.gpt.h) :
+            attn = block.attn
+
+            residual = hidden_states
+            hidden_states = block.ln_1(hidden_states)
+
+            query, key, value = attn.c_attn(hidden_states).split(attn.split_size, dim=2)
+            query, key, value = [x.view(batch_size, 1, self.num_head, self.head_dim).transpose(1, 2) for x in (query, key, value)]
+
+            keys[layer_idx].index_copy_(2, position, key)
+            values[layer_idx].index_copy_(2, position, value)
+
+            attn_weights = torch.matmul(query, keys[layer_idx].transpose(-1, -2)) # [batch_size, num_head, 1, max_length]
+            if attn.scale_attn_weights :
+                attn_weights = attn_weights / (self.head_dim ** 0.5)
+            if attn.scale_attn_by_inverse_layer_idx :
+                attn_weights = attn_weights / float(layer_idx + 1)
+            attn_weights = attn_weights.masked_fill(is_empty, torch.finfo(attn_weights.dtype).min)
+            attn_weights = nnf.softmax(attn_weights, dim=-1)
+
+            attn_output = torch.matmul(attn_weights, values[layer_idx]) # [batch_size, num_head, 1, head_dim]
+            attn_output = attn_output.transpose(1, 2).reshape(batch_size, 1, -1)
+            hidden_states = residual + attn.c_proj(attn_output)
+
+            residual = hidden_states
+            hidden_states = block.ln_2(hidden_states)
+            hidden_states = residual + block.mlp(hidden_states)
+
+        hidden_states = self.gpt.ln_f(hidden_states)
+        logits = self.language_header(hidden_states[:, 0])
+
+        # '!' of own vocabulary is not used (see AAC_Prefix.get_logits_from_hidden_states)
+        if self.mask_first_word == True :
+            logits[:, 0] = 0.0
+
+        return logits
+
+    def __init__(self, gpt, language_header, mask_first_word) :
+        super(DecodeStep, self).__init__()
+
+        check_gpt2_attention(gpt)
+
+        self.gpt = gpt
+        self.language_header = language_header
+        self.mask_first_word = mask_first_word
+
+        self.num_head = gpt.h[0].attn.num_heads
+        self.head_dim = gpt.h[0].attn.head_dim
+
+
+class StaticDecoder() :
+
+    def prefill(self, prefix_embeds) :
+        # prefix_embeds : [batch_size, prefix_len, 768]
+        # return : logits of the first token, [batch_size, vocab_size]
+
+        out = self.decode_step.gpt(inputs_embeds=prefix_embeds, use_cache=True)
+
+        for layer_idx, (key, value) in enumerate(out.past_key_values) :
+            self.keys[layer_idx, :, :, :self.prefix_len] = key
+            self.values[layer_idx, :, :, :self.prefix_len] = value
+
+        logits = self.decode_step.language_header(out[0][:, -1])
+        if self.decode_step.mask_first_word == True :
+            logits[:, 0] = 0.0
+
+        return logits
+
+    def step(self, token, token_idx) :
+        # token : [batch_size], the 'token_idx'-th generated token (0 = first token after the prefix)
+        position = torch.tensor([self.prefix_len + token_idx], dtype=torch.int64, device=self.device)
+
+        return self.step_fn(token.contiguous(), position, self.keys, self.values)
+
+    def is_compatible(self, prefix_embeds) :
+        return prefix_embeds.size()[0] == self.batch_size and prefix_embeds.size()[1] == self.prefix_len
+
+    def cache_key(self, backend) :
+        # compiled artifacts depend on the weights (GPT2 and the trained header), the shapes and the torch version.
+        # The state_dict also holds the int8 weights of a quantized decoder (AAC_Prefix.quantize_decoder).
+        sha = hashlib.sha1()
+        sha.update(str((torch.__version__, backend, tuple(self.keys.size()), str(self.keys.dtype), str(self.device))).encode())
+        for name, value in list(self.decode_step.state_dict().items()) :
+            sha.update(name.encode())
+            for tensor in (value if isinstance(value, tuple) else (value,)) : # packed params : (weight, bias)
+                if isinstance(tensor, torch.Tensor) :
+                    if tensor.is_quantized :
+                        tensor = tensor.int_repr()
+                    sha.update(tensor.detach().cpu().numpy().tobytes())
+                else :
+                    sha.update(str(tensor).encode())
+        return sha.hexdigest()[:16]
+
+    def compile(self, backend = 'torchscript', cache_dir = './AAC_Prefix/compiled_decode_step', warmup_steps = 3) :
+        # backend = 'torchscript' : traced and frozen graph, saved in 'cache_dir' and loaded by later processes
+        # backend = 'inductor'    : torch.compile, using 'cache_dir' as inductor's on-disk cache
+        # backend = None          : eager
+
+        example_inputs = (torch.zeros(self.batch_size, dtype=torch.int64, device=self.device),
+                          torch.tensor([self.prefix_len], dtype=torch.int64, device=self.device),
+                          self.keys, self.values)
+
+        if backend == 'torchscript' :
+            os.makedirs(cache_dir, exist_ok=True)
+            compiled_path = os.path.join(cache_dir, 'decode_step_' + self.cache_key(backend) + '.pt')
+
+            if os.path.exists(compiled_path) :
+                print("load compiled decode step :", compiled_path)
+                self.step_fn = torch.jit.load(compiled_path, map_location=self.device)
+            else :
+                with torch.no_grad() :
+                    traced = torch.jit.trace(self.decode_step, example_inputs, check_trace=False)
+                self.step_fn = torch.jit.freeze(traced)
+                torch.jit.save(self.step_fn, compiled_path)
+                print("save compiled decode step :", compiled_path)
+
+        elif backend == 'inductor' :
+            os.makedirs(cache_dir, exist_ok=True)
+            os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(cache_dir)
+            from torch._inductor import config as inductor_config
+            inductor_config.fx_graph_cache = True
+            self.step_fn = torch.compile(self.decode_step, dynamic=False)
+
+        elif backend == None :
+            self.step_fn = self.decode_step
+
+        else :
+            raise Exception('Incorrect argument!')
+
+        # warm-up : the first calls optimize (TorchScript) or compile (inductor) the graph.
+        # The cache is written at 'prefix_len', which prefill() / the first step overwrite before it is read.
+        with torch.no_grad() :
+            for _ in range(warmup_steps) :
+                self.step_fn(*example_inputs)
+
+    def __init__(self, gpt, language_header, mask_first_word, batch_size, prefix_len, max_length, device) :
+
+        self.decode_step = DecodeStep(gpt, language_header, mask_first_word)
+        self.decode_step.training = False # only used for inference (gpt / language_header keep their own mode)
+        self.batch_size = batch_size
+        self.prefix_len = prefix_len
+        self.device = device
+
+        num_layers = len(gpt.h)
+        cache_size = (num_layers, batch_size, self.decode_step.num_head, prefix_len + max_length, self.decode_step.head_dim)
+        self.keys = torch.zeros(cache_size, device=device, dtype=gpt.wte.weight.dtype)
+        self.values = torch.zeros(cache_size, device=device, dtype=gpt.wte.weight.dtype)
+
+        self.step_fn = self.decode_step
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 from torch.nn import functional as nnf
+import torch.utils.checkpoint as cp
 
 from typing import Optional
 
@@ -92,14 +93,20 @@ class Transformer(nn.Module):
             attentions.append(att)
         return x, attentions
 
+    def run_layer(self, layer, x, y=None, mask=None):
+        # activation checkpointing : the layer's activations are recomputed in backward instead of stored
+        if self.use_checkpoint and self.training and torch.is_grad_enabled():
+            return cp.checkpoint(layer, x, y, mask, use_reentrant=False)
+        return layer(x, y, mask)
+
     def forward(self, x, y=None, mask=None):
         for i, layer in enumerate(self.layers):
             if i % 2 == 0 and self.enc_dec: # cross
-                x = layer(x, y)
+                x = self.run_layer(layer, x, y)
             elif self.enc_dec:  # self
-                x = layer(x, x, mask)
+                x = self.run_layer(layer, x, x, mask)
             else:  # self or cross
-                x = layer(x, y, mask)
+                x = self.run_layer(layer, x, y, mask)
         return x
 
     def __init__(self, dim_self: int, num_heads: int, num_layers: int, dim_ref: Optional[int] = None,
@@ -117,4 +124,5 @@ class Transformer(nn.Module):
                 layers.append(TransformerLayer(dim_self, dim_self, num_heads, mlp_ratio, act=act, norm_layer=norm_layer))
             else:  # self or cross
                 layers.append(TransformerLayer(dim_self, dim_ref, num_heads, mlp_ratio, act=act, norm_layer=norm_layer))
-        self.layers = nn.ModuleList(layers)
\ No newline at end of file
+        self.layers = nn.ModuleList(layers)
+        self.use_checkpoint = False
\ No newline at end of file
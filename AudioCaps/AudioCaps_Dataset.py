@@ -1,87 +1,85 @@
 import torch
 from torch.utils.data import Dataset
+import numpy as np
 
-import pandas as pd
 import torchaudio
 import os
 from tqdm import tqdm
-import re
 
 import util
+from DatasetManifest import get_audiocaps_manifest
+from TokenCache import get_caption_tokens, get_token_matrix
 
 class AudioCapsDataset(Dataset):
-    def __init__(self, tokenizer, data_dir, split, prefix_size, set_length = 10, tokenizer_type = 'GPT2') :  # split = 'train' or 'test'
+    def __init__(self, tokenizer, data_dir, split, prefix_size, set_length = 10, tokenizer_type = 'GPT2', variable_length = False) :  # split = 'train' or 'test'
         super(AudioCapsDataset, self).__init__()
         
         self.SAMPLE_RATE = 16000
         self.split = split
         self.set_length = set_length
+        self.variable_length = variable_length # no zero padding, clips are padded per batch (util.collate_variable_length)
 
         self.data_dir = data_dir + '/' + split + '/'
-        csv_file = pd.read_csv(self.data_dir + split + '.csv')
         
-        # file's name = youtube_id
-        audio_file_list = os.listdir(self.data_dir)
+        # wav files and their normalized captions (DatasetManifest.py)
+        manifest = get_audiocaps_manifest(data_dir, split)
         
         self.path_list = []
-        self.token_list = []
         self.caption_list_for_test = []
+        caption_list_for_train = []
         
-        for file in tqdm(audio_file_list, desc = 'get dataset...') :
-            if file[-3:] == 'wav' :
-                file_row_in_csv = csv_file[csv_file['youtube_id'] == file[:-4]]
+        for file, captions in tqdm(zip(manifest['file_list'], manifest['caption_lists']), desc = 'get dataset...', total = len(manifest['file_list'])) :
+            # train : 1 caption per each audio, test : 5 captions per each audio
+            for caption in captions : 
+                self.path_list.append(file)
                 
-                captions = file_row_in_csv['caption'].to_list() # train : 1 caption per each audio, test : 5 captions per each audio
-                for caption in captions : 
-                    self.path_list.append(file)
-                    
-                    caption = caption.lower()    
-                
-                    caption = caption.replace(',', ' , ') 
-                    caption = re.sub(' +', ' ', caption)
-                    caption = caption.replace(' ,', ',')
-                    caption = re.sub(r'[.]', '', caption)
-
-                    caption = caption.strip()
-
-                    caption += '.'
-                    
-                    if split != 'train' :
-                        self.caption_list_for_test.append(caption)
-                    elif split == 'train' :
-                        if tokenizer_type == 'GPT2' :
-                            tokens = tokenizer(caption)['input_ids']
-                        else :
-                            tokens = tokenizer.encode(caption)
-
-                        self.token_list.append(torch.tensor(tokens))
+                if split != 'train' :
+                    self.caption_list_for_test.append(caption)
+                elif split == 'train' :
+                    caption_list_for_train.append(caption)
                         
-        if split == 'train' :          
-            self.all_len = torch.tensor([len(self.token_list[i]) for i in range(len(self.token_list))]).float()
+        if split == 'train' :
+            # all captions tokenized at once, or loaded from the cache of a previous run (TokenCache.py)
+            token_ids, offsets = get_caption_tokens(tokenizer, tokenizer_type, caption_list_for_train)
+            self.all_len = torch.from_numpy(np.diff(offsets)).float()
             self.max_seq_len = min(int(self.all_len.mean() + self.all_len.std() * 10), int(self.all_len.max()))
+            
+            # [num_captions, max_seq_len] and the caption lengths, the mask is built per batch (util.CaptionCollate)
+            self.token_matrix, self.token_lengths = get_token_matrix(token_ids, offsets, self.max_seq_len)
         self.prefix_length = prefix_size # audio_prefix_length + semantic_prefix_length
+        
+        # encoder features or log-mel instead of audio, see set_feature_cache() and set_logmel_store()
+        self.feature_cache = None
+        self.logmel_store = None
+        self.feature_cache_name = 'AudioCaps_' + split
             
     def __len__(self):
        
         return len(self.path_list)
     
-    def pad_tokens(self, item: int):
-        tokens = self.token_list[item].clone().detach()
-        padding = self.max_seq_len - tokens.shape[0]
-        if padding > 0:
-            tokens = torch.cat((tokens, torch.zeros(padding, dtype=torch.int64) - 1))
-            self.token_list[item] = tokens
-        elif padding < 0:
-            tokens = tokens[:self.max_seq_len]
-            self.token_list[item] = tokens
-        mask = tokens.ge(0)  # mask is zero where we out of sequence
-        tokens[~mask] = 0
-        mask = mask.float()
-        mask = torch.cat((torch.ones(self.prefix_length), mask), dim=0)  # adding prefix mask
-        return tokens, mask
+    def get_clip_name(self, item: int) :
+        return self.path_list[item]
     
+    def get_file_name(self, item: int) :
+        return self.path_list[item]
     
-    def __getitem__(self, item: int) :
+    def set_feature_cache(self, feature_cache) :
+        # feature_cache : FeatureCache (FeatureCache.py) of the frozen encoder, or None to serve audio again
+        self.feature_cache = feature_cache
+    
+    def set_logmel_store(self, logmel_store) :
+        # logmel_store : log-mel of every clip (FeatureCache.build_logmel_store), or None to serve audio again
+        self.logmel_store = logmel_store
+    
+    def get_audio_length(self, item: int) :
+        # number of samples load_audio returns, without loading the audio
+        if self.variable_length == False :
+            return self.SAMPLE_RATE * self.set_length
+        
+        num_frames = torchaudio.info(self.data_dir + self.path_list[item]).num_frames
+        return min(num_frames, self.SAMPLE_RATE * self.set_length)
+    
+    def load_audio(self, item: int) :
         
         audio_file_full_path = self.data_dir + self.path_list[item]
        
@@ -94,13 +92,24 @@ class AudioCapsDataset(Dataset):
         if audio_file.shape[0] > (self.SAMPLE_RATE * self.set_length) :
             audio_file = audio_file[:self.SAMPLE_RATE * self.set_length]
         # zero padding
-        if audio_file.shape[0] < (self.SAMPLE_RATE * self.set_length) :
+        if audio_file.shape[0] < (self.SAMPLE_RATE * self.set_length) and self.variable_length == False :
             pad_len = (self.SAMPLE_RATE * self.set_length) - audio_file.shape[0]
             pad_val = torch.zeros(pad_len)
             audio_file = torch.cat((audio_file, pad_val), dim=0)
+        
+        return audio_file
+    
+    def __getitem__(self, item: int) :
+        
+        if self.feature_cache != None :
+            audio_file = self.feature_cache.get_features(self.get_clip_name(item)) # (temporal_feature, global_feature)
+        elif self.logmel_store != None :
+            audio_file = self.logmel_store[self.get_clip_name(item)].float() # [1, time_steps, mel_bins]
+        else :
+            audio_file = self.load_audio(item)
             
         if self.split == 'train' :
-            tokens, mask = self.pad_tokens(item)
-            return audio_file, tokens, mask, self.path_list[item]
+            # (audio, tokens, token_length, file name), util.CaptionCollate adds the mask
+            return audio_file, self.token_matrix[item], self.token_lengths[item], self.path_list[item]
         else :
             return audio_file, self.caption_list_for_test[item], self.path_list[item]
\ No newline at end of file
@@ -0,0 +1,51 @@
+import sys
+import time
+
+import torch
+
+from AAC_Prefix.PANNs.CNN14 import Cnn14
+
+# CPU benchmark of Cnn14's spectrogram frontends : torchlibrosa's conv1d STFT (default) and torch.stft (frontend = 'fft').
+# Random weights and audio : the frontends have no trained parameters, and the log-mel / encoder outputs are also compared.
+#
+# python3 Benchmark_Frontend.py [num_threads]
+
+NUM_RUNS = 10
+
+num_threads = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+torch.set_num_threads(num_threads)
+
+torch.manual_seed(0)
+encoder_dict = {'torchlibrosa' : Cnn14(16000, 512, 320, 64, 50, 14000, 527).eval(),
+                'fft' : Cnn14(16000, 512, 320, 64, 50, 14000, 527, frontend='fft').eval()}
+encoder_dict['fft'].load_state_dict(encoder_dict['torchlibrosa'].state_dict())
+
+
+def measure_ms(function, audio, num_runs) :
+    for _ in range(2) : # warm-up
+        function(audio)
+
+    start_time = time.time()
+    for _ in range(num_runs) :
+        function(audio)
+
+    return (time.time() - start_time) / num_runs * 1000
+
+
+print("num_threads :", num_threads)
+
+# (clip length in seconds, batch size) : AudioCaps (10s) and Clotho (up to 30s) batches
+for length_sec, batch_size in ((10, 8), (30, 4)) :
+    audio = torch.randn(batch_size, 16000 * length_sec) * 0.1
+
+    with torch.no_grad() :
+        logmel_list = [encoder.get_logmel(audio) for encoder in encoder_dict.values()]
+        feature_list = [encoder(audio) for encoder in encoder_dict.values()]
+
+        print(str(batch_size) + " x " + str(length_sec) + "s :",
+              "log-mel max abs diff %.2e dB," % (logmel_list[0] - logmel_list[1]).abs().max().item(),
+              "temporal feature relative diff %.2e" % ((feature_list[0][0] - feature_list[1][0]).norm() / feature_list[0][0].norm()).item())
+
+        for frontend, encoder in encoder_dict.items() :
+            print("    %-12s : log-mel %.1f ms, whole encoder %.0f ms" % (frontend, 
+                  measure_ms(encoder.get_logmel, audio, NUM_RUNS), measure_ms(encoder, audio, 2)))
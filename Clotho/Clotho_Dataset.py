@@ -1,128 +1,141 @@
 import torch
 from torch.utils.data import Dataset
+import numpy as np
 
-import pandas as pd
 import torchaudio
 import os
 from tqdm import tqdm
-import re
 import string
 
 import util
+from DatasetManifest import get_clotho_manifest
+from FeatureCache import get_pcm_store
+from TokenCache import get_caption_tokens, get_token_matrix
 
 class ClothoDataset(Dataset):
     def compress_audio(self, audio, set_length = 10) :
+        # audio : [num_samples], subsampled to set_length seconds (sample int(ratio * idx), computed in float64)
+        ratio = audio.size()[0]/(self.SAMPLE_RATE * set_length)
         
-        ratio = audio.size()[1]/(self.SAMPLE_RATE * set_length)
+        compress_idx = (torch.arange(self.SAMPLE_RATE * set_length, dtype=torch.float64) * ratio).long()
         
-        compress_idx_list = []
-        
-        for idx in range(self.SAMPLE_RATE * set_length) :
-            compress_idx_list.append(int(ratio * idx))
-        
-        return audio[:, compress_idx_list]
+        return audio[compress_idx]
     
-    def __init__(self, tokenizer, data_dir, split, prefix_size, tokenizer_type = 'GPT2', is_settingnum_3 = False) :  # split = 'development' or 'evaluation'
+    def __init__(self, tokenizer, data_dir, split, prefix_size, tokenizer_type = 'GPT2', is_settingnum_3 = False, variable_length = False) :  # split = 'development' or 'evaluation'
         super(ClothoDataset, self).__init__()
         
         self.SAMPLE_RATE = 16000
+        self.variable_length = variable_length # no zero padding, clips are padded per batch (util.collate_variable_length)
         
         self.change_sampling_rate = torchaudio.transforms.Resample(self.SAMPLE_RATE, 16000)
         
         self.split = split
+        self.set_length = 30
+        self.is_settingnum_3 = is_settingnum_3 # audio compressed to 10s
         
         self.audio_files_dir = data_dir + '/clotho_audio_files/' + split
         
-        csv_file_path = data_dir + '/clotho_csv_files/' + 'clotho_captions_' + split + '.csv'
+        # audio files and their 5 normalized captions (DatasetManifest.py)
+        manifest = get_clotho_manifest(data_dir, split)
         
-        audio_file_list = os.listdir(self.audio_files_dir)
+        # waveforms in memory-mapped files (FeatureCache.get_pcm_store), decoded once for all runs. 
+        # Slicing, padding and compression are applied in load_audio.
+        self.pcm_store = get_pcm_store(data_dir + '/' + split + '_pcm.bin', 
+                                       {file : self.audio_files_dir + '/' + file for file in manifest['file_list']})
         
         self.audio_name_list = []
-        self.audio_file_list = []
-        self.token_list = []
         self.caption_list_for_test = []
+        caption_list_for_train = []
         
-        csv_file = pd.read_csv(csv_file_path)
-        
-        for file in tqdm(audio_file_list, desc = 'get dataset...') :
-           
-            audio_file_full_path = self.audio_files_dir + '/' + file
-            audio_file, _ = torchaudio.load(audio_file_full_path)
+        for file, captions in tqdm(zip(manifest['file_list'], manifest['caption_lists']), desc = 'get dataset...', total = len(manifest['file_list'])) :
             
-            if is_settingnum_3 == False :
-                audio_file = audio_file.squeeze(0)
-                # slicing or padding based on set_length
-                set_length = 30
-
-                # slicing
-                if audio_file.shape[0] > (self.SAMPLE_RATE * set_length) :
-                    audio_file = audio_file[:self.SAMPLE_RATE * set_length]
-                # zero padding
-                if audio_file.shape[0] < (self.SAMPLE_RATE * set_length) :
-                    pad_len = (self.SAMPLE_RATE * set_length) - audio_file.shape[0]
-                    pad_val = torch.zeros(pad_len)
-                    audio_file = torch.cat((audio_file, pad_val), dim=0)
-            else :
-                 audio_file = self.compress_audio(audio_file).squeeze(0)
-            
-            for i in range(5) :
+            for caption in captions :
                 
-                self.audio_file_list.append(audio_file)
                 self.audio_name_list.append(file)
-                sentence_str = 'caption_' + str(i + 1)
-                caption = csv_file[csv_file['file_name'] == file][sentence_str].item()
-
-                caption = caption.lower()    
-                
-                caption = caption.replace(',', ' , ') 
-                caption = re.sub(' +', ' ', caption)
-                caption = caption.replace(' ,', ',')
-                caption = re.sub(r'[.]', '', caption)
-                
-                caption = caption.strip()
-                caption += '.'
                 
                 if split != 'development' :
                     self.caption_list_for_test.append(caption)
                 elif split == 'development' : 
-                    if tokenizer_type == 'GPT2' :
-                        tokens = tokenizer(caption)['input_ids']
-                    else :
-                        tokens = tokenizer.encode(caption)
-
-                    self.token_list.append(torch.tensor(tokens))
+                    caption_list_for_train.append(caption)
 
                 
-        if split == 'development' :                           
-            self.all_len = torch.tensor([len(self.token_list[i]) for i in range(len(self.token_list))]).float()
+        if split == 'development' :
+            # all captions tokenized at once, or loaded from the cache of a previous run (TokenCache.py)
+            token_ids, offsets = get_caption_tokens(tokenizer, tokenizer_type, caption_list_for_train)
+            self.all_len = torch.from_numpy(np.diff(offsets)).float()
             self.max_seq_len = min(int(self.all_len.mean() + self.all_len.std() * 10), int(self.all_len.max()))
+            
+            # [num_captions, max_seq_len] and the caption lengths, the mask is built per batch (util.CaptionCollate)
+            self.token_matrix, self.token_lengths = get_token_matrix(token_ids, offsets, self.max_seq_len)
         self.prefix_length = prefix_size
+        
+        # encoder features or log-mel instead of audio, see set_feature_cache() and set_logmel_store()
+        self.feature_cache = None
+        self.logmel_store = None
+        self.feature_cache_name = 'Clotho_' + split
+        if is_settingnum_3 == True :
+            self.feature_cache_name += '_compressed'
             
     def __len__(self):
        
-        return len(self.audio_file_list)
+        return len(self.audio_name_list)
+    
+    def get_clip_name(self, item: int) :
+        return self.audio_name_list[item]
     
-    def pad_tokens(self, item: int):
-        tokens = self.token_list[item].clone().detach()
-        padding = self.max_seq_len - tokens.shape[0]
-        if padding > 0:
-            tokens = torch.cat((tokens, torch.zeros(padding, dtype=torch.int64) - 1))
-            self.token_list[item] = tokens
-        elif padding < 0:
-            tokens = tokens[:self.max_seq_len]
-            self.token_list[item] = tokens
-        mask = tokens.ge(0)  # mask is zero where we out of sequence
-        tokens[~mask] = 0
-        mask = mask.float()
-        mask = torch.cat((torch.ones(self.prefix_length), mask), dim=0)  # adding prefix mask
-        return tokens, mask
+    def get_file_name(self, item: int) :
+        return self.audio_name_list[item]
     
+    def set_feature_cache(self, feature_cache) :
+        # feature_cache : FeatureCache (FeatureCache.py) of the frozen encoder, or None to serve audio again
+        self.feature_cache = feature_cache
+    
+    def set_logmel_store(self, logmel_store) :
+        # logmel_store : log-mel of every clip (FeatureCache.build_logmel_store), or None to serve audio again
+        self.logmel_store = logmel_store
+    
+    def get_audio_length(self, item: int) :
+        # number of samples load_audio returns, without loading the audio
+        if self.is_settingnum_3 == True :
+            return self.SAMPLE_RATE * 10
+        if self.variable_length == False :
+            return self.SAMPLE_RATE * self.set_length
+        
+        num_samples = self.pcm_store.get_num_samples(self.audio_name_list[item])
+        return min(num_samples, self.SAMPLE_RATE * self.set_length)
+    
+    def load_audio(self, item: int) :
+        
+        audio_file = self.pcm_store[self.audio_name_list[item]]
+        
+        if self.is_settingnum_3 == True :
+            return self.compress_audio(audio_file)
+        
+        # slicing or padding based on set_length
+        
+        # slicing
+        if audio_file.shape[0] > (self.SAMPLE_RATE * self.set_length) :
+            audio_file = audio_file[:self.SAMPLE_RATE * self.set_length]
+        # zero padding
+        if audio_file.shape[0] < (self.SAMPLE_RATE * self.set_length) and self.variable_length == False :
+            pad_len = (self.SAMPLE_RATE * self.set_length) - audio_file.shape[0]
+            pad_val = torch.zeros(pad_len)
+            audio_file = torch.cat((audio_file, pad_val), dim=0)
+        
+        return audio_file
     
     def __getitem__(self, item: int) :
         
+        if self.feature_cache != None :
+            audio_file = self.feature_cache.get_features(self.get_clip_name(item)) # (temporal_feature, global_feature)
+        elif self.logmel_store != None :
+            audio_file = self.logmel_store[self.get_clip_name(item)].float() # [1, time_steps, mel_bins]
+        else :
+            audio_file = self.load_audio(item)
+        
         if self.split == 'development' : 
             
-            tokens, mask = self.pad_tokens(item)
-            return self.audio_file_list[item], tokens, mask, self.audio_name_list[item]
+            # (audio, tokens, token_length, file name), util.CaptionCollate adds the mask
+            return audio_file, self.token_matrix[item], self.token_lengths[item], self.audio_name_list[item]
         else :
-            return self.audio_file_list[item], self.caption_list_for_test[item], self.audio_name_list[item]
\ No newline at end of file
+            return audio_file, self.caption_list_for_test[item], self.audio_name_list[item]
\ No newline at end of file
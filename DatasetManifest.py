@@ -0,0 +1,116 @@
+import os
+import pickle
+
+import pandas as pd
+
+# Manifest of a dataset split : the audio files and their normalized captions.
+#
+# The datasets used to look up the captions of every audio file with a boolean scan of the whole CSV, so building
+# a split took O(files x rows). The manifest groups the CSV once (normalize_captions is vectorized over the column),
+# then it is saved next to the split and later runs load it instead of reading the CSV.
+# It is rebuilt when the CSV or the audio directory is modified (mtime), e.g. files are added or removed.
+#
+# <data_dir>/<split>_manifest.pickle : {'file_list' : [file name, ...], 'caption_lists' : [[caption, ...], ...]}
+#     file_list is in the order of os.listdir(<audio directory>), caption_lists[i] are the captions of file_list[i]
+#     in the order of the CSV (AudioCaps : 1 per train clip / 5 per test clip, Clotho : caption_1 ... caption_5)
+
+MANIFEST_VERSION = 1 # to be increased when normalize_captions or the manifest's format changes
+
+
+def normalize_captions(captions) :
+    # captions : pd.Series of str. lower case, ' , ' -> ', ', no '.', single spaces, then a final '.'
+    captions = captions.str.lower()
+
+    captions = captions.str.replace(',', ' , ', regex=False)
+    captions = captions.str.replace(' +', ' ', regex=True)
+    captions = captions.str.replace(' ,', ',', regex=False)
+    captions = captions.str.replace('.', '', regex=False)
+
+    return captions.str.strip() + '.'
+
+
+def get_source_mtimes(source_path_list) :
+    return [os.path.getmtime(source_path) for source_path in source_path_list]
+
+
+def load_manifest(manifest_path, source_path_list) :
+    # None if there is no manifest or it is older than its sources
+    if os.path.exists(manifest_path) == False :
+        return None
+
+    with open(manifest_path, 'rb') as f :
+        manifest_file = pickle.load(f)
+
+    if manifest_file['version'] != MANIFEST_VERSION or manifest_file['source_mtimes'] != get_source_mtimes(source_path_list) :
+        return None
+
+    return manifest_file['manifest']
+
+
+def save_manifest(manifest_path, manifest, source_path_list) :
+    manifest_file = {'version' : MANIFEST_VERSION,
+                     'source_mtimes' : get_source_mtimes(source_path_list),
+                     'manifest' : manifest}
+
+    # written to a temporary file first, so a manifest is always complete
+    with open(manifest_path + '.tmp', 'wb') as f :
+        pickle.dump(manifest_file, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def build_audiocaps_manifest(csv_file_path, audio_dir) :
+    csv_file = pd.read_csv(csv_file_path)
+    csv_file['caption'] = normalize_captions(csv_file['caption'])
+
+    # file's name = youtube_id
+    caption_dict = csv_file.groupby('youtube_id', sort=False)['caption'].agg(list).to_dict()
+
+    file_list = [file for file in os.listdir(audio_dir) if file[-3:] == 'wav']
+
+    return {'file_list' : file_list,
+            'caption_lists' : [caption_dict.get(file[:-4], []) for file in file_list]}
+
+
+def build_clotho_manifest(csv_file_path, audio_dir) :
+    csv_file = pd.read_csv(csv_file_path)
+
+    sentence_str_list = ['caption_' + str(i + 1) for i in range(5)]
+    for sentence_str in sentence_str_list :
+        csv_file[sentence_str] = normalize_captions(csv_file[sentence_str])
+
+    caption_dict = dict(zip(csv_file['file_name'], csv_file[sentence_str_list].values.tolist()))
+
+    file_list = os.listdir(audio_dir)
+
+    # every audio file has a row in the CSV (KeyError otherwise)
+    return {'file_list' : file_list,
+            'caption_lists' : [caption_dict[file] for file in file_list]}
+
+
+def get_manifest(manifest_path, csv_file_path, audio_dir, build_function) :
+    # load the manifest of a split, or build and save it
+    source_path_list = [csv_file_path, audio_dir]
+
+    manifest = load_manifest(manifest_path, source_path_list)
+
+    if manifest == None :
+        manifest = build_function(csv_file_path, audio_dir)
+        save_manifest(manifest_path, manifest, source_path_list)
+        print("save dataset manifest :", manifest_path)
+
+    return manifest
+
+
+def get_audiocaps_manifest(data_dir, split) :
+    # split = 'train' or 'test', files in <data_dir>/<split>/ and captions in <data_dir>/<split>/<split>.csv
+    audio_dir = data_dir + '/' + split + '/'
+
+    return get_manifest(data_dir + '/' + split + '_manifest.pickle', audio_dir + split + '.csv',
+                        audio_dir, build_audiocaps_manifest)
+
+
+def get_clotho_manifest(data_dir, split) :
+    # split = 'development' or 'evaluation'
+    return get_manifest(data_dir + '/' + split + '_manifest.pickle',
+                        data_dir + '/clotho_csv_files/' + 'clotho_captions_' + split + '.csv',
+                        data_dir + '/clotho_audio_files/' + split, build_clotho_manifest)
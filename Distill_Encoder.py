@@ -0,0 +1,92 @@
+import torch
+import copy
+import os
+import sys
+
+# custom
+from util import *
+from AAC_Prefix.AAC_Prefix import * # network
+from AAC_Prefix.PANNs.CNN14 import get_student_encoder
+from Train import Train_StudentEncoder, eval_model
+from Quantization import get_model_size, measure_encoder_latency
+from terminaltables import AsciiTable
+
+# Knowledge distillation of the audio encoder of a model in the paper's table : a slim Cnn14 (Cnn14_Student)
+# learns the temporal and global features of the model's Cnn14 on the training split, then caption quality,
+# encoder latency (CPU, batch size 1) and encoder size are compared with the teacher.
+# The student is saved in Params_in_Table and used with
+# get_model_in_table(table_num, setting_num, device, student_encoder_params_path = <saved path>).
+
+TRAIN_BATCH_SIZE = 32
+TEST_BATCH_SIZE = 5
+
+epochs = 30
+LR = 1e-3
+
+argv_num = 1 + 2
+
+if len(sys.argv) != argv_num :
+    print("you should write 'table_num' and 'setting_num'!")
+    exit()
+
+table_num = int(sys.argv[1])
+setting_num = int(sys.argv[2])
+
+USE_CUDA = torch.cuda.is_available() 
+device = torch.device('cuda' if USE_CUDA else 'cpu')
+
+prefix_size = 15 + 11 # temporal_prefix_size + global_prefix_size of get_model_in_table
+
+if setting_num == 3 :
+    is_settingnum_3 = True
+else :
+    is_settingnum_3 = False
+
+if setting_num == 1 :
+    tokenizer_type = 'Custom'
+else :
+    tokenizer_type = 'GPT2'
+
+model = get_model_in_table(table_num, setting_num, device)
+teacher = model.audio_encoder
+
+# training split of the dataset the model was trained on
+if model.Dataset == 'Clotho' :
+    train_dataloader = CreateDataloader(model.tokenizer, './Clotho', TRAIN_BATCH_SIZE, 'development', prefix_size, 
+                                        is_TrainDataset = True, tokenizer_type = tokenizer_type)
+else :
+    train_dataloader = CreateDataloader(model.tokenizer, './AudioCaps', TRAIN_BATCH_SIZE, 'train', prefix_size, 
+                                        is_TrainDataset = True, tokenizer_type = tokenizer_type)
+
+# evaluation split of the table
+if table_num == 1 :
+    Dataset = 'Clotho'
+    test_dataloader = CreateDataloader(model.tokenizer, './Clotho', TEST_BATCH_SIZE, 'evaluation', prefix_size,
+                                       is_TrainDataset = False, tokenizer_type = tokenizer_type, is_settingnum_3 = is_settingnum_3)
+else :
+    Dataset = 'AudioCaps'
+    test_dataloader = CreateDataloader(model.tokenizer, './AudioCaps', TEST_BATCH_SIZE, 'test', prefix_size,
+                                       is_TrainDataset = False, tokenizer_type = tokenizer_type)
+
+MODEL_NAME = 'Table' + str(table_num) + '_' + str(setting_num) + '_student_encoder'
+os.makedirs("./Train_record/params_" + MODEL_NAME, exist_ok=True)
+
+student = get_student_encoder(teacher = teacher)
+student = Train_StudentEncoder(teacher, student, LR, train_dataloader, epochs, MODEL_NAME, device)
+
+student_encoder_path = 'Params_in_Table/' + MODEL_NAME + '.pt'
+torch.save(student.state_dict(), student_encoder_path)
+print("save student encoder :", student_encoder_path)
+
+result_table = [['encoder', 'SPIDEr', 'CIDEr', 'SPICE', 'encoder latency (ms/clip, CPU)', 'encoder size (MB)']]
+
+for encoder_name, audio_encoder in [('Cnn14', teacher), ('student', student)] :
+    model.audio_encoder = audio_encoder.to(device)
+    metrics = eval_model(model, test_dataloader, 0, encoder_name, True, device, Dataset)[0]
+    latency_sec = measure_encoder_latency(copy.deepcopy(audio_encoder).cpu(), test_dataloader)
+    
+    result_table.append([encoder_name, 
+                         round(metrics['spider']['score'], 4), round(metrics['cider']['score'], 4), round(metrics['spice']['score'], 4), 
+                         round(latency_sec * 1000, 1), round(get_model_size(audio_encoder) / 2**20, 1)])
+
+print(AsciiTable(result_table).table)
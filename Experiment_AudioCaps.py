@@ -89,6 +89,9 @@ print("vocab_size :", vocab_size)
 TEST_BATCH_SIZE = 5
 TRAIN_BATCH_SIZE = 75
 
+FEATURE_CACHE_DIR = None # frozen encoder's feature cache, off as in the paper (see README, 'Train the model')
+FRONTEND = 'torchlibrosa' # spectrogram of Cnn14 : 'torchlibrosa' (as in the paper) or 'fft' (faster, see README)
+
 if prefix_size == 0 :
     prefix_size = 26
 
@@ -114,11 +117,12 @@ model = get_AAC_Prefix(tokenizer,
                         vocab_size = vocab_size, Dataset = 'AudioCaps',
                         prefix_size_dict = prefix_size_dict, transformer_num_layers = transformer_num_layers, 
                         encoder_freeze = False, decoder_freeze = True,
-                        pretrain_fromAudioCaps = False, device = device)
+                        pretrain_fromAudioCaps = False, device = device, frontend = FRONTEND)
 
 Train(model, LR, train_dataloader, test_dataloader,
     epochs, model_name = MODEL_NAME, beam_search = True, device = device,
-    Dataset = 'AudioCaps', test_dataloader_other_dataset = test_dataloader_clotho)
+    Dataset = 'AudioCaps', test_dataloader_other_dataset = test_dataloader_clotho,
+    feature_cache_dir = FEATURE_CACHE_DIR)
 
 torch.cuda.empty_cache()
 #============Experiment================
\ No newline at end of file
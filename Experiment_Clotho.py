@@ -77,6 +77,9 @@ else :
 TEST_BATCH_SIZE = 5
 TRAIN_BATCH_SIZE = 55
 
+FEATURE_CACHE_DIR = None # frozen encoder's feature cache, off as in the paper (see README, 'Train the model')
+FRONTEND = 'torchlibrosa' # spectrogram of Cnn14 : 'torchlibrosa' (as in the paper) or 'fft' (faster, see README)
+
 test_dataloader  = CreateDataloader(tokenizer, data_dir, TEST_BATCH_SIZE, 'evaluation', prefix_size, is_TrainDataset = False, tokenizer_type = tokenizer_type)
 train_dataloader = CreateDataloader(tokenizer, data_dir, TRAIN_BATCH_SIZE, 'development', prefix_size, is_TrainDataset = True, tokenizer_type = tokenizer_type)
 
@@ -112,11 +115,12 @@ model = get_AAC_Prefix(tokenizer,
                         vocab_size = vocab_size, Dataset = 'Clotho',
                         prefix_size_dict = prefix_size_dict, transformer_num_layers = transformer_num_layers, 
                         encoder_freeze = False, decoder_freeze = True,
-                        pretrain_fromAudioCaps = True, device = device)
+                        pretrain_fromAudioCaps = True, device = device, frontend = FRONTEND)
 
 Train(model, LR, train_dataloader, test_dataloader,
     epochs, model_name = MODEL_NAME, beam_search = True, device = device,
-    Dataset = 'Clotho', test_dataloader_other_dataset = None)
+    Dataset = 'Clotho', test_dataloader_other_dataset = None,
+    feature_cache_dir = FEATURE_CACHE_DIR)
 
 torch.cuda.empty_cache()
 #============Experiment================
\ No newline at end of file
@@ -61,6 +61,9 @@ tokenizer_type = 'GPT2'
 
 TEST_BATCH_SIZE = 5
 TRAIN_BATCH_SIZE = 62
+
+FEATURE_CACHE_DIR = None # frozen encoder's feature cache, off as in the paper (see README, 'Train the model')
+FRONTEND = 'torchlibrosa' # spectrogram of Cnn14 : 'torchlibrosa' (as in the paper) or 'fft' (faster, see README)
 test_dataloader  = dataloader_FusionDataset(tokenizer, TEST_BATCH_SIZE, 'test', prefix_size, is_TrainDataset = False)
 train_dataloader = dataloader_FusionDataset(tokenizer, TRAIN_BATCH_SIZE, 'train', prefix_size, is_TrainDataset = True)
 
@@ -84,11 +87,12 @@ model = get_AAC_Prefix(tokenizer,
                         vocab_size = vocab_size, Dataset = 'AudioCaps',
                         prefix_size_dict = prefix_size_dict, transformer_num_layers = transformer_num_layers, 
                         encoder_freeze = False, decoder_freeze = True,
-                        pretrain_fromAudioCaps = False, device = device)
+                        pretrain_fromAudioCaps = False, device = device, frontend = FRONTEND)
 
 Train(model, LR, train_dataloader, test_dataloader,
     epochs, model_name = MODEL_NAME, beam_search = True, device = device,
-    Dataset = 'Fusion')
+    Dataset = 'Fusion',
+    feature_cache_dir = FEATURE_CACHE_DIR)
 
 torch.cuda.empty_cache()
 #============Experiment================
\ No newline at end of file
@@ -0,0 +1,337 @@
+import os
+import pickle
+import hashlib
+
+import numpy as np
+import torch
+import torchaudio
+from torch.utils.data import Dataset
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+# On-disk cache of the frozen audio encoder's outputs for training.
+#
+# Once the audio encoder (Cnn14) is frozen, its output for a clip never changes, so it is computed once in eval mode
+# and written to memory-mapped files. The training datasets then serve (temporal_feature, global_feature) instead of
+# the waveform, and AAC_Prefix skips the encoder.
+#
+# cache_dir/<dataset name>_<encoder weight hash>/
+#     temporal_feature.bin, temporal_feature_index.pickle : [2048, T, 2] per clip
+#     global_feature.bin,   global_feature_index.pickle   : [527] per clip
+#
+# Log-mel store : the STFT and mel filter bank of Cnn14 are frozen, so the log-mel spectrogram of every clip 
+# is computed once by an offline pass (Preprocess_LogmelStore.py) and stored in float16. 
+# The datasets then serve log-mels and Cnn14 starts from them (SpecAugment and the conv blocks still run).
+#
+# store_dir/<dataset name>_logmel.bin, <dataset name>_logmel_index.pickle : [1, time_steps, 64] per clip
+#
+# PCM store : the waveform of every clip (first channel, full length) decoded once and stored in int16 
+# (float32 for files that are not 16-bit), so a dataset keeps no audio in memory and the dataloader workers 
+# read the same mapped file.
+#
+# <store name>.bin, <store name>_index.pickle             : [num_samples] int16 per 16-bit clip
+# <store name>_float.bin, <store name>_float_index.pickle : [num_samples] float32 per other clip
+# <store name>_sources.pickle                             : version and (path, mtime, size) of the audio files
+
+class MemmapStore() :
+    # Arrays of one dtype in a flat binary file, with an index 'key -> (offset, shape)'.
+    # The index is written last, so a store whose index exists is complete.
+
+    def is_complete(self) :
+        return os.path.exists(self.index_path)
+
+    def open_writer(self) :
+        self.index = {}
+        self.write_offset = 0
+        self.writer = open(self.data_path, 'wb')
+
+    def write(self, key, array) :
+        array = np.ascontiguousarray(array, dtype=self.dtype)
+        self.writer.write(array.tobytes())
+        self.index[key] = (self.write_offset, array.shape)
+        self.write_offset += array.size
+
+    def close_writer(self) :
+        self.writer.close()
+        self.writer = None
+
+        with open(self.index_path + '.tmp', 'wb') as f :
+            pickle.dump({'dtype' : np.dtype(self.dtype).str, 'index' : self.index}, f)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    def load_index(self) :
+        with open(self.index_path, 'rb') as f :
+            index_file = pickle.load(f)
+        self.dtype = np.dtype(index_file['dtype'])
+        self.index = index_file['index']
+
+    def __contains__(self, key) :
+        return key in self.index
+
+    def __getitem__(self, key) :
+        # the file is mapped on first access, so each dataloader worker maps it in its own process
+        if self.data is None :
+            self.data = np.memmap(self.data_path, dtype=self.dtype, mode='r')
+
+        offset, shape = self.index[key]
+        array = self.data[offset : offset + int(np.prod(shape))].reshape(shape)
+
+        return torch.from_numpy(np.array(array))
+
+    def __getstate__(self) :
+        # np.memmap and open files are not sent to dataloader workers
+        state = self.__dict__.copy()
+        state['data'] = None
+        state['writer'] = None
+        return state
+
+    def __init__(self, data_path, dtype = np.float32) :
+
+        self.data_path = data_path
+        self.index_path = os.path.splitext(data_path)[0] + '_index.pickle'
+        self.dtype = dtype
+
+        self.index = {}
+        self.data = None
+        self.writer = None
+
+        if self.is_complete() :
+            self.load_index()
+
+
+def get_encoder_hash(audio_encoder) :
+    # weights and buffers (BatchNorm statistics) of the encoder
+    sha = hashlib.sha1()
+    for name, tensor in audio_encoder.state_dict().items() :
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().numpy().tobytes())
+    return sha.hexdigest()[:16]
+
+
+class ClipAudioDataset(Dataset) :
+    # one waveform per clip of a training dataset (several captions share a clip)
+
+    def __init__(self, dataset) :
+        super(ClipAudioDataset, self).__init__()
+
+        self.dataset = dataset
+
+        self.item_list = []
+        clip_name_set = set()
+        for item in range(len(dataset)) :
+            clip_name = dataset.get_clip_name(item)
+            if clip_name not in clip_name_set :
+                clip_name_set.add(clip_name)
+                self.item_list.append(item)
+
+    def __len__(self) :
+        return len(self.item_list)
+
+    def __getitem__(self, idx) :
+        item = self.item_list[idx]
+        return self.dataset.load_audio(item), self.dataset.get_clip_name(item)
+
+
+class FeatureCache() :
+
+    def get_features(self, clip_name) :
+        return self.temporal_store[clip_name], self.global_store[clip_name]
+
+    def is_complete(self) :
+        return self.temporal_store.is_complete() and self.global_store.is_complete()
+
+    def build(self, audio_encoder, dataset, device, batch_size = 32) :
+
+        dataloader = DataLoader(dataset=ClipAudioDataset(dataset),
+                                batch_size=batch_size,
+                                shuffle=False,
+                                num_workers=8,
+                                drop_last=False)
+
+        # eval mode : no SpecAugment / dropout, BatchNorm uses its running statistics
+        is_training = audio_encoder.training
+        audio_encoder.eval()
+
+        self.temporal_store.open_writer()
+        self.global_store.open_writer()
+
+        with torch.no_grad() :
+            for audio, clip_names in tqdm(dataloader, desc = 'cache encoder features...') :
+                temporal_feature, global_feature = audio_encoder(audio.to(device))
+
+                for clip_name, temporal, global_ in zip(clip_names, temporal_feature.cpu().numpy(), global_feature.cpu().numpy()) :
+                    self.temporal_store.write(clip_name, temporal)
+                    self.global_store.write(clip_name, global_)
+
+        self.temporal_store.close_writer()
+        self.global_store.close_writer()
+
+        audio_encoder.train(is_training)
+
+    def __init__(self, cache_dir, dataset_name, encoder_hash) :
+
+        self.cache_dir = os.path.join(cache_dir, dataset_name + '_' + encoder_hash)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.temporal_store = MemmapStore(os.path.join(self.cache_dir, 'temporal_feature.bin'))
+        self.global_store = MemmapStore(os.path.join(self.cache_dir, 'global_feature.bin'))
+
+
+def get_feature_cache(audio_encoder, dataset, cache_dir, device) :
+    # load the cache of 'dataset' for the current encoder weights, or build it
+
+    feature_cache = FeatureCache(cache_dir, dataset.feature_cache_name, get_encoder_hash(audio_encoder))
+
+    if feature_cache.is_complete() :
+        print("load feature cache :", feature_cache.cache_dir)
+    else :
+        feature_cache.build(audio_encoder, dataset, device)
+        print("save feature cache :", feature_cache.cache_dir)
+
+    return feature_cache
+
+
+def get_logmel_store(store_dir, dataset) :
+    # None if the offline pass has not been run for 'dataset'
+
+    logmel_store = MemmapStore(os.path.join(store_dir, dataset.feature_cache_name + '_logmel.bin'), np.float16)
+
+    if logmel_store.is_complete() == False :
+        print("no log-mel store :", logmel_store.data_path)
+        return None
+
+    return logmel_store
+
+
+def build_logmel_store(audio_encoder, dataset, store_dir, device, batch_size = 32) :
+    # audio_encoder : Cnn14, only its (frozen) log-mel frontend is used
+
+    os.makedirs(store_dir, exist_ok=True)
+    logmel_store = MemmapStore(os.path.join(store_dir, dataset.feature_cache_name + '_logmel.bin'), np.float16)
+
+    dataloader = DataLoader(dataset=ClipAudioDataset(dataset),
+                            batch_size=batch_size,
+                            shuffle=False,
+                            num_workers=8,
+                            drop_last=False)
+
+    logmel_store.open_writer()
+
+    with torch.no_grad() :
+        for audio, clip_names in tqdm(dataloader, desc = 'compute log-mel ' + dataset.feature_cache_name + '...') :
+            logmel = audio_encoder.get_logmel(audio.to(device)) # [batch_size, 1, time_steps, mel_bins]
+
+            for clip_name, clip_logmel in zip(clip_names, logmel.cpu().numpy()) :
+                logmel_store.write(clip_name, clip_logmel)
+
+    logmel_store.close_writer()
+    print("save log-mel store :", logmel_store.data_path)
+
+    return logmel_store
+
+
+PCM_STORE_VERSION = 1 # to be increased when the PCM store's format changes
+
+
+def is_pcm_16(audio_path) :
+    # 16-bit integer files are stored exactly in int16, other files (24-bit, float, compressed) in float32
+    audio_info = torchaudio.info(audio_path)
+    return audio_info.encoding == 'PCM_S' and audio_info.bits_per_sample == 16
+
+
+def get_source_stats(audio_path_dict) :
+    # key -> (path, mtime, size) of the audio files, a store is rebuilt when they change
+    return {key : (audio_path, os.path.getmtime(audio_path), os.path.getsize(audio_path)) 
+            for key, audio_path in audio_path_dict.items()}
+
+
+class AudioFileDataset(Dataset) :
+    # first channel of audio files, decoded by the dataloader workers
+
+    def __init__(self, audio_path_dict) :
+        super(AudioFileDataset, self).__init__()
+
+        self.key_list = list(audio_path_dict.keys())
+        self.audio_path_dict = audio_path_dict
+
+    def __len__(self) :
+        return len(self.key_list)
+
+    def __getitem__(self, idx) :
+        key = self.key_list[idx]
+        audio, _ = torchaudio.load(self.audio_path_dict[key])
+        return audio[0], key, is_pcm_16(self.audio_path_dict[key])
+
+
+class PCMStore() :
+    # Waveforms (first channel, full length) of audio files, as torchaudio.load gives them (float in [-1, 1]).
+    # 16-bit files are kept in an int16 MemmapStore (PCM / 32768 is exact), the other files in a float32 one. 
+    # <store name>_sources.pickle is written last with the version and the (path, mtime, size) of every source.
+
+    def is_valid(self, audio_path_dict) :
+        if os.path.exists(self.sources_path) == False or self.int16_store.is_complete() == False or self.float_store.is_complete() == False :
+            return False
+
+        with open(self.sources_path, 'rb') as f :
+            sources_file = pickle.load(f)
+
+        return sources_file['version'] == PCM_STORE_VERSION and sources_file['sources'] == get_source_stats(audio_path_dict)
+
+    def build(self, audio_path_dict) :
+
+        dataloader = DataLoader(dataset=AudioFileDataset(audio_path_dict),
+                                batch_size=None,
+                                shuffle=False,
+                                num_workers=8)
+
+        # the sources file is removed first, so an interrupted build is not taken for a valid store
+        if os.path.exists(self.sources_path) :
+            os.remove(self.sources_path)
+
+        self.int16_store.open_writer()
+        self.float_store.open_writer()
+
+        for audio, key, is_16bit in tqdm(dataloader, desc = 'store PCM ' + os.path.basename(self.int16_store.data_path) + '...') :
+            if is_16bit == True :
+                self.int16_store.write(key, (audio * 32768).round().numpy())
+            else :
+                self.float_store.write(key, audio.numpy())
+
+        self.int16_store.close_writer()
+        self.float_store.close_writer()
+
+        with open(self.sources_path + '.tmp', 'wb') as f :
+            pickle.dump({'version' : PCM_STORE_VERSION, 'sources' : get_source_stats(audio_path_dict)}, f)
+        os.replace(self.sources_path + '.tmp', self.sources_path)
+
+    def get_num_samples(self, key) :
+        if key in self.int16_store :
+            return self.int16_store.index[key][1][0]
+        return self.float_store.index[key][1][0]
+
+    def __getitem__(self, key) :
+        # float32 waveform [num_samples]
+        if key in self.int16_store :
+            return self.int16_store[key].float() / 32768
+        return self.float_store[key]
+
+    def __init__(self, store_path) :
+
+        self.int16_store = MemmapStore(store_path, np.int16)
+        self.float_store = MemmapStore(os.path.splitext(store_path)[0] + '_float.bin', np.float32)
+        self.sources_path = os.path.splitext(store_path)[0] + '_sources.pickle'
+
+
+def get_pcm_store(store_path, audio_path_dict) :
+    # PCMStore of the files of 'audio_path_dict' (key -> audio file path), built if it does not exist, 
+    # or if the files or the store's version changed
+
+    pcm_store = PCMStore(store_path)
+
+    if pcm_store.is_valid(audio_path_dict) :
+        return pcm_store
+
+    pcm_store.build(audio_path_dict)
+    print("save PCM store :", store_path)
+
+    return pcm_store
@@ -1,32 +1,19 @@
 import torch
 from torch.utils.data import Dataset
 from torch.utils.data import DataLoader
-import pandas as pd
 import torchaudio
 import os
 import numpy as np
 from tqdm import tqdm
 import pickle
-import re
 import string
 
+from FeatureCache import get_logmel_store
+from util import LengthBucketBatchSampler, get_collate_fn
+from ShardDataset import get_shard_dataset, ShardDataLoader
+from TokenCache import get_caption_tokens, get_token_matrix
+from DatasetManifest import get_audiocaps_manifest, get_clotho_manifest
 
-def fix_caption(caption) :
-    caption = caption.lower()
-                    
-    caption = caption.replace(',', ' , ') 
-
-    caption = re.sub(' +', ' ', caption)
-    caption = caption.replace(' ,', ',')
-             
-    caption = re.sub(r'[.]', '', caption)
-                
-    caption += '.'
-                   
-    caption = caption.strip()
-    
-    return caption
-    
 
 class FusionDataset(Dataset):
     
@@ -41,108 +28,108 @@ class FusionDataset(Dataset):
 
         return audio[compress_idx_list]
     
-    def __init__(self, tokenizer, split, prefix_size) :  # split = 'train' or 'test'
+    def __init__(self, tokenizer, split, prefix_size, variable_length = False) :  # split = 'train' or 'test'
         super(FusionDataset, self).__init__()
         
         self.SAMPLE_RATE = 16000
         self.split = split
+        self.variable_length = variable_length # AudioCaps clips are not zero padded, see collate_variable_length (util.py)
         
         self.audiocaps_dir = './AudioCaps/'
         self.clotho_dir = './Clotho/'
         
+        # audio files and their normalized captions (DatasetManifest.py)
         if split == 'train' :
-            audiocaps_csv_file = pd.read_csv(self.audiocaps_dir + 'train/train.csv')
-            clotho_csv_file    = pd.read_csv(self.clotho_dir + 'clotho_csv_files/clotho_captions_development.csv')
+            audiocaps_manifest = get_audiocaps_manifest('./AudioCaps', 'train')
+            clotho_manifest    = get_clotho_manifest('./Clotho', 'development')
             
             audiocaps_full_path_prefix = './AudioCaps/train/'
-            
-            audiocaps_audio_file_list = os.listdir(self.audiocaps_dir + 'train')
-            clotho_audio_file_list = os.listdir(self.clotho_dir + 'clotho_audio_files/development')
-            
             clotho_full_path_prefix = './Clotho/clotho_audio_files/development/'
             
         else :
-            audiocaps_csv_file = pd.read_csv(self.audiocaps_dir + 'test/test.csv')
-            clotho_csv_file    = pd.read_csv(self.clotho_dir + 'clotho_csv_files/clotho_captions_evaluation.csv')
+            audiocaps_manifest = get_audiocaps_manifest('./AudioCaps', 'test')
+            clotho_manifest    = get_clotho_manifest('./Clotho', 'evaluation')
             
             audiocaps_full_path_prefix = './AudioCaps/test/'
-            
-            audiocaps_audio_file_list = os.listdir(self.audiocaps_dir + 'test')
-            clotho_audio_file_list = os.listdir(self.clotho_dir + 'clotho_audio_files/evaluation')
-            
             clotho_full_path_prefix = './Clotho/clotho_audio_files/evaluation/'
         
         self.path_list = []
         self.file_name_list = []
-        self.token_list = []
         self.caption_list_for_test = []
+        caption_list_for_train = []
                      
         
-        for file in tqdm(clotho_audio_file_list, desc = 'get dataset from clotho...') :
+        for file, captions in tqdm(zip(clotho_manifest['file_list'], clotho_manifest['caption_lists']), 
+                                   desc = 'get dataset from clotho...', total = len(clotho_manifest['file_list'])) :
             
             audio_full_path = clotho_full_path_prefix + file
             
-            for i in range(5) :
+            for caption in captions :
                 self.path_list.append(audio_full_path)
                 self.file_name_list.append(file)
                 
-                sentence_str = 'caption_' + str(i + 1)
-                
-                caption = clotho_csv_file[clotho_csv_file['file_name'] == file][sentence_str].item()
-        
-                caption = fix_caption(caption)
-                
                 if split != 'train' :
                     self.caption_list_for_test.append(caption)
                 else :
-                    tokens = tokenizer(caption)['input_ids']
-                    self.token_list.append(torch.tensor(tokens))
+                    caption_list_for_train.append(caption)
                     
-        for file in tqdm(audiocaps_audio_file_list, desc = 'get dataset from audiocaps...') :
-            if file[-3:] == 'wav' :
-                file_row_in_csv = audiocaps_csv_file[audiocaps_csv_file['youtube_id'] == file[:-4]]
+        for file, captions in tqdm(zip(audiocaps_manifest['file_list'], audiocaps_manifest['caption_lists']), 
+                                   desc = 'get dataset from audiocaps...', total = len(audiocaps_manifest['file_list'])) :
+            for caption in captions :
                 
-                captions = file_row_in_csv['caption'].to_list() 
-                for caption in captions :
-                    
-                    self.path_list.append(audiocaps_full_path_prefix + file)
-                    self.file_name_list.append(file)
-                    
-                    caption = fix_caption(caption)
-                    
-                    if split != 'train' :
-                        self.caption_list_for_test.append(caption)
-                    else :
-                        tokens = tokenizer(caption)['input_ids']
-                        self.token_list.append(torch.tensor(tokens))
+                self.path_list.append(audiocaps_full_path_prefix + file)
+                self.file_name_list.append(file)
+                
+                if split != 'train' :
+                    self.caption_list_for_test.append(caption)
+                else :
+                    caption_list_for_train.append(caption)
             
         
-        if split == 'train' :          
-            self.all_len = torch.tensor([len(self.token_list[i]) for i in range(len(self.token_list))]).float()
+        if split == 'train' :
+            # all captions tokenized at once with GPT2's tokenizer, or loaded from the cache of a previous run (TokenCache.py)
+            token_ids, offsets = get_caption_tokens(tokenizer, 'GPT2', caption_list_for_train)
+            self.all_len = torch.from_numpy(np.diff(offsets)).float()
             self.max_seq_len = min(int(self.all_len.mean() + self.all_len.std() * 10), int(self.all_len.max()))
+            
+            # [num_captions, max_seq_len] and the caption lengths, the mask is built per batch (util.CaptionCollate)
+            self.token_matrix, self.token_lengths = get_token_matrix(token_ids, offsets, self.max_seq_len)
         self.prefix_length = prefix_size # audio_prefix_length + semantic_prefix_length
+        
+        # encoder features or log-mel instead of audio, see set_feature_cache() and set_logmel_store()
+        self.feature_cache = None
+        self.logmel_store = None
+        self.feature_cache_name = 'Fusion_' + split
             
     def __len__(self):
        
         return len(self.path_list)
     
-    def pad_tokens(self, item: int):
-        tokens = self.token_list[item].clone().detach()
-        padding = self.max_seq_len - tokens.shape[0]
-        if padding > 0:
-            tokens = torch.cat((tokens, torch.zeros(padding, dtype=torch.int64) - 1))
-            self.token_list[item] = tokens
-        elif padding < 0:
-            tokens = tokens[:self.max_seq_len]
-            self.token_list[item] = tokens
-        mask = tokens.ge(0)  # mask is zero where we out of sequence
-        tokens[~mask] = 0
-        mask = mask.float()
-        mask = torch.cat((torch.ones(self.prefix_length), mask), dim=0)  # adding prefix mask
-        return tokens, mask
+    def get_clip_name(self, item: int) :
+        # file names of Clotho and AudioCaps are kept apart
+        return self.path_list[item]
     
+    def get_file_name(self, item: int) :
+        return self.file_name_list[item]
     
-    def __getitem__(self, item: int) :
+    def set_feature_cache(self, feature_cache) :
+        # feature_cache : FeatureCache (FeatureCache.py) of the frozen encoder, or None to serve audio again
+        self.feature_cache = feature_cache
+    
+    def set_logmel_store(self, logmel_store) :
+        # logmel_store : log-mel of every clip (FeatureCache.build_logmel_store), or None to serve audio again
+        self.logmel_store = logmel_store
+    
+    def get_audio_length(self, item: int) :
+        # number of samples load_audio returns, without loading the audio
+        set_length = 10
+        
+        if 'AudioCaps' in self.path_list[item] and self.variable_length == True :
+            return min(torchaudio.info(self.path_list[item]).num_frames, self.SAMPLE_RATE * set_length)
+        
+        return self.SAMPLE_RATE * set_length
+    
+    def load_audio(self, item: int) :
         
         audio_file, _ = torchaudio.load(self.path_list[item])
         audio_file = audio_file[0,:] 
@@ -154,25 +141,34 @@ class FusionDataset(Dataset):
             if audio_file.size()[0] > (self.SAMPLE_RATE * set_length) :
                 audio_file = audio_file[:self.SAMPLE_RATE * set_length]
             # zero padding
-            if audio_file.size()[0] < (self.SAMPLE_RATE * set_length) :
+            if audio_file.size()[0] < (self.SAMPLE_RATE * set_length) and self.variable_length == False :
                 pad_len = (self.SAMPLE_RATE * set_length) - audio_file.shape[0]
                 pad_val = torch.zeros(pad_len)
                 audio_file = torch.cat((audio_file, pad_val), dim=0)
         else :
             audio_file = self.compress_audio(audio_file)
         
+        return audio_file
+    
+    def __getitem__(self, item: int) :
+        
+        if self.feature_cache != None :
+            audio_file = self.feature_cache.get_features(self.get_clip_name(item)) # (temporal_feature, global_feature)
+        elif self.logmel_store != None :
+            audio_file = self.logmel_store[self.get_clip_name(item)].float() # [1, time_steps, mel_bins]
+        else :
+            audio_file = self.load_audio(item)
+        
         if self.split == 'train' :
-            tokens, mask = self.pad_tokens(item)
-            return audio_file, tokens, mask, self.file_name_list[item]
+            # (audio, tokens, token_length, file name), util.CaptionCollate adds the mask
+            return audio_file, self.token_matrix[item], self.token_lengths[item], self.file_name_list[item]
         else :
             return audio_file, self.caption_list_for_test[item], self.file_name_list[item]
             
             
     
 
-def dataloader_FusionDataset(tokenizer, batch_size, split, prefix_size, is_TrainDataset = False) :
-    
-    dataset = FusionDataset(tokenizer, split, prefix_size)
+def dataloader_FusionDataset(tokenizer, batch_size, split, prefix_size, is_TrainDataset = False, logmel_store_dir = None, variable_length = False, shard_dir = None) :
     
     if is_TrainDataset == True :
         is_shuffle = True
@@ -182,10 +178,38 @@ def dataloader_FusionDataset(tokenizer, batch_size, split, prefix_size, is_Train
         is_drop_last = False
     
     cpu_core_num = 8
-    dataloader = DataLoader(dataset=dataset,
-                      batch_size=batch_size,
-                      shuffle=is_shuffle,
-                      num_workers=cpu_core_num,
-                      drop_last=is_drop_last)
+    
+    collate_fn = get_collate_fn(split == 'train', prefix_size, variable_length)
+    
+    # shard_dir : see CreateDataloader (util.py)
+    if shard_dir != None :
+        dataset = get_shard_dataset(shard_dir, 'Fusion_' + split, 'GPT2', prefix_size, shuffle = is_shuffle, variable_length = variable_length)
+        if dataset != None :
+            return ShardDataLoader(dataset=dataset,
+                                   batch_size=batch_size,
+                                   num_workers=cpu_core_num,
+                                   drop_last=is_drop_last,
+                                   collate_fn=collate_fn)
+    
+    dataset = FusionDataset(tokenizer, split, prefix_size, variable_length = variable_length)
+    
+    # precomputed log-mel (Preprocess_LogmelStore.py) instead of audio, if the store exists
+    if logmel_store_dir != None and variable_length == False :
+        dataset.set_logmel_store(get_logmel_store(logmel_store_dir, dataset))
+    
+    # variable_length : see CreateDataloader (util.py)
+    if variable_length == True and is_TrainDataset == True :
+        length_list = [dataset.get_audio_length(item) for item in range(len(dataset))]
+        dataloader = DataLoader(dataset=dataset,
+                          batch_sampler=LengthBucketBatchSampler(length_list, batch_size, shuffle=is_shuffle, drop_last=is_drop_last),
+                          num_workers=cpu_core_num,
+                          collate_fn=collate_fn)
+    else :
+        dataloader = DataLoader(dataset=dataset,
+                          batch_size=batch_size,
+                          shuffle=is_shuffle,
+                          num_workers=cpu_core_num,
+                          drop_last=is_drop_last,
+                          collate_fn=collate_fn)
     
     return dataloader
\ No newline at end of file
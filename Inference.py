@@ -4,6 +4,7 @@ import sys
 # custom
 from util import *
 from AAC_Prefix.AAC_Prefix import * # network
+from AAC_Prefix.LongForm import caption_long_audio # long-form captioning
 from Train import *
     
 TEST_BATCH_SIZE = 5
@@ -13,13 +14,14 @@ device = torch.device('cuda:0' if USE_CUDA else 'cpu')
 
 argv_num = 1 + 3
 
-if len(sys.argv) != argv_num :
-    print("you should write 'table_num', 'setting_num' and 'audio file path'!")
+if len(sys.argv) != argv_num and not (len(sys.argv) == argv_num + 1 and sys.argv[4] == 'long') :
+    print("you should write 'table_num', 'setting_num' and 'audio file path'! (and 'long' for long-form audio)")
     exit()
 
 table_num = sys.argv[1]
 setting_num = sys.argv[2]
 audio_file_path = sys.argv[3]
+is_long_form = len(sys.argv) == argv_num + 1
 
 # table_num = 1 : Evaluation on Clotho
 # table_num = 2 : Evaluation on AudioCaps
@@ -35,6 +37,14 @@ else :
 
 model = get_model_in_table(table_num, setting_num, device)
 
+# long-form audio : captions of overlapping windows with timestamps (see AAC_Prefix/LongForm.py)
+if is_long_form == True :
+    window_sec = 30 if model.Dataset == 'Clotho' else 10 # length of the training clips
+    
+    for start_sec, end_sec, caption in caption_long_audio(model, audio_file_path, window_sec = window_sec, hop_sec = window_sec / 2) :
+        print("[%.2fs - %.2fs] %s" % (start_sec, end_sec, caption))
+    exit()
+
 
 # prepare audio input=========
 SAMPLE_RATE = 16000
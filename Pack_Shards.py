@@ -0,0 +1,57 @@
+import sys
+
+# custom
+from util import *
+from FusionDataset import FusionDataset
+from ShardDataset import write_shards, get_shard_dir
+from transformers import GPT2Tokenizer
+
+# Packs the splits of a dataset into large shards of PCM, caption tokens and file names (see ShardDataset.py).
+# The dataloaders stream them when they get the same directory as 'shard_dir'.
+# The train splits hold the tokens of the tokenizer : 'Custom' packs them with the own vocabulary of the dataset.
+
+argv_num = 1 + 2
+
+if len(sys.argv) != argv_num and (len(sys.argv) != argv_num + 1 or sys.argv[3] != 'Custom') :
+    print("you should write 'dataset' (AudioCaps, Clotho, Fusion or all) and 'shard directory' (and 'Custom' for own vocabulary)!")
+    exit()
+
+dataset_name = sys.argv[1]
+shard_root_dir = sys.argv[2]
+
+if len(sys.argv) == argv_num + 1 :
+    tokenizer_type = 'Custom'
+else :
+    tokenizer_type = 'GPT2'
+
+prefix_size = 26
+
+def get_tokenizer(Dataset) :
+    if tokenizer_type == 'Custom' :
+        return tokenizer_forCustomVocab(Dataset = Dataset)
+    return GPT2Tokenizer.from_pretrained("gpt2")
+
+dataset_list = []
+
+if dataset_name == 'AudioCaps' or dataset_name == 'all' :
+    tokenizer = get_tokenizer('AudioCaps')
+    dataset_list.append(AudioCapsDataset(tokenizer, './AudioCaps', 'train', prefix_size, set_length = 10, tokenizer_type = tokenizer_type))
+    dataset_list.append(AudioCapsDataset(tokenizer, './AudioCaps', 'test', prefix_size, set_length = 10, tokenizer_type = tokenizer_type))
+    
+if dataset_name == 'Clotho' or dataset_name == 'all' :
+    tokenizer = get_tokenizer('Clotho')
+    dataset_list.append(ClothoDataset(tokenizer, './Clotho', 'development', prefix_size, tokenizer_type = tokenizer_type))
+    dataset_list.append(ClothoDataset(tokenizer, './Clotho', 'evaluation', prefix_size, tokenizer_type = tokenizer_type))
+    dataset_list.append(ClothoDataset(tokenizer, './Clotho', 'evaluation', prefix_size, tokenizer_type = tokenizer_type, is_settingnum_3 = True))
+    
+if (dataset_name == 'Fusion' or dataset_name == 'all') and tokenizer_type == 'GPT2' : # FusionDataset uses GPT2's tokenizer
+    tokenizer = get_tokenizer('AudioCaps')
+    dataset_list.append(FusionDataset(tokenizer, 'train', prefix_size))
+    dataset_list.append(FusionDataset(tokenizer, 'test', prefix_size))
+
+if len(dataset_list) == 0 :
+    print("dataset should be AudioCaps, Clotho, Fusion or all!")
+    exit()
+
+for dataset in dataset_list :
+    write_shards(dataset, get_shard_dir(shard_root_dir, dataset.feature_cache_name, tokenizer_type))
@@ -0,0 +1,55 @@
+import torch
+import sys
+
+# custom
+from util import *
+from FusionDataset import FusionDataset
+from FeatureCache import build_logmel_store
+from transformers import GPT2Tokenizer
+from AAC_Prefix.PANNs.CNN14 import Cnn14
+
+# Offline pass : log-mel spectrogram of every clip, stored in float16 (see FeatureCache.py).
+# The dataloaders use it when they get the same directory as 'logmel_store_dir'.
+
+argv_num = 1 + 2
+
+if len(sys.argv) != argv_num :
+    print("you should write 'dataset' (AudioCaps, Clotho, Fusion or all) and 'store directory'!")
+    exit()
+
+dataset_name = sys.argv[1]
+store_dir = sys.argv[2]
+
+USE_CUDA = torch.cuda.is_available() 
+device = torch.device('cuda' if USE_CUDA else 'cpu')
+
+prefix_size = 26
+
+# the log-mel frontend has no trained weights : same parameters as get_AAC_Prefix
+audio_encoder = Cnn14(sample_rate=16000, window_size=512, 
+            hop_size=320, mel_bins=64, fmin=50, fmax=14000, 
+            classes_num=527).to(device)
+
+tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
+
+dataset_list = []
+
+if dataset_name == 'AudioCaps' or dataset_name == 'all' :
+    dataset_list.append(AudioCapsDataset(tokenizer, './AudioCaps', 'train', prefix_size, set_length = 10))
+    dataset_list.append(AudioCapsDataset(tokenizer, './AudioCaps', 'test', prefix_size, set_length = 10))
+    
+if dataset_name == 'Clotho' or dataset_name == 'all' :
+    dataset_list.append(ClothoDataset(tokenizer, './Clotho', 'development', prefix_size))
+    dataset_list.append(ClothoDataset(tokenizer, './Clotho', 'evaluation', prefix_size))
+    dataset_list.append(ClothoDataset(tokenizer, './Clotho', 'evaluation', prefix_size, is_settingnum_3 = True))
+    
+if dataset_name == 'Fusion' or dataset_name == 'all' :
+    dataset_list.append(FusionDataset(tokenizer, 'train', prefix_size))
+    dataset_list.append(FusionDataset(tokenizer, 'test', prefix_size))
+
+if len(dataset_list) == 0 :
+    print("dataset should be AudioCaps, Clotho, Fusion or all!")
+    exit()
+
+for dataset in dataset_list :
+    build_logmel_store(audio_encoder, dataset, store_dir, device)
@@ -0,0 +1,169 @@
+import os
+import copy
+import time
+
+import torch
+from torch.utils.data import DataLoader, Subset
+from tqdm import tqdm
+from terminaltables import AsciiTable
+
+from FeatureCache import ClipAudioDataset
+from Train import eval_model
+from AAC_Prefix.PANNs.CNN14 import Cnn14, Cnn14_Student
+
+# Int8 post-training quantization for CPU inference.
+#
+# Static quantization of the audio encoder (Cnn14) : the BatchNorms are folded into the convs, observers record
+# the range of the activations on a sample of training clips (calibration), then the conv blocks run with int8
+# weights and activations. The log-mel frontend and the global head stay in float32, and the encoder still returns
+# (temporal_feature, global_feature), so it replaces model.audio_encoder as is.
+#
+# Dynamic quantization of the decoder (AAC_Prefix.quantize_decoder) : GPT2's linear layers and the language header,
+# which run at every decoding step, get int8 weights and quantize their input at run time (no calibration).
+
+
+def quantize_cnn14_static(audio_encoder, dataset, num_calibration_clips = 256, batch_size = 16, backend = 'x86') :
+    # int8 copy of 'audio_encoder' (the float32 encoder is not modified), calibrated on random clips of 'dataset'
+    quantized_encoder = copy.deepcopy(audio_encoder).cpu()
+    quantized_encoder.prepare_static_quantization(backend)
+
+    clip_dataset = ClipAudioDataset(dataset)
+    clip_idx_list = torch.randperm(len(clip_dataset))[:num_calibration_clips].tolist()
+    dataloader = DataLoader(dataset=Subset(clip_dataset, clip_idx_list),
+                            batch_size=batch_size,
+                            shuffle=False,
+                            num_workers=8,
+                            drop_last=False)
+
+    with torch.no_grad() :
+        for audio, _ in tqdm(dataloader, desc = 'calibrate int8 encoder...') :
+            quantized_encoder(audio)
+
+    return quantized_encoder.convert_static_quantization()
+
+
+def get_quantized_cnn14(params_path, backend = 'x86', student = False) :
+    # int8 encoder saved by Quantize_Cnn14.py (state_dict of a converted Cnn14, or of a converted Cnn14_Student
+    # with student = True : its channels are read from the saved int8 conv blocks)
+    state_dict = torch.load(params_path, map_location = 'cpu')
+
+    if student == True :
+        channels = tuple(state_dict['quantized_conv_blocks.' + str(i) + '.conv1.weight'].size()[0] for i in range(1, 7))
+        audio_encoder = Cnn14_Student(sample_rate=16000, window_size=512,
+                    hop_size=320, mel_bins=64, fmin=50, fmax=14000,
+                    classes_num=527, channels=channels)
+    else :
+        audio_encoder = Cnn14(sample_rate=16000, window_size=512,
+                    hop_size=320, mel_bins=64, fmin=50, fmax=14000,
+                    classes_num=527)
+
+    # same modules as the calibrated encoder, the observers' ranges are replaced by the saved scales / zero points
+    audio_encoder.prepare_static_quantization(backend)
+    audio_encoder.convert_static_quantization()
+    audio_encoder.load_state_dict(state_dict)
+
+    return audio_encoder
+
+
+def get_model_size(module) :
+    # bytes of the parameters and buffers, int8 weights included (packed params are in the state_dict)
+    total_bytes = 0
+    for tensor in module.state_dict().values() :
+        if isinstance(tensor, torch.Tensor) :
+            total_bytes += tensor.numel() * tensor.element_size()
+        elif isinstance(tensor, tuple) : # packed params : (weight, bias)
+            total_bytes += sum(t.numel() * t.element_size() for t in tensor if isinstance(t, torch.Tensor))
+    return total_bytes
+
+
+def measure_encoder_latency(audio_encoder, test_dataloader, num_clips = 50, warmup_clips = 3) :
+    # seconds per clip (batch size 1) on the first 'num_clips' clips of the test dataloader
+    audio_encoder.eval()
+    consumed_sec = 0.0
+
+    with torch.no_grad() :
+        for i, batch in enumerate(test_dataloader) :
+            if i == num_clips + warmup_clips :
+                break
+
+            audio = batch[0][0,:].unsqueeze(0).cpu()
+
+            start_time = time.time()
+            audio_encoder(audio)
+            if i >= warmup_clips :
+                consumed_sec += time.time() - start_time
+
+    return consumed_sec / max(1, min(num_clips, i + 1 - warmup_clips))
+
+
+def report_static_quantization(model, quantized_encoder, test_dataloader, Dataset, beam_search = True) :
+    # SPIDEr / CIDEr / SPICE on the evaluation split and encoder latency / size, float32 encoder against int8 encoder.
+    # The model runs on CPU (int8 kernels are CPU only).
+    model.to('cpu')
+    float_encoder = model.audio_encoder
+
+    result_table = [['encoder', 'SPIDEr', 'CIDEr', 'SPICE', 'encoder latency (ms/clip)', 'encoder size (MB)']]
+
+    for encoder_name, audio_encoder in [('float32', float_encoder), ('int8 static', quantized_encoder)] :
+        model.audio_encoder = audio_encoder
+        metrics = eval_model(model, test_dataloader, 0, encoder_name, beam_search, 'cpu', Dataset)[0]
+        latency_sec = measure_encoder_latency(audio_encoder, test_dataloader)
+
+        result_table.append([encoder_name,
+                             round(metrics['spider']['score'], 4), round(metrics['cider']['score'], 4), round(metrics['spice']['score'], 4),
+                             round(latency_sec * 1000, 1), round(get_model_size(audio_encoder) / 2**20, 1)])
+
+    model.audio_encoder = float_encoder
+
+    print(AsciiTable(result_table).table)
+
+    return result_table
+
+
+def measure_decoding_latency(model, test_dataloader, beam_search = True, num_clips = 50, warmup_clips = 3) :
+    # seconds per decoding step (one token of every beam) on the first 'num_clips' clips of the test dataloader,
+    # the audio encoder and the mapping networks are not timed
+    model.eval()
+    consumed_sec, step_count = 0.0, 0
+
+    with torch.no_grad() :
+        for i, batch in enumerate(test_dataloader) :
+            if i == num_clips + warmup_clips :
+                break
+
+            prefix_vectors = model.get_prefix_vectors(batch[0][0,:].unsqueeze(0).to(model.device))
+
+            start_time = time.time()
+            if beam_search == True :
+                steps = sum(1 for _ in model.generate_beam_steps(prefix_vectors))
+            else :
+                steps = sum(1 for _ in model.generate_steps(prefix_vectors))
+
+            if i >= warmup_clips :
+                consumed_sec += time.time() - start_time
+                step_count += steps
+
+    return consumed_sec / max(1, step_count)
+
+
+def report_dynamic_quantization(model, test_dataloader, Dataset, beam_search = True) :
+    # caption quality (eval_metrics.evaluate_metrics through eval_model) and latency per token
+    # of the float32 decoder against the int8 decoder (a quantized copy of 'model'), on CPU
+    model.to('cpu')
+    quantized_model = copy.deepcopy(model).quantize_decoder()
+
+    result_table = [['decoder', 'SPIDEr', 'CIDEr', 'SPICE', 'BLEU4', 'latency (ms/token)', 'GPT2 + header size (MB)']]
+
+    for decoder_name, decoder_model in [('float32', model), ('int8 dynamic', quantized_model)] :
+        metrics = eval_model(decoder_model, test_dataloader, 0, decoder_name, beam_search, 'cpu', Dataset)[0]
+        latency_sec = measure_decoding_latency(decoder_model, test_dataloader, beam_search)
+
+        result_table.append([decoder_name,
+                             round(metrics['spider']['score'], 4), round(metrics['cider']['score'], 4),
+                             round(metrics['spice']['score'], 4), round(metrics['bleu_4']['score'], 4),
+                             round(latency_sec * 1000, 2),
+                             round((get_model_size(decoder_model.gpt) + get_model_size(decoder_model.language_header)) / 2**20, 1)])
+
+    print(AsciiTable(result_table).table)
+
+    return result_table
@@ -0,0 +1,73 @@
+import torch
+import sys
+
+# custom
+from util import *
+from AAC_Prefix.AAC_Prefix import * # network
+from Quantization import quantize_cnn14_static, report_static_quantization
+
+# Int8 static quantization of the audio encoder of a model in the paper's table (see Quantization.py) :
+# calibration on training clips, then SPIDEr on the evaluation split with the float32 and the int8 encoder.
+# The int8 encoder is saved in Params_in_Table and loaded by Quantization.get_quantized_cnn14.
+# With 'student', the distilled encoder of Distill_Encoder.py is quantized instead of Cnn14
+# (loaded by Quantization.get_quantized_cnn14(..., student = True)).
+
+TEST_BATCH_SIZE = 5
+
+argv_num = 1 + 2
+
+if len(sys.argv) != argv_num and (len(sys.argv) != argv_num + 1 or sys.argv[3] != 'student') :
+    print("you should write 'table_num' and 'setting_num' (and 'student' for the distilled encoder)!")
+    exit()
+
+table_num = int(sys.argv[1])
+setting_num = int(sys.argv[2])
+
+is_student = len(sys.argv) == argv_num + 1
+
+# int8 kernels run on CPU
+device = torch.device('cpu')
+
+prefix_size = 15 + 11 # temporal_prefix_size + global_prefix_size of get_model_in_table
+
+if setting_num == 3 :
+    is_settingnum_3 = True
+else :
+    is_settingnum_3 = False
+
+if setting_num == 1 :
+    tokenizer_type = 'Custom'
+else :
+    tokenizer_type = 'GPT2'
+
+if is_student == True :
+    student_encoder_params_path = 'Params_in_Table/Table' + str(table_num) + '_' + str(setting_num) + '_student_encoder.pt'
+    model = get_model_in_table(table_num, setting_num, device, student_encoder_params_path = student_encoder_params_path)
+    encoder_name = 'int8_student_encoder'
+else :
+    model = get_model_in_table(table_num, setting_num, device)
+    encoder_name = 'int8_encoder'
+
+# calibration clips : training split of the dataset the model was trained on
+if model.Dataset == 'Clotho' :
+    calibration_dataset = ClothoDataset(model.tokenizer, './Clotho', 'development', prefix_size, tokenizer_type = tokenizer_type)
+else :
+    calibration_dataset = AudioCapsDataset(model.tokenizer, './AudioCaps', 'train', prefix_size, set_length = 10, tokenizer_type = tokenizer_type)
+
+# evaluation split of the table
+if table_num == 1 :
+    Dataset = 'Clotho'
+    test_dataloader = CreateDataloader(model.tokenizer, './Clotho', TEST_BATCH_SIZE, 'evaluation', prefix_size,
+                                       is_TrainDataset = False, tokenizer_type = tokenizer_type, is_settingnum_3 = is_settingnum_3)
+else :
+    Dataset = 'AudioCaps'
+    test_dataloader = CreateDataloader(model.tokenizer, './AudioCaps', TEST_BATCH_SIZE, 'test', prefix_size,
+                                       is_TrainDataset = False, tokenizer_type = tokenizer_type)
+
+quantized_encoder = quantize_cnn14_static(model.audio_encoder, calibration_dataset)
+
+quantized_encoder_path = 'Params_in_Table/Table' + str(table_num) + '_' + str(setting_num) + '_' + encoder_name + '.pt'
+torch.save(quantized_encoder.state_dict(), quantized_encoder_path)
+print("save int8 encoder :", quantized_encoder_path)
+
+report_static_quantization(model, quantized_encoder, test_dataloader, Dataset)
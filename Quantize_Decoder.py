@@ -0,0 +1,51 @@
+import torch
+import sys
+
+# custom
+from util import *
+from AAC_Prefix.AAC_Prefix import * # network
+from Quantization import report_dynamic_quantization
+
+# Int8 dynamic quantization of GPT2 and the language header of a model in the paper's table (see Quantization.py) :
+# caption quality on the evaluation split and latency per token, float32 decoder against int8 decoder.
+# For inference, the int8 decoder is get_model_in_table(table_num, setting_num, 'cpu', quantize_decoder = True).
+
+TEST_BATCH_SIZE = 5
+
+argv_num = 1 + 2
+
+if len(sys.argv) != argv_num :
+    print("you should write 'table_num' and 'setting_num'!")
+    exit()
+
+table_num = int(sys.argv[1])
+setting_num = int(sys.argv[2])
+
+# int8 kernels run on CPU
+device = torch.device('cpu')
+
+prefix_size = 15 + 11 # temporal_prefix_size + global_prefix_size of get_model_in_table
+
+if setting_num == 3 :
+    is_settingnum_3 = True
+else :
+    is_settingnum_3 = False
+
+if setting_num == 1 :
+    tokenizer_type = 'Custom'
+else :
+    tokenizer_type = 'GPT2'
+
+model = get_model_in_table(table_num, setting_num, device)
+
+# evaluation split of the table
+if table_num == 1 :
+    Dataset = 'Clotho'
+    test_dataloader = CreateDataloader(model.tokenizer, './Clotho', TEST_BATCH_SIZE, 'evaluation', prefix_size,
+                                       is_TrainDataset = False, tokenizer_type = tokenizer_type, is_settingnum_3 = is_settingnum_3)
+else :
+    Dataset = 'AudioCaps'
+    test_dataloader = CreateDataloader(model.tokenizer, './AudioCaps', TEST_BATCH_SIZE, 'test', prefix_size,
+                                       is_TrainDataset = False, tokenizer_type = tokenizer_type)
+
+report_dynamic_quantization(model, test_dataloader, Dataset)
@@ -0,0 +1,270 @@
+import os
+import math
+import pickle
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset
+from torch.utils.data import DataLoader
+from torch.utils.data import get_worker_info
+from tqdm import tqdm
+
+from FeatureCache import ClipAudioDataset
+
+# Sharded datasets : a split packed into a few large files (Pack_Shards.py), read sequentially instead of
+# one small wav file per sample (slow random I/O, above all on network filesystems).
+#
+# shard_dir/<dataset name>_<tokenizer type>/
+#     shard_00000.bin, shard_00000.pickle, ... : int16 PCM of 'clips_per_shard' clips (without zero padding) and
+#                                                their samples [(offset, num_samples, [(tokens or caption, file name), ...]), ...]
+#                                                (tokens : cut to max_seq_len, int32)
+#     shards.pickle                            : list of the shards and the split's metadata, written last
+#
+# ShardDataset streams the shards. Training (shuffle = True) : every epoch the shards are put in a new order, shared 
+# by the dataloader workers, and each worker reads a contiguous range of that order's samples (so the shards of a worker
+# change every epoch). The samples of each shard are shuffled, then go through a shuffle buffer that mixes consecutive shards.
+# Test (shuffle = False) : worker 'i' reads shard_list[i::num_workers] in order.
+# Each worker makes its own batches, so the dataloader's length is counted per worker (ShardDataLoader).
+# The samples are those of the dataset's __getitem__ (train : audio, tokens, token_length, file name / test : audio, caption, file name).
+
+
+def write_shards(dataset, shard_dir, clips_per_shard = 256) :
+    # dataset : AudioCapsDataset, ClothoDataset or FusionDataset. The train splits store the tokens of the dataset's tokenizer.
+    os.makedirs(shard_dir, exist_ok=True)
+
+    is_train = dataset.split == 'train' or dataset.split == 'development'
+
+    # the audio is stored without zero padding, ShardDataset pads it to the length of the dataset's clips
+    variable_length = dataset.variable_length
+    dataset.variable_length = False
+    padded_length = dataset.get_audio_length(0)
+    dataset.variable_length = True
+
+    item_list_dict = {} # clip name -> items of the clip (one per caption)
+    for item in range(len(dataset)) :
+        item_list_dict.setdefault(dataset.get_clip_name(item), []).append(item)
+
+    dataloader = DataLoader(dataset=ClipAudioDataset(dataset),
+                            batch_size=None,
+                            shuffle=False,
+                            num_workers=8)
+
+    shard_name_list = []
+    num_samples_list = []
+
+    def write_shard(clip_list, pcm_list) :
+        shard_name = 'shard_%05d' % len(shard_name_list)
+
+        with open(os.path.join(shard_dir, shard_name + '.bin'), 'wb') as f :
+            for pcm in pcm_list :
+                f.write(pcm.tobytes())
+        with open(os.path.join(shard_dir, shard_name + '.pickle'), 'wb') as f :
+            pickle.dump(clip_list, f)
+
+        shard_name_list.append(shard_name)
+        num_samples_list.append(sum(len(sample_list) for _, _, sample_list in clip_list))
+
+    clip_list, pcm_list, offset = [], [], 0
+
+    for audio, clip_name in tqdm(dataloader, desc = 'pack ' + dataset.feature_cache_name + '...') :
+        pcm = (audio * 32768).round().clamp(-32768, 32767).numpy().astype(np.int16)
+
+        sample_list = []
+        for item in item_list_dict[clip_name] :
+            if is_train == True :
+                tokens = dataset.token_matrix[item, :dataset.token_lengths[item]]
+                sample_list.append((tokens.numpy().astype(np.int32), dataset.get_file_name(item)))
+            else :
+                sample_list.append((dataset.caption_list_for_test[item], dataset.get_file_name(item)))
+
+        clip_list.append((offset, pcm.shape[0], sample_list))
+        pcm_list.append(pcm)
+        offset += pcm.shape[0]
+
+        if len(clip_list) == clips_per_shard :
+            write_shard(clip_list, pcm_list)
+            clip_list, pcm_list, offset = [], [], 0
+
+    if len(clip_list) > 0 :
+        write_shard(clip_list, pcm_list)
+
+    dataset.variable_length = variable_length
+
+    shard_index = {'shard_list' : shard_name_list,
+                   'num_samples_list' : num_samples_list,
+                   'is_train' : is_train,
+                   'padded_length' : padded_length,
+                   'max_seq_len' : dataset.max_seq_len if is_train == True else None}
+
+    with open(os.path.join(shard_dir, 'shards.pickle.tmp'), 'wb') as f :
+        pickle.dump(shard_index, f)
+    os.replace(os.path.join(shard_dir, 'shards.pickle.tmp'), os.path.join(shard_dir, 'shards.pickle'))
+
+    print("save shards :", shard_dir, "(" + str(len(shard_name_list)) + " shards)")
+
+
+class ShardDataset(IterableDataset) :
+
+    def __len__(self) :
+        return sum(self.num_samples_list)
+
+    def pad_tokens(self, tokens) :
+        # a row of the datasets' token_matrix and its length (util.CaptionCollate adds the mask)
+        tokens = tokens[:self.max_seq_len]
+        padded_tokens = torch.zeros(self.max_seq_len, dtype=torch.int64)
+        padded_tokens[:tokens.shape[0]] = torch.from_numpy(tokens)
+        return padded_tokens, torch.tensor(tokens.shape[0])
+
+    def get_num_samples_per_worker(self, num_workers) :
+        # num_workers = 0 : the main process reads every sample
+        num_workers = max(1, num_workers)
+        if self.shuffle == True :
+            # worker 'i' reads the samples [i * total // num_workers, (i + 1) * total // num_workers) of the epoch's shard order
+            total = sum(self.num_samples_list)
+            return [(worker_id + 1) * total // num_workers - worker_id * total // num_workers for worker_id in range(num_workers)]
+        # worker 'i' reads shard_list[i::num_workers]
+        return [sum(self.num_samples_list[worker_id::num_workers]) for worker_id in range(num_workers)]
+
+    def get_num_batches(self, batch_size, num_workers, drop_last) :
+        # every worker batches its own samples, so each one has an incomplete last batch (dropped with drop_last)
+        if drop_last == True :
+            return sum(num_samples // batch_size for num_samples in self.get_num_samples_per_worker(num_workers))
+        return sum(math.ceil(num_samples / batch_size) for num_samples in self.get_num_samples_per_worker(num_workers))
+
+    def get_epoch_seed(self) :
+        # the same seed in all the workers of an epoch, a new one every epoch
+        worker_info = get_worker_info()
+        if worker_info != None :
+            return worker_info.seed - worker_info.id # worker_info.seed = base seed of the epoch + worker id
+        return int(torch.empty((), dtype=torch.int64).random_().item())
+
+    def get_shard_ranges(self) :
+        # [(shard name, first sample, end sample), ...] of this worker for this epoch
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info == None else (worker_info.id, worker_info.num_workers)
+
+        if self.shuffle == False :
+            return [(shard_name, 0, num_samples) for shard_name, num_samples
+                    in zip(self.shard_list[worker_id::num_workers], self.num_samples_list[worker_id::num_workers])]
+
+        # the shards are reordered every epoch, then the workers split the samples of that order into contiguous ranges,
+        # so a worker reads other shards every epoch (a few whole shards and the ends of two others)
+        generator = torch.Generator().manual_seed(self.get_epoch_seed())
+        shard_order = torch.randperm(len(self.shard_list), generator=generator).tolist()
+
+        total = sum(self.num_samples_list)
+        begin, end = worker_id * total // num_workers, (worker_id + 1) * total // num_workers
+
+        shard_range_list = []
+        shard_begin = 0
+        for shard_idx in shard_order :
+            shard_end = shard_begin + self.num_samples_list[shard_idx]
+            if shard_begin < end and shard_end > begin :
+                shard_range_list.append((self.shard_list[shard_idx], max(begin, shard_begin) - shard_begin, min(end, shard_end) - shard_begin))
+            shard_begin = shard_end
+
+        return shard_range_list
+
+    def read_shard_samples(self, generator) :
+        # (int16 PCM, tokens or caption, file name) of this worker's samples, shuffled within each shard range
+        for shard_name, begin, end in self.get_shard_ranges() :
+            with open(os.path.join(self.shard_dir, shard_name + '.pickle'), 'rb') as f :
+                clip_list = pickle.load(f)
+
+            sample_list = [(offset, num_samples, sample) for offset, num_samples, clip_sample_list in clip_list
+                                                         for sample in clip_sample_list][begin:end]
+
+            # one sequential read of the clips of the range
+            pcm_begin = sample_list[0][0]
+            pcm_end = sample_list[-1][0] + sample_list[-1][1]
+            pcm = np.fromfile(os.path.join(self.shard_dir, shard_name + '.bin'), dtype=np.int16,
+                              count=pcm_end - pcm_begin, offset=pcm_begin * np.dtype(np.int16).itemsize)
+
+            if self.shuffle == True :
+                sample_list = [sample_list[i] for i in torch.randperm(len(sample_list), generator=generator).tolist()]
+
+            for offset, num_samples, (tokens_or_caption, file_name) in sample_list :
+                yield pcm[offset - pcm_begin : offset - pcm_begin + num_samples], tokens_or_caption, file_name
+
+    def shuffle_samples(self, sample_iterator, generator) :
+        # shuffle buffer : a batch mixes the samples of the last shards read, not only those of one shard
+        buffer = []
+        for sample in sample_iterator :
+            if len(buffer) < self.shuffle_buffer_size :
+                buffer.append(sample)
+                continue
+            i = int(torch.randint(len(buffer), (), generator=generator).item())
+            yield buffer[i]
+            buffer[i] = sample
+
+        for i in torch.randperm(len(buffer), generator=generator).tolist() :
+            yield buffer[i]
+
+    def __iter__(self) :
+
+        # the seed of a worker changes every epoch
+        worker_info = get_worker_info()
+        if worker_info != None :
+            generator = torch.Generator().manual_seed(worker_info.seed)
+        else :
+            generator = torch.Generator().manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+
+        sample_iterator = self.read_shard_samples(generator)
+        if self.shuffle == True :
+            sample_iterator = self.shuffle_samples(sample_iterator, generator)
+
+        for pcm, tokens_or_caption, file_name in sample_iterator :
+            audio_file = torch.from_numpy(pcm.astype(np.float32) / 32768)
+
+            # zero padding
+            if audio_file.shape[0] < self.padded_length and self.variable_length == False :
+                audio_file = torch.cat((audio_file, torch.zeros(self.padded_length - audio_file.shape[0])), dim=0)
+
+            if self.is_train == True :
+                tokens, token_length = self.pad_tokens(tokens_or_caption)
+                yield audio_file, tokens, token_length, file_name
+            else :
+                yield audio_file, tokens_or_caption, file_name
+
+    def __init__(self, shard_dir, prefix_size, shuffle = False, variable_length = False, shuffle_buffer_size = 512) :
+        super(ShardDataset, self).__init__()
+
+        self.shard_dir = shard_dir
+        self.prefix_length = prefix_size
+        self.shuffle = shuffle
+        self.shuffle_buffer_size = shuffle_buffer_size # samples (views of the shards read), with shuffle = True
+        self.variable_length = variable_length # no zero padding, clips are padded per batch (util.collate_variable_length)
+
+        with open(os.path.join(shard_dir, 'shards.pickle'), 'rb') as f :
+            shard_index = pickle.load(f)
+
+        self.shard_list = shard_index['shard_list']
+        self.num_samples_list = shard_index['num_samples_list']
+        self.is_train = shard_index['is_train']
+        self.padded_length = shard_index['padded_length']
+        self.max_seq_len = shard_index['max_seq_len']
+
+
+class ShardDataLoader(DataLoader) :
+    # DataLoader of a ShardDataset : its length is the number of batches the workers actually make
+    # (DataLoader counts the batches of the whole split, one incomplete batch at most),
+    # so e.g. the learning rate schedule of Train gets the real number of steps per epoch
+
+    def __len__(self) :
+        return self.dataset.get_num_batches(self.batch_size, self.num_workers, self.drop_last)
+
+
+def get_shard_dir(shard_root_dir, dataset_name, tokenizer_type) :
+    # dataset_name : feature_cache_name of the dataset (e.g. 'AudioCaps_train', 'Clotho_evaluation_compressed')
+    return os.path.join(shard_root_dir, dataset_name + '_' + tokenizer_type)
+
+
+def get_shard_dataset(shard_root_dir, dataset_name, tokenizer_type, prefix_size, shuffle = False, variable_length = False) :
+    # None if the split has not been packed (Pack_Shards.py)
+    shard_dir = get_shard_dir(shard_root_dir, dataset_name, tokenizer_type)
+
+    if os.path.exists(os.path.join(shard_dir, 'shards.pickle')) == False :
+        print("no shards :", shard_dir)
+        return None
+
+    return ShardDataset(shard_dir, prefix_size, shuffle = shuffle, variable_length = variable_length)
@@ -0,0 +1,91 @@
+import os
+import hashlib
+
+import numpy as np
+import torch
+from transformers.convert_slow_tokenizer import convert_slow_tokenizer
+
+# On-disk cache of the caption tokens of a training split.
+#
+# The captions are tokenized in one batched call (GPT2 : the fast (Rust) version of the tokenizer, custom vocabulary :
+# a word -> index dict) and the token ids are stored as one flat int32 array with the offsets of the captions.
+# The cache is keyed by the tokenizer (type and vocabulary hash) and the hash of the captions' text, so a later run
+# with the same captions and tokenizer loads it instead of tokenizing.
+#
+# cache_dir/<tokenizer type>_<vocabulary hash>_<captions hash>.npz : token_ids [total tokens], offsets [captions + 1]
+
+TOKEN_CACHE_DIR = './Train_record/token_cache'
+
+
+def get_text_hash(text_list) :
+    sha = hashlib.sha1()
+    for text in text_list :
+        sha.update(text.encode())
+        sha.update(b'\n')
+    return sha.hexdigest()[:16]
+
+
+def get_vocab_hash(tokenizer, tokenizer_type) :
+    if tokenizer_type == 'GPT2' :
+        vocab = sorted(tokenizer.get_vocab().items(), key=lambda item : item[1])
+        return get_text_hash([type(tokenizer).__name__] + [word for word, _ in vocab])
+    else :
+        return get_text_hash(tokenizer.vocab)
+
+
+def tokenize_captions(tokenizer, tokenizer_type, caption_list) :
+    # token ids of every caption, the same as tokenizer(caption)['input_ids'] / tokenizer.encode(caption)
+    if tokenizer_type == 'GPT2' :
+        if getattr(tokenizer, 'is_fast', False) == True :
+            return tokenizer(caption_list)['input_ids']
+
+        fast_tokenizer = convert_slow_tokenizer(tokenizer)
+        return [encoding.ids for encoding in fast_tokenizer.encode_batch(caption_list)]
+
+    else :
+        # tokenizer_forCustomVocab.encode with a dict instead of vocab.index (first index of a word)
+        word_to_index = {}
+        for index, word in enumerate(tokenizer.vocab) :
+            word_to_index.setdefault(word, index)
+
+        #  <eos> : 13
+        return [[word_to_index[word] for word in caption.split(' ')] + [13] for caption in caption_list]
+
+
+def get_caption_tokens(tokenizer, tokenizer_type, caption_list, cache_dir = TOKEN_CACHE_DIR) :
+    # (token_ids, offsets) : the tokens of caption_list[i] are token_ids[offsets[i] : offsets[i + 1]]
+    cache_path = os.path.join(cache_dir, tokenizer_type + '_' + get_vocab_hash(tokenizer, tokenizer_type) + '_' +
+                              get_text_hash(caption_list) + '.npz')
+
+    if os.path.exists(cache_path) :
+        cache_file = np.load(cache_path)
+        return cache_file['token_ids'], cache_file['offsets']
+
+    tokens_list = tokenize_captions(tokenizer, tokenizer_type, caption_list)
+
+    offsets = np.zeros(len(tokens_list) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(tokens) for tokens in tokens_list])
+    token_ids = np.fromiter((token for tokens in tokens_list for token in tokens), dtype=np.int32, count=int(offsets[-1]))
+
+    # written to a temporary file first, so a cache file is always complete
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_path + '.tmp', 'wb') as f :
+        np.savez(f, token_ids=token_ids, offsets=offsets)
+    os.replace(cache_path + '.tmp', cache_path)
+    print("save caption tokens :", cache_path)
+
+    return token_ids, offsets
+
+
+def get_token_matrix(token_ids, offsets, max_seq_len) :
+    # tokens of every caption padded with 0 / cut to max_seq_len : [num_captions, max_seq_len] (int64),
+    # and the number of tokens kept per caption [num_captions] (the mask is built per batch, util.CaptionCollate)
+    token_lengths = np.minimum(np.diff(offsets), max_seq_len)
+
+    position = np.arange(max_seq_len)
+    is_token = position[None, :] < token_lengths[:, None]
+
+    token_matrix = np.zeros((len(token_lengths), max_seq_len), dtype=np.int64)
+    token_matrix[is_token] = token_ids[(offsets[:-1, None] + position[None, :])[is_token]]
+
+    return torch.from_numpy(token_matrix), torch.from_numpy(token_lengths)
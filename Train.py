@@ -14,11 +14,19 @@ from eval_metrics import evaluate_metrics
 from terminaltables import AsciiTable
 import pickle
 
-def Train(model, LR, train_dataloader, test_dataloader, epochs, model_name, beam_search, device, Dataset = 'AudioCaps', test_dataloader_other_dataset = None) :
+from FeatureCache import get_feature_cache
+from ShardDataset import ShardDataset
+
+def Train(model, LR, train_dataloader, test_dataloader, epochs, model_name, beam_search, device, Dataset = 'AudioCaps', test_dataloader_other_dataset = None, feature_cache_dir = None, checkpointing_policy = None) :
+    # feature_cache_dir : if set, the encoder's features are cached there once the encoder is frozen (FeatureCache.py)
+    # checkpointing_policy : parts whose activations are recomputed in backward (AAC_Prefix.set_checkpointing_policy)
     
     model.train()
     model.to(device)
     
+    if checkpointing_policy != None :
+        model.set_checkpointing_policy(checkpointing_policy)
+    
     if Dataset == 'AudioCaps' :
         optimizer = AdamW(model.parameters(), lr=LR, weight_decay = 0.01) # Custom
 #         optimizer = AdamW( # GPT2 header
@@ -53,19 +61,36 @@ def Train(model, LR, train_dataloader, test_dataloader, epochs, model_name, beam
     training_consumed_sec = 0
     
     for epoch in range(epochs) :
+        
+        # the frozen encoder gives the same features every epoch : read them from the cache instead of running it
+        # (not for variable-length batches : the cache holds features of fixed-length clips, 
+        #  nor for shards : they are streamed)
+        if feature_cache_dir != None and isinstance(train_dataloader.dataset, ShardDataset) == False and \
+           train_dataloader.dataset.feature_cache == None and \
+           getattr(train_dataloader.dataset, 'variable_length', False) == False :
+            if all(param.requires_grad == False for param in model.audio_encoder.parameters()) :
+                feature_cache = get_feature_cache(model.audio_encoder, train_dataloader.dataset, feature_cache_dir, device)
+                train_dataloader.dataset.set_feature_cache(feature_cache)
+        
         pbar = tqdm(train_dataloader, desc=f"Training Epoch {epoch}")
         total_loss_per_epopch = 0.0
         loss_add_count = 0.0
         
         train_start_time_per_epoch = time.time()
         
-        for batch_i, (audio, tokens, mask, _) in enumerate(pbar) :
+        for batch_i, batch in enumerate(pbar) :
             
-            audio = audio.to(device)
+            audio, tokens, mask = batch[:3]
+            audio_lengths = batch[4].to(device) if len(batch) == 5 else None # variable-length batch (util.collate_variable_length)
+            
+            if isinstance(audio, list) : # cached (temporal_feature, global_feature)
+                audio = [feature.to(device) for feature in audio]
+            else :
+                audio = audio.to(device)
             tokens = tokens.to(device)
             mask = mask.to(device)
             
-            logits = model(audio, tokens, mask)[:, prefix_length - 1: -1]
+            logits = model(audio, tokens, mask, audio_lengths = audio_lengths)[:, prefix_length - 1: -1]
                 
             loss = nnf.cross_entropy(logits.reshape(-1, logits.shape[-1]).to(device), tokens.flatten().to(device), ignore_index=0)
                 
@@ -112,6 +137,245 @@ def Train(model, LR, train_dataloader, test_dataloader, epochs, model_name, beam
     print("Training time :", result_list[0])
 
 
+def measure_training_step(model, audio, tokens, mask, prefix_length, device, audio_lengths = None) :
+    # memory of the activations kept for backward at the end of the forward pass, peak memory of the step 
+    # (bytes, above the memory in use before the step) and time of one forward + backward pass
+    
+    def training_step() :
+        with torch.profiler.record_function('training_step_forward') :
+            logits = model(audio, tokens, mask, audio_lengths = audio_lengths)[:, prefix_length - 1: -1]
+            loss = nnf.cross_entropy(logits.reshape(-1, logits.shape[-1]), tokens.flatten(), ignore_index=0)
+        
+        if device.type == 'cuda' :
+            torch.cuda.synchronize(device)
+            activation_memory_list.append(torch.cuda.memory_allocated(device))
+        
+        loss.backward()
+    
+    activation_memory_list = []
+    start_time = time.time()
+    
+    if device.type == 'cuda' :
+        torch.cuda.synchronize(device)
+        memory_before = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        training_step()
+        torch.cuda.synchronize(device)
+        activation_memory = activation_memory_list[0] - memory_before
+        peak_memory = torch.cuda.max_memory_allocated(device) - memory_before
+    else :
+        # CPU : memory timeline of the profiler (memory allocated minus freed by each op, in order)
+        with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof :
+            training_step()
+        events = sorted(prof.events(), key=lambda event : event.time_range.start)
+        forward_end = [event.time_range.end for event in events if event.name == 'training_step_forward'][0]
+        
+        memory_in_use, peak_memory, activation_memory = 0, 0, 0
+        for event in events :
+            memory_in_use += event.self_cpu_memory_usage
+            peak_memory = max(peak_memory, memory_in_use)
+            if event.time_range.start <= forward_end :
+                activation_memory = memory_in_use
+    
+    step_sec = time.time() - start_time
+    model.zero_grad(set_to_none=True)
+    
+    return activation_memory, peak_memory, step_sec
+
+
+def report_checkpointing_memory(model, train_dataloader, device, policy_list = [None, ['encoder'], ['mapping'], ['gpt2'], 'all']) :
+    # Activation memory, peak memory and time of one training step on the first batch of 'train_dataloader' 
+    # for each activation checkpointing policy (AAC_Prefix.set_checkpointing_policy)
+    device = torch.device(device)
+    
+    model.train()
+    model.to(device)
+    
+    prefix_length = model.temporal_prefix_length + model.global_prefix_length
+    
+    if prefix_length == 0 :
+        prefix_length = 26
+    
+    batch = next(iter(train_dataloader))
+    audio, tokens, mask = batch[:3]
+    audio_lengths = batch[4].to(device) if len(batch) == 5 else None # variable-length batch (util.collate_variable_length)
+    
+    if isinstance(audio, list) : # cached (temporal_feature, global_feature)
+        audio = [feature.to(device) for feature in audio]
+    else :
+        audio = audio.to(device)
+    tokens = tokens.to(device)
+    mask = mask.to(device)
+    
+    # BatchNorm statistics are restored after the measurement
+    state_dict = {name : tensor.clone() for name, tensor in model.state_dict().items()}
+    
+    model.set_checkpointing_policy(None)
+    measure_training_step(model, audio, tokens, mask, prefix_length, device, audio_lengths) # warm-up
+    no_checkpointing_activation_memory, no_checkpointing_peak_memory, _ = measure_training_step(model, audio, tokens, mask, prefix_length, device, audio_lengths)
+    
+    result_table = [['policy', 'activations (MB)', 'activations saved (MB)', 'peak (MB)', 'peak saved (MB)', 'step time (s)']]
+    
+    for policy in policy_list :
+        model.set_checkpointing_policy(policy)
+        activation_memory, peak_memory, step_sec = measure_training_step(model, audio, tokens, mask, prefix_length, device, audio_lengths)
+        
+        result_table.append([str(policy), 
+                             round(activation_memory / 2**20, 1), round((no_checkpointing_activation_memory - activation_memory) / 2**20, 1), 
+                             round(peak_memory / 2**20, 1), round((no_checkpointing_peak_memory - peak_memory) / 2**20, 1), 
+                             round(step_sec, 3)])
+    
+    model.set_checkpointing_policy(None)
+    model.load_state_dict(state_dict)
+    
+    print(AsciiTable(result_table).table)
+    
+    return result_table
+
+
+def Train_DraftDecoder(model, draft_decoder, LR, train_dataloader, epochs, model_name, device) :
+    # Distill the draft decoder of speculative decoding (AAC_Prefix/DraftDecoder.py) from the trained model.
+    # The model is a frozen teacher : the draft learns GPT2 + language header's next-token distribution 
+    # on the training captions, given the same prefix vectors.
+    
+    model.eval()
+    model.to(device)
+    draft_decoder.train()
+    draft_decoder.to(device)
+    
+    optimizer = AdamW(draft_decoder.parameters(), lr=LR, weight_decay = 0.01)
+    
+    warmup_steps = int((epochs * len(train_dataloader)) / 6)
+    num_training_steps=epochs * len(train_dataloader)
+    
+    scheduler = get_cosine_schedule_with_warmup(
+    optimizer, num_warmup_steps=warmup_steps, num_training_steps=num_training_steps)
+    
+    prefix_length = model.temporal_prefix_length + model.global_prefix_length
+    
+    if prefix_length == 0 :
+        prefix_length = 26
+    
+    for epoch in range(epochs) :
+        pbar = tqdm(train_dataloader, desc=f"Distilling Epoch {epoch}")
+        total_loss_per_epopch = 0.0
+        loss_add_count = 0.0
+        
+        for batch_i, batch in enumerate(pbar) :
+            
+            audio, tokens, mask = batch[:3]
+            audio_lengths = batch[4].to(device) if len(batch) == 5 else None # variable-length batch
+
+            if isinstance(audio, list) : # cached (temporal_feature, global_feature)
+                audio = [feature.to(device) for feature in audio]
+            else :
+                audio = audio.to(device)
+            tokens = tokens.to(device)
+            mask = mask.to(device)
+            
+            with torch.no_grad() :
+                prefix_vectors = model.get_prefix_vectors(audio, audio_lengths)
+                embedding_cat = torch.cat((prefix_vectors, model.gpt.wte(tokens)), dim=1)
+                
+                out_hidden_states = model.gpt(inputs_embeds=embedding_cat, attention_mask=mask)[0]
+                teacher_logits = model.get_logits_from_hidden_states(out_hidden_states)[:, prefix_length - 1: -1]
+            
+            draft_hidden_states = draft_decoder(embedding_cat, attention_mask=mask)[0]
+            draft_logits = draft_decoder.get_logits(model, draft_hidden_states)[:, prefix_length - 1: -1]
+            
+            # KL(teacher || draft) on the caption positions (padding is excluded by the mask)
+            kl_div = nnf.kl_div(draft_logits.log_softmax(-1), teacher_logits.log_softmax(-1), 
+                                reduction='none', log_target=True).sum(-1)
+            token_mask = mask[:, prefix_length:]
+            loss = (kl_div * token_mask).sum() / token_mask.sum()
+            
+            total_loss_per_epopch += loss.item()
+            loss_add_count += 1.0
+            loss.backward()
+            
+            optimizer.step()
+            optimizer.zero_grad()
+            scheduler.step()
+            
+            avr_loss = total_loss_per_epopch / loss_add_count
+            pbar.set_description(f"Distilling Epoch {epoch}, Loss = {round(avr_loss, 5)}")
+        
+        param_file_path = "./Train_record/params_" + model_name + "/DraftDecoder_epoch_" + str(epoch) + ".pt"
+            
+        torch.save(draft_decoder.state_dict(), param_file_path)
+    
+    draft_decoder.eval()
+    
+    return draft_decoder
+
+
+def Train_StudentEncoder(teacher, student, LR, train_dataloader, epochs, model_name, device, global_loss_weight = 1.0) :
+    # Distill a slim audio encoder (Cnn14_Student in AAC_Prefix/PANNs/CNN14.py) from Cnn14.
+    # The mapping networks only see the encoder's outputs, so the student learns the teacher's temporal feature
+    # (MSE, padded frames excluded) and global feature (BCE with the teacher's AudioSet probabilities as targets).
+    
+    teacher.eval()
+    teacher.to(device)
+    student.train() # SpecAugment / dropout on the student's input only
+    student.to(device)
+    
+    optimizer = AdamW(student.parameters(), lr=LR, weight_decay = 0.01)
+    
+    warmup_steps = int((epochs * len(train_dataloader)) / 6)
+    num_training_steps=epochs * len(train_dataloader)
+    
+    scheduler = get_cosine_schedule_with_warmup(
+    optimizer, num_warmup_steps=warmup_steps, num_training_steps=num_training_steps)
+    
+    for epoch in range(epochs) :
+        pbar = tqdm(train_dataloader, desc=f"Distilling Epoch {epoch}")
+        total_loss_per_epopch = 0.0
+        loss_add_count = 0.0
+        
+        for batch_i, batch in enumerate(pbar) :
+            
+            audio = batch[0].to(device)
+            audio_lengths = batch[4].to(device) if len(batch) == 5 else None # variable-length batch
+            
+            if audio_lengths is None :
+                with torch.no_grad() :
+                    teacher_temporal, teacher_global = teacher(audio)
+                student_temporal, student_global = student(audio)
+                frame_mask = torch.ones(teacher_temporal.size()[0], teacher_temporal.size()[2], device=device)
+            else :
+                with torch.no_grad() :
+                    teacher_temporal, teacher_global, frame_mask = teacher(audio, lengths=audio_lengths)
+                student_temporal, student_global, _ = student(audio, lengths=audio_lengths)
+                frame_mask = frame_mask.float()
+            
+            # MSE per element of the temporal feature, on the columns of the clips
+            squared_error = (student_temporal - teacher_temporal).pow(2).mean(dim=(1, 3))
+            temporal_loss = (squared_error * frame_mask).sum() / frame_mask.sum()
+            
+            global_loss = nnf.binary_cross_entropy(student_global.clamp(1e-7, 1 - 1e-7), teacher_global)
+            
+            loss = temporal_loss + global_loss_weight * global_loss
+            
+            total_loss_per_epopch += loss.item()
+            loss_add_count += 1.0
+            loss.backward()
+            
+            optimizer.step()
+            optimizer.zero_grad()
+            scheduler.step()
+            
+            avr_loss = total_loss_per_epopch / loss_add_count
+            pbar.set_description(f"Distilling Epoch {epoch}, Loss = {round(avr_loss, 5)}")
+        
+        param_file_path = "./Train_record/params_" + model_name + "/StudentEncoder_epoch_" + str(epoch) + ".pt"
+            
+        torch.save(student.state_dict(), param_file_path)
+    
+    student.eval()
+    
+    return student
+
+
 def eval_model(model, test_dataloader, epoch, model_name, beam_search, device, Dataset, test_dataloader_other_dataset = None) :
     
     model.eval()
@@ -123,16 +387,19 @@ def eval_model(model, test_dataloader, epoch, model_name, beam_search, device, D
     captions_pred_other_dataset: List[Dict] = []
     captions_gt_other_dataset: List[Dict] = []
     
-    for i, (audio, captions, f_names) in enumerate(tqdm(test_dataloader, desc="Eval using dataset...")):
+    for i, batch in enumerate(tqdm(test_dataloader, desc="Eval using dataset...")):
+        audio, captions, f_names = batch[:3]
+        audio_lengths = batch[3][:1].to(device) if len(batch) == 4 else None # variable-length dataloader
+        
         with torch.no_grad():
             audio = audio.to(device)
             
             audio = audio[0,:].unsqueeze(0)
             
             if beam_search == True :
-                pred_caption = model(audio, None, beam_search = True)[0][0]
+                pred_caption = model(audio, None, beam_search = True, audio_lengths = audio_lengths)[0][0]
             else :
-                pred_caption = model(audio, None, beam_search = False)[0]
+                pred_caption = model(audio, None, beam_search = False, audio_lengths = audio_lengths)[0]
 
         captions_pred.append({
                             'file_name': f_names[0], 
@@ -153,16 +420,19 @@ def eval_model(model, test_dataloader, epoch, model_name, beam_search, device, D
         
         print("==========================================================================================")
         
-        for i, (audio, captions, f_names) in enumerate(tqdm(test_dataloader_other_dataset, desc="Eval using other dataset...")):
+        for i, batch in enumerate(tqdm(test_dataloader_other_dataset, desc="Eval using other dataset...")):
+            audio, captions, f_names = batch[:3]
+            audio_lengths = batch[3][:1].to(device) if len(batch) == 4 else None # variable-length dataloader
+            
             with torch.no_grad():
                 audio = audio.to(device)
 
                 audio = audio[0,:].unsqueeze(0)
 
                 if beam_search == True :
-                    pred_caption = model(audio, None, beam_search = True)[0][0]
+                    pred_caption = model(audio, None, beam_search = True, audio_lengths = audio_lengths)[0][0]
                 else :
-                    pred_caption = model(audio, None, beam_search = False)[0]
+                    pred_caption = model(audio, None, beam_search = False, audio_lengths = audio_lengths)[0]
 
             captions_pred_other_dataset.append({
                                 'file_name': f_names[0], 
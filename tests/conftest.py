@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the modules of the repository are imported from its root (e.g. 'from util import *'), as in the scripts
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, REPO_DIR)
+os.chdir(REPO_DIR)
@@ -0,0 +1,176 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+from transformers import GPT2Config, GPT2Model
+
+import AAC_Prefix.AAC_Prefix as AAC_Prefix_module
+
+# generate_beam (batched clips, GPT2 key/value cache shared by the beams, finished clips dropped from the batch)
+# against the original beam search, which decodes one clip at a time and runs GPT2 on the whole sequence every step.
+# A small random GPT2 and language header on CPU, custom vocabulary (stop token : 13).
+
+VOCAB_SIZE = 300
+STOP_TOKEN_INDEX = 13
+PREFIX_SIZE_DICT = {"temporal_prefix_size" : 15, "global_prefix_size" : 11}
+
+
+class IdTokenizer() :
+    # the captions are the token ids, so the outputs can be compared and scored exactly
+    def encode(self, sentence) :
+        return [STOP_TOKEN_INDEX]
+
+    def decode(self, token_idx) :
+        return ' '.join(str(int(idx)) for idx in token_idx)
+
+
+def get_tiny_model(seed, monkeypatch) :
+    torch.manual_seed(seed)
+    gpt = GPT2Model(GPT2Config(n_layer=2, n_embd=768, n_head=12, vocab_size=VOCAB_SIZE, n_positions=128))
+    monkeypatch.setattr(AAC_Prefix_module.GPT2Model, 'from_pretrained', lambda *args, **kwargs : gpt)
+
+    model = AAC_Prefix_module.AAC_Prefix(nn.Identity(), IdTokenizer(), vocab_size=VOCAB_SIZE, Dataset='AudioCaps',
+                                         prefix_size_dict=PREFIX_SIZE_DICT, temporal_num_layers=1, global_num_layers=1,
+                                         device='cpu')
+
+    # a sharper header with a bias on the stop token, so the beams stop at different lengths
+    language_header = nn.Linear(768, VOCAB_SIZE, bias=True)
+    with torch.no_grad() :
+        language_header.weight.copy_(model.language_header.weight * 3.0)
+        language_header.bias.zero_()
+        language_header.bias[STOP_TOKEN_INDEX] = 5.0
+    model.language_header = language_header
+
+    return model.eval()
+
+
+def reference_generate_beam(model, prefix_projections, beam_size = 5) :
+    # the original generate_beam : returns the captions and the normalized scores of every clip, best first
+    entry_count = prefix_projections.size()[0]
+    entry_length = 67
+    temperature=1.0
+    stop_token_index = STOP_TOKEN_INDEX
+
+    output_texts_list = []
+    output_scores_list = []
+
+    for entry_idx in range(entry_count):
+
+        generated = prefix_projections[entry_idx,:,:].unsqueeze(0)
+        scores = None
+        tokens = None
+        seq_lengths = torch.ones(beam_size)
+        is_stopped = torch.zeros(beam_size, dtype=torch.bool)
+
+        for i in range(entry_length):
+
+            out_hidden_states = model.gpt(inputs_embeds=generated)[0]
+            logits = model.get_logits_from_hidden_states(out_hidden_states)
+
+            logits = logits[:, -1, :] / (temperature)
+            logits = logits.softmax(-1).log()
+            if scores is None:
+                scores, next_tokens = logits.topk(beam_size, -1)
+                generated = generated.expand(beam_size, *generated.shape[1:])
+                next_tokens, scores = next_tokens.permute(1, 0), scores.squeeze(0)
+                tokens = next_tokens
+            else:
+                logits[is_stopped] = -float(np.inf)
+                logits[is_stopped, 0] = 0
+                scores_sum = scores[:, None] + logits
+                seq_lengths[~is_stopped] += 1
+                scores_sum_average = scores_sum / seq_lengths[:, None]
+                scores_sum_average, next_tokens = scores_sum_average.view(-1).topk(
+                    beam_size, -1
+                )
+                next_tokens_source = torch.div(next_tokens, scores_sum.shape[1], rounding_mode='floor')
+                seq_lengths = seq_lengths[next_tokens_source]
+                next_tokens = next_tokens % scores_sum.shape[1]
+                next_tokens = next_tokens.unsqueeze(1)
+                tokens = tokens[next_tokens_source]
+                tokens = torch.cat((tokens, next_tokens), dim=1)
+                generated = generated[next_tokens_source]
+                scores = scores_sum_average * seq_lengths
+                is_stopped = is_stopped[next_tokens_source]
+            next_token_embed = model.gpt.wte(next_tokens.squeeze()).view(
+                generated.shape[0], 1, -1
+            )
+            generated = torch.cat((generated, next_token_embed), dim=1)
+            is_stopped = is_stopped + next_tokens.eq(stop_token_index).squeeze()
+            if is_stopped.all():
+                break
+        scores = scores / seq_lengths
+        output_list = tokens.numpy()
+        order = scores.argsort(descending=True)
+        output_texts = [model.tokenizer.decode(output[: int(length)]) for output, length in zip(output_list, seq_lengths)]
+
+        output_texts_list.append([output_texts[i] for i in order])
+        output_scores_list.append([scores[i].item() for i in order])
+
+    return output_texts_list, output_scores_list
+
+
+def get_normalized_score(model, prefix_projection, caption) :
+    # average log-probability of a caption (token ids joined by ' ') after the prefix, as the beam search scores it
+    token_idx = torch.tensor([int(idx) for idx in caption.split(' ')])
+
+    generated = torch.cat((prefix_projection, model.gpt.wte(token_idx)), dim=0).unsqueeze(0)
+    log_probs = model.get_logits_from_hidden_states(model.gpt(inputs_embeds=generated)[0])[0].softmax(-1).log()
+
+    prefix_length = prefix_projection.size()[0]
+    positions = torch.arange(token_idx.size()[0]) + prefix_length - 1
+
+    return log_probs[positions, token_idx].mean().item()
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('beam_size', [2, 5])
+def test_generate_beam_matches_reference(seed, beam_size, monkeypatch) :
+    model = get_tiny_model(seed, monkeypatch)
+
+    torch.manual_seed(100 + seed)
+    prefix_projections = torch.randn(3, PREFIX_SIZE_DICT["temporal_prefix_size"] + PREFIX_SIZE_DICT["global_prefix_size"], 768) * 2
+
+    with torch.no_grad() :
+        reference_texts_list, reference_scores_list = reference_generate_beam(model, prefix_projections, beam_size)
+        output_texts_list = model.generate_beam(prefix_projections, beam_size)
+
+        assert output_texts_list == reference_texts_list
+
+        for prefix_projection, output_texts, reference_scores in zip(prefix_projections, output_texts_list, reference_scores_list) :
+            scores = [get_normalized_score(model, prefix_projection, output_text) for output_text in output_texts]
+            assert scores == pytest.approx(reference_scores, abs=1e-4)
+
+
+@pytest.mark.parametrize('seed', [0, 3])
+def test_generate_beam_skips_finished_beams(seed, monkeypatch) :
+    # beams of a clip stop at different steps : the finished ones are not decoded while the others run
+    row_counts = {'decoded' : 0, 'all' : 0}
+
+    class CountingKVCache(AAC_Prefix_module.SharedPrefixKVCache) :
+        def step(self, token_embeds, is_active = None) :
+            row_counts['decoded'] += token_embeds.size()[0] if is_active is not None else self.num_clips * self.beam_size
+            row_counts['all'] += self.num_clips * self.beam_size
+            return super(CountingKVCache, self).step(token_embeds, is_active)
+
+    model = get_tiny_model(seed, monkeypatch)
+    monkeypatch.setattr(AAC_Prefix_module, 'SharedPrefixKVCache', CountingKVCache)
+
+    torch.manual_seed(100 + seed)
+    prefix_projections = torch.randn(3, PREFIX_SIZE_DICT["temporal_prefix_size"] + PREFIX_SIZE_DICT["global_prefix_size"], 768) * 2
+
+    with torch.no_grad() :
+        reference_texts_list, _ = reference_generate_beam(model, prefix_projections, 5)
+        output_texts_list = model.generate_beam(prefix_projections, 5)
+
+    assert any(len(set(len(text.split(' ')) for text in texts)) > 1 for texts in reference_texts_list)
+    assert output_texts_list == reference_texts_list
+    assert row_counts['decoded'] < row_counts['all']
+
+
+def test_unsupported_gpt2_config_raises() :
+    # the cached decoding step does not implement the upcast / reordered attention
+    gpt = GPT2Model(GPT2Config(n_layer=1, n_embd=768, n_head=12, vocab_size=VOCAB_SIZE, reorder_and_upcast_attn=True))
+
+    with pytest.raises(Exception) :
+        AAC_Prefix_module.SharedPrefixKVCache(gpt, 2, 8)
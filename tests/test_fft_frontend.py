@@ -0,0 +1,37 @@
+import pytest
+import torch
+
+from AAC_Prefix.PANNs.CNN14 import Cnn14
+
+# Cnn14's torch.stft frontend (frontend = 'fft') against torchlibrosa's conv1d STFT, 
+# with the same random weights in float32 on CPU.
+
+
+def get_encoder_pair() :
+    torch.manual_seed(0)
+    conv_encoder = Cnn14(16000, 512, 320, 64, 50, 14000, 527).eval()
+    fft_encoder = Cnn14(16000, 512, 320, 64, 50, 14000, 527, frontend='fft').eval()
+    fft_encoder.load_state_dict(conv_encoder.state_dict()) # strict : the frontend adds no parameters
+
+    return conv_encoder, fft_encoder
+
+
+@pytest.mark.parametrize('length_sec', [1.0, 4.3, 10.0])
+def test_fft_frontend_matches_conv_stft(length_sec) :
+    conv_encoder, fft_encoder = get_encoder_pair()
+
+    torch.manual_seed(1)
+    audio = torch.randn(2, int(16000 * length_sec)) * 0.1
+    audio[0, :8000] = 0 # silence, clamped by power_to_db
+
+    with torch.no_grad() :
+        conv_logmel, fft_logmel = conv_encoder.get_logmel(audio), fft_encoder.get_logmel(audio)
+        conv_temporal, conv_global = conv_encoder(audio)[:2]
+        fft_temporal, fft_global = fft_encoder(audio)[:2]
+
+    assert conv_logmel.shape == fft_logmel.shape
+    assert (conv_logmel - fft_logmel).abs().max().item() < 1e-3 # dB
+
+    assert conv_temporal.shape == fft_temporal.shape
+    assert ((conv_temporal - fft_temporal).norm() / conv_temporal.norm()).item() < 1e-4
+    assert torch.allclose(conv_global, fft_global, rtol=1e-4, atol=1e-5)
@@ -0,0 +1,53 @@
+import pytest
+import torch
+
+from AAC_Prefix.AAC_Prefix import nucleus_filtering
+
+# nucleus_filtering (partial top-k, full sort only for the rows that need it) against the original top-p filtering
+# of generate, which sorts the whole vocabulary (applied here row by row).
+
+
+def reference_nucleus_filtering(logits, top_p, filter_value = -float("Inf")) :
+    filtered_logits_list = []
+
+    for row_logits in logits :
+        row_logits = row_logits.clone().unsqueeze(0)
+
+        sorted_logits, sorted_indices = torch.sort(row_logits, descending=True)
+        cumulative_probs = torch.cumsum(
+                    torch.softmax(sorted_logits, dim=-1), dim=-1
+                )
+        sorted_indices_to_remove = cumulative_probs > top_p
+        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[
+                    ..., :-1
+                ].clone()
+        sorted_indices_to_remove[..., 0] = 0
+
+        indices_to_remove = sorted_indices[sorted_indices_to_remove]
+        row_logits[:, indices_to_remove] = filter_value
+        filtered_logits_list.append(row_logits)
+
+    return torch.cat(filtered_logits_list, dim=0)
+
+
+@pytest.mark.parametrize('vocab_size', [300, 50257])
+@pytest.mark.parametrize('scale', [0.05, 1.0, 8.0]) # flat (high temperature) to peaked distributions
+def test_nucleus_filtering_matches_full_sort(vocab_size, scale) :
+    torch.manual_seed(0)
+    logits = torch.randn(6, vocab_size) * scale
+    logits[0] = logits[0] * 0.01 # nearly uniform row : the nucleus holds thousands of tokens
+
+    filtered_logits = nucleus_filtering(logits, 0.8)
+    reference_logits = reference_nucleus_filtering(logits, 0.8)
+
+    assert torch.equal(filtered_logits.isinf(), reference_logits.isinf())
+    assert torch.equal(filtered_logits[~filtered_logits.isinf()], reference_logits[~reference_logits.isinf()])
+
+
+def test_nucleus_filtering_keeps_best_token() :
+    logits = torch.tensor([[5.0, 1.0, 0.0, -1.0]])
+
+    filtered_logits = nucleus_filtering(logits, 0.1)
+
+    assert filtered_logits[0, 0].item() == 5.0
+    assert filtered_logits[0, 1:].isinf().all()
@@ -0,0 +1,47 @@
+import os
+
+import torch
+import torchaudio
+
+from FeatureCache import PCMStore, get_pcm_store
+
+
+def write_audio_files(audio_dir) :
+    torch.manual_seed(0)
+    audio = torch.rand(1, 16000) * 1.8 - 0.9
+
+    audio_path_dict = {}
+    for name, encoding, bits_per_sample in [('pcm16', 'PCM_S', 16), ('pcm24', 'PCM_S', 24), ('float', 'PCM_F', 32)] :
+        audio_path_dict[name] = os.path.join(audio_dir, name + '.wav')
+        torchaudio.save(audio_path_dict[name], audio, 16000, encoding=encoding, bits_per_sample=bits_per_sample)
+
+    return audio_path_dict
+
+
+def test_pcm_store_keeps_non_16bit_files_in_float(tmp_path) :
+    audio_path_dict = write_audio_files(str(tmp_path))
+    pcm_store = get_pcm_store(str(tmp_path / 'test_pcm.bin'), audio_path_dict)
+
+    assert 'pcm16' in pcm_store.int16_store
+    assert 'pcm24' in pcm_store.float_store and 'float' in pcm_store.float_store
+
+    for key, audio_path in audio_path_dict.items() :
+        audio, _ = torchaudio.load(audio_path)
+        assert torch.equal(pcm_store[key], audio[0])
+        assert pcm_store.get_num_samples(key) == audio.shape[1]
+
+
+def test_pcm_store_is_rebuilt_when_a_file_changes(tmp_path) :
+    audio_path_dict = write_audio_files(str(tmp_path))
+    store_path = str(tmp_path / 'test_pcm.bin')
+    get_pcm_store(store_path, audio_path_dict)
+
+    assert get_pcm_store(store_path, audio_path_dict).is_valid(audio_path_dict)
+
+    # a shorter file : its size changes, whatever the mtime resolution
+    torchaudio.save(audio_path_dict['pcm16'], torch.zeros(1, 8000), 16000, encoding='PCM_S', bits_per_sample=16)
+    assert PCMStore(store_path).is_valid(audio_path_dict) == False
+
+    pcm_store = get_pcm_store(store_path, audio_path_dict)
+    assert pcm_store.get_num_samples('pcm16') == 8000
+    assert torch.equal(pcm_store['pcm16'], torch.zeros(8000))
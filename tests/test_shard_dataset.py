@@ -0,0 +1,63 @@
+import os
+import pickle
+
+import numpy as np
+import torch
+
+from ShardDataset import ShardDataset, ShardDataLoader
+
+
+def write_test_shards(shard_dir, num_clips_list) :
+    # one sample per clip, file name 'f<clip index>', the clip's PCM is its index
+    shard_list, clip_idx = [], 0
+    for shard_idx, num_clips in enumerate(num_clips_list) :
+        shard_name = 'shard_%05d' % shard_idx
+        pcm = np.repeat(np.arange(clip_idx, clip_idx + num_clips, dtype=np.int16), 10)
+        pcm.tofile(os.path.join(shard_dir, shard_name + '.bin'))
+        clip_list = [(i * 10, 10, [(np.array([1, 2], dtype=np.int32), 'f%d' % (clip_idx + i))]) for i in range(num_clips)]
+        with open(os.path.join(shard_dir, shard_name + '.pickle'), 'wb') as f :
+            pickle.dump(clip_list, f)
+        shard_list.append(shard_name)
+        clip_idx += num_clips
+
+    with open(os.path.join(shard_dir, 'shards.pickle'), 'wb') as f :
+        pickle.dump({'shard_list' : shard_list, 'num_samples_list' : num_clips_list, 'is_train' : True,
+                     'padded_length' : 10, 'max_seq_len' : 4}, f)
+
+
+def test_shuffled_shards_mix_and_change_every_epoch(tmp_path) :
+    num_clips_list = [40, 40, 40, 13, 40, 40]
+    write_test_shards(str(tmp_path), num_clips_list)
+    shard_of = np.repeat(np.arange(len(num_clips_list)), num_clips_list)
+
+    dataset = ShardDataset(str(tmp_path), 10, shuffle=True, shuffle_buffer_size=64)
+    dataloader = ShardDataLoader(dataset=dataset, batch_size=16, num_workers=2, drop_last=False)
+
+    torch.manual_seed(0)
+    worker_file_sets = []
+    for epoch in range(3) :
+        batch_file_lists, shards_per_batch = [], []
+        for audio, tokens, token_length, file_names in dataloader :
+            clip_idx = [int(file_name[1:]) for file_name in file_names]
+            assert torch.equal(audio[:, 0], torch.tensor(clip_idx, dtype=torch.float32) / 32768) # PCM of the sample
+            batch_file_lists.append(list(file_names))
+            shards_per_batch.append(len(set(shard_of[clip_idx])))
+
+        file_list = sum(batch_file_lists, [])
+        assert len(batch_file_lists) == len(dataloader)
+        assert len(file_list) == sum(num_clips_list) and len(set(file_list)) == len(file_list)
+        assert sum(num_shards > 1 for num_shards in shards_per_batch) > len(shards_per_batch) // 2 # batches mix shards
+
+        # the dataloader alternates the batches of the two workers (7 batches each)
+        worker_file_sets.append(frozenset(sum(batch_file_lists[0::2], [])))
+
+    assert len(set(worker_file_sets)) > 1
+
+
+def test_test_split_reads_whole_shards_in_order(tmp_path) :
+    num_clips_list = [5, 3, 4]
+    write_test_shards(str(tmp_path), num_clips_list)
+
+    dataset = ShardDataset(str(tmp_path), 10, shuffle=False)
+    assert [sample[3] for sample in dataset] == ['f%d' % i for i in range(12)]
+    assert dataset.get_num_samples_per_worker(2) == [9, 3]
@@ -1,10 +1,14 @@
 import pickle
 import re
 import csv
-from torch.utils.data import DataLoader
+import torch
+from torch.utils.data import DataLoader, Sampler
+from torch.utils.data.dataloader import default_collate
 
 from AudioCaps.AudioCaps_Dataset import *
 from Clotho.Clotho_Dataset import *
+from FeatureCache import get_logmel_store
+from ShardDataset import get_shard_dataset, ShardDataLoader
 
 # Tokenizer of own vocabulary for Training Datset
 class tokenizer_forCustomVocab() :
@@ -51,12 +55,102 @@ class tokenizer_forCustomVocab() :
             with open(file_path, 'rb') as f:
                 self.vocab = pickle.load(f) 
         
-def CreateDataloader(tokenizer, data_dir, batch_size, split, prefix_size, is_TrainDataset = False, tokenizer_type = 'GPT2', is_settingnum_3 = False) :
+class LengthBucketBatchSampler(Sampler) :
+    # Batches of clips with similar durations, so a variable-length batch holds little zero padding.
+    # The shuffled indices are split into buckets of 'bucket_size' batches, each bucket is sorted by audio length 
+    # and cut into batches, and the order of the batches is shuffled.
+    
+    def __iter__(self) :
+        
+        if self.shuffle == True :
+            index_list = torch.randperm(len(self.length_list)).tolist()
+        else :
+            index_list = list(range(len(self.length_list)))
+        
+        batch_list = []
+        bucket_len = self.batch_size * self.bucket_size
+        for bucket_start in range(0, len(index_list), bucket_len) :
+            bucket = sorted(index_list[bucket_start : bucket_start + bucket_len], key=lambda idx : self.length_list[idx])
+            
+            for batch_start in range(0, len(bucket), self.batch_size) :
+                batch = bucket[batch_start : batch_start + self.batch_size]
+                if len(batch) == self.batch_size or self.drop_last == False :
+                    batch_list.append(batch)
+        
+        if self.shuffle == True :
+            batch_list = [batch_list[i] for i in torch.randperm(len(batch_list)).tolist()]
+        
+        return iter(batch_list)
+    
+    def __len__(self) :
+        if self.drop_last == True :
+            return len(self.length_list) // self.batch_size
+        return (len(self.length_list) + self.batch_size - 1) // self.batch_size
+    
+    def __init__(self, length_list, batch_size, shuffle = True, drop_last = False, bucket_size = 100) :
+        # length_list : audio length (samples) of every item of the dataset
+        
+        self.length_list = length_list
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.bucket_size = bucket_size
 
-    if split == 'train' or split == 'test' :
-        dataset = AudioCapsDataset(tokenizer, data_dir, split, prefix_size, set_length = 10, tokenizer_type = tokenizer_type)
-    elif split == 'development' or split == 'evaluation' :
-        dataset = ClothoDataset(tokenizer, data_dir, split, prefix_size, tokenizer_type = tokenizer_type, is_settingnum_3 = is_settingnum_3)
+
+def collate_variable_length(batch) :
+    # Zero-pads the audio of a variable-length batch to its longest clip and appends the audio lengths 
+    # (number of samples) as the last element : (audio, ..., audio_lengths).
+    # Encoder features / log-mel (feature cache, log-mel store) have a fixed shape and use the default collate.
+    
+    if torch.is_tensor(batch[0][0]) == False or batch[0][0].dim() != 1 :
+        return default_collate(batch)
+    
+    audio_lengths = torch.tensor([item[0].shape[0] for item in batch], dtype=torch.int64)
+    audio = torch.zeros(len(batch), int(audio_lengths.max()))
+    for i, item in enumerate(batch) :
+        audio[i, :audio_lengths[i]] = item[0]
+    
+    return [audio] + default_collate([item[1:] for item in batch]) + [audio_lengths]
+
+
+class CaptionCollate() :
+    # Batches of training samples (audio, tokens, token_length, file name) : the mask of the prefix and the caption
+    # tokens is built for the whole batch, (audio, tokens, mask, file name[, audio_lengths]).
+    
+    def __call__(self, batch) :
+        
+        if self.variable_length == True :
+            batch = collate_variable_length(batch)
+        else :
+            batch = default_collate(batch)
+        
+        tokens, token_lengths = batch[1], batch[2]
+        
+        # 1 for the prefix and the caption's tokens, 0 where we out of sequence
+        mask = torch.ones(tokens.size()[0], self.prefix_length + tokens.size()[1])
+        mask[:, self.prefix_length:] = (torch.arange(tokens.size()[1]).unsqueeze(0) < token_lengths.unsqueeze(1)).float()
+        
+        return [batch[0], tokens, mask] + batch[3:]
+    
+    def __init__(self, prefix_length, variable_length = False) :
+        
+        self.prefix_length = prefix_length
+        self.variable_length = variable_length
+
+
+def get_collate_fn(is_train_split, prefix_length, variable_length) :
+    # collate_fn of the dataloader of a split (None : default collate)
+    if is_train_split == True :
+        return CaptionCollate(prefix_length, variable_length)
+    if variable_length == True :
+        return collate_variable_length
+    return None
+
+
+def CreateDataloader(tokenizer, data_dir, batch_size, split, prefix_size, is_TrainDataset = False, tokenizer_type = 'GPT2', is_settingnum_3 = False, logmel_store_dir = None, variable_length = False, shard_dir = None) :
+    # variable_length : clips are not padded to a fixed duration, batches hold clips of similar length 
+    #                   (LengthBucketBatchSampler) and end with the audio lengths (collate_variable_length)
+    # shard_dir       : the split is streamed from its shards (Pack_Shards.py) if they exist
 
     if is_TrainDataset == True :
         is_shuffle = True
@@ -66,11 +160,47 @@ def CreateDataloader(tokenizer, data_dir, batch_size, split, prefix_size, is_Tra
         is_drop_last = False
 
     cpu_core_num = 8 # num of thread to use for dataloader
-    dataloader = DataLoader(dataset=dataset,
-                      batch_size=batch_size,
-                      shuffle=is_shuffle,
-                      num_workers=cpu_core_num,
-                      drop_last=is_drop_last)
+    
+    collate_fn = get_collate_fn(split == 'train' or split == 'development', prefix_size, variable_length)
+    
+    if shard_dir != None :
+        if split == 'train' or split == 'test' :
+            dataset_name = 'AudioCaps_' + split
+        else :
+            dataset_name = 'Clotho_' + split + ('_compressed' if is_settingnum_3 == True else '')
+        
+        dataset = get_shard_dataset(shard_dir, dataset_name, tokenizer_type, prefix_size, shuffle = is_shuffle, variable_length = variable_length)
+        if dataset != None :
+            # shuffled by the dataset (order of the shards, samples of a shard), no length buckets
+            return ShardDataLoader(dataset=dataset,
+                                   batch_size=batch_size,
+                                   num_workers=cpu_core_num,
+                                   drop_last=is_drop_last,
+                                   collate_fn=collate_fn)
+
+    if split == 'train' or split == 'test' :
+        dataset = AudioCapsDataset(tokenizer, data_dir, split, prefix_size, set_length = 10, tokenizer_type = tokenizer_type, variable_length = variable_length)
+    elif split == 'development' or split == 'evaluation' :
+        dataset = ClothoDataset(tokenizer, data_dir, split, prefix_size, tokenizer_type = tokenizer_type, is_settingnum_3 = is_settingnum_3, variable_length = variable_length)
+    
+    # precomputed log-mel (Preprocess_LogmelStore.py) instead of audio, if the store exists
+    if logmel_store_dir != None and variable_length == False :
+        dataset.set_logmel_store(get_logmel_store(logmel_store_dir, dataset))
+    
+    if variable_length == True and is_TrainDataset == True :
+        length_list = [dataset.get_audio_length(item) for item in range(len(dataset))]
+        dataloader = DataLoader(dataset=dataset,
+                          batch_sampler=LengthBucketBatchSampler(length_list, batch_size, shuffle=is_shuffle, drop_last=is_drop_last),
+                          num_workers=cpu_core_num,
+                          collate_fn=collate_fn)
+    else :
+        # variable-length test : the batch of a clip holds its captions, so the order is kept
+        dataloader = DataLoader(dataset=dataset,
+                          batch_size=batch_size,
+                          shuffle=is_shuffle,
+                          num_workers=cpu_core_num,
+                          drop_last=is_drop_last,
+                          collate_fn=collate_fn)
     
     return dataloader
 
@@ -80,11 +210,14 @@ def get_pred_captions(model, test_dataloader, device, dataset = 'AudioCaps') :
     with open(f"{dataset}_pred_captions.csv", "w") as f:
         writer = csv.writer(f)
         writer.writerow(['file_name', 'caption'])
-        for i, (audio, captions, f_names) in enumerate(tqdm(test_dataloader, desc="Get Caption...")):
+        for i, batch in enumerate(tqdm(test_dataloader, desc="Get Caption...")):
+            audio, captions, f_names = batch[:3]
+            audio_lengths = batch[3][:1].to(device) if len(batch) == 4 else None # variable-length dataloader
+            
             with torch.no_grad() :
                 audio = audio.to(device)
                 audio = audio[0,:].unsqueeze(0)
 
-                pred_caption = model(audio, None, beam_search = True)[0][0]
+                pred_caption = model(audio, None, beam_search = True, audio_lengths = audio_lengths)[0][0]
 
                 writer.writerow([f_names[0], pred_caption])
\ No newline at end of file